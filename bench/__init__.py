@@ -0,0 +1,13 @@
+"""Headless benchmarks for the trading_app_full data layer.
+
+    python -m bench generate bench.db --users 10000 --trades 5000000
+    python -m bench run bench.db --out report.json
+    python -m bench compare before.json report.json
+
+Everything runs against trading_app_full as a plain library: no Streamlit
+server, no network (the USD/IDR rate and prices are never fetched).
+"""
+import streamlit.logger
+
+# st.cache_resource without a script-run context logs a warning per call
+streamlit.logger.set_log_level("error")
@@ -0,0 +1,83 @@
+import argparse
+import json
+import sys
+import time
+
+def cmdgenerate(args):
+    from bench.datagen import generate
+    started = time.perf_counter()
+    summary = generate(args.db, users=args.users, trades=args.trades, seed=args.seed, skew=args.skew,
+                       days=args.days, force=args.force,
+                       progress=lambda done: print(f"{done}/{args.trades} trades", file=sys.stderr))
+    summary['seconds'] = round(time.perf_counter() - started, 2)
+    print(json.dumps(summary, indent=2))
+    return 0
+
+def cmdrun(args):
+    from bench.scenarios import runall
+
+    def progress(name, result):
+        print(f"{name:28} median {result['medianms']:10.3f} ms  p95 {result['p95ms']:10.3f} ms  "
+              f"rows {result['rows']}", file=sys.stderr)
+
+    report = runall(args.db, only=args.only, repeatscale=args.repeat_scale,
+                    burstthreads=args.burst_threads, burstsize=args.burst_size, progress=progress)
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+def cmdcompare(args):
+    """Median ratio new/old per scenario; exit 1 when any scenario regressed past --threshold"""
+    with open(args.old) as f:
+        old = json.load(f)['scenarios']
+    with open(args.new) as f:
+        new = json.load(f)['scenarios']
+    regressed = []
+    print(f"{'scenario':28} {'old ms':>12} {'new ms':>12} {'ratio':>8}")
+    for name in sorted(set(old) | set(new)):
+        if name not in old or name not in new:
+            print(f"{name:28} {'only in ' + ('new' if name in new else 'old'):>34}")
+            continue
+        ratio = new[name]['medianms'] / old[name]['medianms'] if old[name]['medianms'] else float('inf')
+        flag = ""
+        if ratio > 1 + args.threshold:
+            regressed.append(name)
+            flag = "  REGRESSED"
+        print(f"{name:28} {old[name]['medianms']:12.3f} {new[name]['medianms']:12.3f} {ratio:8.2f}{flag}")
+    return 1 if regressed else 0
+
+def buildcli():
+    parser = argparse.ArgumentParser(prog="python -m bench")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("generate", help="create a synthetic database")
+    p.add_argument("db")
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--trades", type=int, default=200000)
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of trades per user")
+    p.add_argument("--days", type=int, default=730, help="history length")
+    p.add_argument("--force", action="store_true", help="overwrite an existing database")
+    p.set_defaults(func=cmdgenerate)
+    p = sub.add_parser("run", help="time the scenarios and write a JSON report")
+    p.add_argument("db")
+    p.add_argument("--out", help="report path (default: stdout)")
+    p.add_argument("--only", nargs="+", help="scenario name prefixes")
+    p.add_argument("--repeat-scale", type=float, default=1.0, help="multiply every scenario's repeat count")
+    p.add_argument("--burst-threads", type=int, default=8)
+    p.add_argument("--burst-size", type=int, default=250, help="inserts per thread")
+    p.set_defaults(func=cmdrun)
+    p = sub.add_parser("compare", help="compare two reports by median latency")
+    p.add_argument("old")
+    p.add_argument("new")
+    p.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown (0.10 = 10%%)")
+    p.set_defaults(func=cmdcompare)
+    return parser
+
+if __name__ == "__main__":
+    # guarded: password hashing spawns worker processes that re-import __main__
+    args = buildcli().parse_args()
+    sys.exit(args.func(args))
@@ -0,0 +1,95 @@
+"""Deterministic synthetic tradingapp.db-style databases"""
+import hashlib
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import trading_app_full as app
+
+# rough price levels and per-trade move size (fraction of price) per pair
+BASEPRICES = {"XAUUSD": 2300.0, "BTCUSD": 60000.0, "ETHUSD": 3000.0, "USTEC": 18000.0,
+              "USOIL": 80.0, "EURUSD": 1.08, "USDJPY": 150.0}
+MOVESIZE = {"XAUUSD": 0.004, "BTCUSD": 0.02, "ETHUSD": 0.025, "USTEC": 0.006,
+            "USOIL": 0.01, "EURUSD": 0.002, "USDJPY": 0.003}
+LOTS = np.array([0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0])
+USERPREFIX = "bench"
+USERPASSWORD = "bench123"
+STARTDATE = datetime(2024, 1, 1)
+GENCHUNKSIZE = 50000
+
+def userpasswordhash(seed):
+    """One PBKDF2 hash shared by every generated user, salted from the seed"""
+    salt = hashlib.sha256(f"bench-{seed}".encode()).digest()[:16]
+    dk = hashlib.pbkdf2_hmac('sha256', USERPASSWORD.encode(), salt, app.PASSWORDITERATIONS)
+    return f"{app.HASHPREFIX}${app.PASSWORDITERATIONS}${salt.hex()}${dk.hex()}"
+
+def userweights(users, skew):
+    """Zipf-like share of trades per user: user 0 is the heaviest, the last the lightest"""
+    weights = 1.0 / np.arange(1, users + 1) ** skew
+    return weights / weights.sum()
+
+def tradechunk(rng, size, userids, weights, firstsecond, spanseconds):
+    """One chunk of TRADEINSERTSQL tuples, in time order"""
+    owners = userids[rng.choice(len(userids), size=size, p=weights)]
+    codes = rng.integers(0, len(app.PAIROPTIONS), size=size)
+    pairs = np.array(app.PAIROPTIONS)[codes]
+    base = np.array([BASEPRICES[p] for p in app.PAIROPTIONS])[codes]
+    move = np.array([MOVESIZE[p] for p in app.PAIROPTIONS])[codes]
+    openprice = np.round(base * (1 + rng.normal(0, 0.05, size)), 5)
+    closeprice = np.round(openprice * (1 + rng.normal(0, 1, size) * move), 5)
+    positions = np.where(rng.random(size) < 0.5, "BUY", "SELL")
+    lot = LOTS[rng.integers(0, len(LOTS), size=size)]
+    pips, profitusd = app.calculatetradesvec(pairs, positions, lot, openprice, closeprice)
+    rate = np.round(app.DEFAULTUSDIDR * (1 + rng.normal(0, 0.01, size)), 0)
+    seconds = np.sort(rng.integers(0, spanseconds, size=size)) + firstsecond
+    createdat = datetime.utcnow().isoformat()
+    rows = []
+    for i in range(size):
+        ts = STARTDATE + timedelta(seconds=int(seconds[i]))
+        usd = round(float(profitusd[i]), 2)
+        rows.append((int(owners[i]), pairs[i], positions[i], float(lot[i]), float(openprice[i]),
+                     float(closeprice[i]), None, None, ts.strftime("%Y-%m-%d"), ts.strftime("%H:%M:%S"),
+                     None, usd, round(usd * rate[i], 0), round(float(pips[i]), 4), createdat))
+    return rows
+
+def generate(path, users=1000, trades=200000, seed=42, skew=1.1, days=730,
+             chunksize=GENCHUNKSIZE, force=False, progress=None):
+    """Create a fresh database at path with users and trades; returns a summary dict.
+
+    The same (users, trades, seed, skew, days) always produce the same rows
+    (createdat aside). Trades go through the app's own bulk insert op so the
+    aggregate tables and data versions are maintained exactly as in production.
+    """
+    if os.path.exists(path):
+        if not force:
+            raise FileExistsError(f"{path} exists (use force=True to overwrite)")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    app.DBPATH = path
+    app.initdb()
+    rng = np.random.default_rng(seed)
+    pwhash = userpasswordhash(seed)
+    created = datetime.utcnow().isoformat()
+    with app.getdb().transaction() as conn:
+        conn.executemany("INSERT INTO tuser(username,passwordhash,role,status,createdat) VALUES (?,?,?,?,?)",
+                         [(f"{USERPREFIX}{i:05d}", pwhash, "user", "active", created) for i in range(users)])
+        userids = np.array([r[0] for r in conn.execute(
+            "SELECT id FROM tuser WHERE username LIKE ? ORDER BY username", (USERPREFIX + "%",))], dtype=np.int64)
+    weights = userweights(users, skew)
+    spanseconds = days * 86400
+    writer = app.gettradewriter()
+    done = 0
+    while done < trades:
+        size = min(chunksize, trades - done)
+        # chunks cover consecutive time slices so ids stay in date order
+        first = spanseconds * done // trades
+        span = max(spanseconds * (done + size) // trades - first, 1)
+        writer.submit(app.tradebulkinsertop, tradechunk(rng, size, userids, weights, first, span)).result()
+        done += size
+        if progress:
+            progress(done)
+    with app.getdb().connection() as conn:
+        conn.execute("ANALYZE")
+    return {'path': path, 'users': users, 'trades': trades, 'seed': seed, 'skew': skew, 'days': days}
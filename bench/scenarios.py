@@ -0,0 +1,201 @@
+"""Timed scenarios against the app's own data-layer functions"""
+import inspect
+import os
+import platform
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+import trading_app_full as app
+from bench.datagen import USERPREFIX, USERPASSWORD
+
+BURSTNOTE = "bench-burst"
+
+def summarize(samples, rows):
+    """Latency summary in milliseconds for one scenario"""
+    ms = sorted(s * 1000.0 for s in samples)
+    return {
+        'repeat': len(ms),
+        'rows': rows,
+        'minms': ms[0],
+        'medianms': statistics.median(ms),
+        'p95ms': float(np.percentile(ms, 95)),
+        'maxms': ms[-1],
+        'meanms': statistics.fmean(ms),
+        'stdevms': statistics.stdev(ms) if len(ms) > 1 else 0.0,
+    }
+
+def timeit(fn, repeat, warmup=1):
+    """Run fn warmup + repeat times; fn returns a row count. Returns (samples, rows of the last run)"""
+    rows = None
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = fn()
+        samples.append(time.perf_counter() - started)
+    return samples, rows
+
+class Context:
+    """Dataset facts the scenarios need, looked up once"""
+
+    def __init__(self):
+        with app.getdb().read() as conn:
+            ranked = conn.execute("""SELECT s.userid, s.tradecount, u.username FROM tuserstats s
+                                     JOIN tuser u ON u.id = s.userid WHERE u.username LIKE ?
+                                     ORDER BY s.tradecount DESC, s.userid""", (USERPREFIX + "%",)).fetchall()
+            self.users = conn.execute("SELECT COUNT(*) FROM tuser").fetchone()[0]
+            self.trades = conn.execute("SELECT COUNT(*) FROM ttrading").fetchone()[0]
+        if not ranked:
+            raise RuntimeError("no generated users with trades; run `python -m bench generate` first")
+        self.heavy, self.heavycount, self.heavyname = ranked[0]
+        self.light, self.lightcount, self.lightname = ranked[-1]
+        self.tmpdir = tempfile.mkdtemp(prefix="tradingbench")
+
+    def dataset(self):
+        return {'users': self.users, 'trades': self.trades,
+                'heavyuser': self.heavyname, 'heavytrades': self.heavycount,
+                'lightuser': self.lightname, 'lighttrades': self.lightcount}
+
+def query(fn, cached):
+    """fn as the app calls it, or without the versioned query cache to time the SQL itself"""
+    return fn if cached else inspect.unwrap(fn)
+
+def tradesforuser(userid):
+    return lambda ctx: len(app.gettradesforuser(userid(ctx)))
+
+def firstpage(cached=False):
+    return lambda ctx: len(query(app.gettradespage, cached)(ctx.heavy)[0])
+
+def tradesframe(userid, allifadmin=False):
+    return lambda ctx: len(app.loadtradesframe(userid(ctx), allifadmin=allifadmin))
+
+def admindashboard(ctx):
+    """The data calls one admin dashboard render makes"""
+    totaltrades, totalusers = app.getadmintotals()
+    users, _ = app.searchusers()
+    trades, _ = app.gettradespage(None, allifadmin=True)
+    return len(users) + len(trades)
+
+def userdashboard(ctx):
+    stats = app.getuserstats(ctx.heavy)
+    return stats['tradecount']
+
+def exportcsv(userid, allifadmin=False):
+    def run(ctx):
+        dest = os.path.join(ctx.tmpdir, "export.csv")
+        try:
+            return app.exporttrades(dest, "csv", userid=userid(ctx), allifadmin=allifadmin)
+        finally:
+            os.remove(dest)
+    return run
+
+def burstrow(userid, i):
+    return {'userid': userid, 'pair': app.PAIROPTIONS[i % len(app.PAIROPTIONS)], 'type': "BUY" if i % 2 else "SELL",
+            'lot': 0.1, 'openprice': 100.0, 'closeprice': 101.0, 'date': datetime.utcnow().strftime("%Y-%m-%d"),
+            'time': datetime.utcnow().strftime("%H:%M:%S"), 'note': BURSTNOTE,
+            'profitusd': 0.0, 'profitidr': 0.0, 'pips': 0.0}
+
+def burstcleanupop(conn):
+    return conn.execute("DELETE FROM ttrading WHERE note=?", (BURSTNOTE,)).rowcount
+
+def insertburst(ctx, threads, perthread):
+    """threads concurrent callers, each inserting perthread rows one inserttradedata() at a time.
+
+    Returns (wall seconds, per-call latencies); the rows are deleted again afterwards.
+    """
+    barrier = threading.Barrier(threads)
+    latencies = [[] for _ in range(threads)]
+
+    def worker(t):
+        barrier.wait()
+        for i in range(perthread):
+            started = time.perf_counter()
+            app.inserttradedata(burstrow(ctx.light, t * perthread + i))
+            latencies[t].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(worker, range(threads)))
+    wall = time.perf_counter() - started
+    app.gettradewriter().submit(burstcleanupop).result()
+    return wall, [x for lat in latencies for x in lat]
+
+def login(ctx):
+    user = app.getuserbyusername(ctx.lightname)
+    if not app.verifypassword(USERPASSWORD, user['passwordhash']):
+        raise RuntimeError("generated user password did not verify")
+    return 1
+
+def hashing(ctx):
+    app.hashpassword(USERPASSWORD)
+    return 1
+
+def concurrentlogins(n):
+    def run(ctx):
+        user = app.getuserbyusername(ctx.lightname)
+        with ThreadPoolExecutor(max_workers=n) as pool:
+            ok = list(pool.map(lambda _: app.verifypassword(USERPASSWORD, user['passwordhash']), range(n)))
+        return sum(ok)
+    return run
+
+# name -> (callable(ctx) -> rows, repeat); repeat is scaled by --repeat-scale
+SCENARIOS = {
+    'gettradesforuser.heavy': (tradesforuser(lambda ctx: ctx.heavy), 5),
+    'gettradesforuser.light': (tradesforuser(lambda ctx: ctx.light), 50),
+    'gettradespage.heavy': (firstpage(), 200),
+    'gettradespage.cached': (firstpage(cached=True), 200),
+    'loadtradesframe.heavy': (tradesframe(lambda ctx: ctx.heavy), 5),
+    'loadtradesframe.all': (tradesframe(lambda ctx: None, allifadmin=True), 2),
+    'dashboard.admin': (admindashboard, 50),
+    'dashboard.user': (userdashboard, 200),
+    'export.csv.heavy': (exportcsv(lambda ctx: ctx.heavy), 3),
+    'export.csv.all': (exportcsv(lambda ctx: None, allifadmin=True), 1),
+    'auth.hashpassword': (hashing, 5),
+    'auth.login': (login, 5),
+    'auth.login.concurrent8': (concurrentlogins(8), 2),
+}
+
+def environment():
+    return {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'sqlite': sqlite3.sqlite_version,
+        'numpy': np.__version__,
+        'startedat': datetime.utcnow().isoformat(),
+    }
+
+def runall(path, only=None, repeatscale=1.0, burstthreads=8, burstsize=250, progress=None):
+    """Run every scenario (or those whose name starts with one of only) and return the report dict"""
+    app.DBPATH = path
+    ctx = Context()
+    report = {'environment': environment(), 'database': path, 'dataset': ctx.dataset(), 'scenarios': {}}
+    selected = [n for n in SCENARIOS if not only or any(n.startswith(o) for o in only)]
+    for name in selected:
+        fn, repeat = SCENARIOS[name]
+        samples, rows = timeit(lambda: fn(ctx), max(1, round(repeat * repeatscale)))
+        report['scenarios'][name] = summarize(samples, rows)
+        if progress:
+            progress(name, report['scenarios'][name])
+    if not only or any('insertburst'.startswith(o) or o.startswith('insertburst') for o in only):
+        wall, latencies = insertburst(ctx, burstthreads, burstsize)
+        result = summarize(latencies, burstthreads * burstsize)
+        result.update({'threads': burstthreads, 'wallms': wall * 1000.0,
+                       'rowspersec': burstthreads * burstsize / wall if wall else None})
+        report['scenarios'][f'insertburst.{burstthreads}x{burstsize}'] = result
+        if progress:
+            progress(f'insertburst.{burstthreads}x{burstsize}', result)
+    report['writer'] = app.gettradewriter().stats()
+    report['metrics'] = {name: {k: v for k, v in t.items() if k != 'buckets'}
+                         for name, t in app.getmetrics().snapshot()['timers'].items()}
+    os.rmdir(ctx.tmpdir)
+    return report
@@ -0,0 +1,96 @@
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+import streamlit.logger
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+streamlit.logger.set_log_level("error")  # st.cache_resource outside a script run warns per call
+
+import trading_app_full as app
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Fresh migrated database (default admin/admin123) used by every app helper"""
+    path = str(tmp_path / "trading.db")
+    monkeypatch.setattr(app, "DBPATH", path)
+    app.initdb()
+    yield path
+    app.gettradewriterfor(path).close()
+    app.getdbpool(path).closeall()
+
+
+class FakeUpstream:
+    """Local stand-in for the Binance, FMP and TwelveData price endpoints.
+
+    prices maps upstream symbols to quotes; every request is logged as
+    (path, query) and can be slowed down or failed per path prefix.
+    """
+
+    def __init__(self):
+        self.prices = {"BTCUSDT": 65000.5, "ETHUSDT": 3200.25, "XAUUSD": 2350.1, "WTIUSD": 78.4,
+                       "NDX": 18000.0, "EURUSD": 1.0812, "USDJPY": 151.3}
+        self.requests = []
+        self.delay = 0.0
+        self.failing = set()
+        self.lock = threading.Lock()
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                with upstream.lock:
+                    upstream.requests.append((url.path, query))
+                if upstream.delay:
+                    time.sleep(upstream.delay)
+                status, body = upstream.respond(url.path, query)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://%s:%d" % self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def respond(self, path, query):
+        if any(path.startswith(prefix) for prefix in self.failing):
+            return 500, {"error": "upstream down"}
+        if path == "/api/v3/ticker/price":
+            return 200, [{"symbol": s, "price": str(self.prices[s])} for s in json.loads(query["symbols"])]
+        if path.startswith("/api/v3/quote/"):
+            return 200, [{"symbol": s, "price": self.prices[s]} for s in path.rsplit("/", 1)[1].split(",")]
+        if path == "/price":
+            syms = query["symbol"].split(",")
+            if len(syms) == 1:
+                return 200, {"price": str(self.prices[syms[0]])}
+            return 200, {s: {"price": str(self.prices[s])} for s in syms}
+        return 404, {"error": "not found"}
+
+    def count(self, prefix):
+        with self.lock:
+            return sum(1 for path, _ in self.requests if path.startswith(prefix))
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def upstream():
+    server = FakeUpstream()
+    yield server
+    server.close()
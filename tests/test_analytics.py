@@ -0,0 +1,69 @@
+import pytest
+
+import trading_app_full as app
+
+
+def addtrade(profitusd, date, userid=1, pair="XAUUSD", time="10:00:00", closeprice=2310.0):
+    return app.inserttradedata({'userid': userid, 'pair': pair, 'type': "BUY", 'lot': 0.1, 'openprice': 2300.0,
+                                'closeprice': closeprice, 'date': date, 'time': time, 'profitusd': profitusd,
+                                'profitidr': profitusd * 16000, 'pips': profitusd / 10})
+
+
+@pytest.fixture
+def history(db):
+    # inserted out of time order: analytics sorts by trade time
+    addtrade(200.0, "2024-05-08", time="15:00:00", pair="EURUSD")   # Wed
+    addtrade(100.0, "2024-05-06")                                   # Mon
+    addtrade(-50.0, "2024-05-07")                                   # Tue
+    addtrade(-100.0, "2024-05-08")                                  # Wed
+    addtrade(0.0, "2024-05-09", closeprice=None)                    # open: not analysed
+
+
+def test_summary_equity_and_drawdown(history):
+    a = app.getanalytics(1)
+    sm = a['summary']
+    assert (sm['trades'], sm['wins'], sm['losses']) == (4, 2, 2)
+    assert sm['winrate'] == 0.5 and sm['netprofit'] == 150.0
+    assert sm['profitfactor'] == 2.0 and sm['expectancy'] == 37.5
+    assert (sm['avgwin'], sm['avgloss']) == (150.0, -75.0)
+    assert sm['maxdrawdown'] == 150.0
+    assert str(sm['maxdrawdownfrom']) == "2024-05-06 10:00:00" and str(sm['maxdrawdownto']) == "2024-05-08 10:00:00"
+    assert a['equity']['equity'].tolist() == [100.0, 50.0, -50.0, 150.0]
+    assert a['equity']['drawdown'].tolist() == [0.0, -50.0, -150.0, 0.0]
+
+
+def test_breakdowns(history):
+    a = app.getanalytics(1)
+    bypair = a['bypair'].set_index('pair')
+    assert bypair.loc['XAUUSD', 'trades'] == 3 and bypair.loc['EURUSD', 'netprofit'] == 200.0
+    byweekday = a['byweekday'].set_index('weekday')
+    assert byweekday['trades'].to_dict() == {"Senin": 1, "Selasa": 1, "Rabu": 2}
+    assert byweekday.loc['Rabu', 'winrate'] == 0.5
+
+
+def test_no_trades(db):
+    sm = app.getanalytics(1)['summary']
+    assert sm['trades'] == 0 and sm['profitfactor'] is None and sm['maxdrawdownfrom'] is None
+
+
+def test_equity_curve_is_downsampled(db, monkeypatch):
+    monkeypatch.setattr(app, "EQUITYPOINTS", 10)
+    rows = [(1, "XAUUSD", "BUY", 0.1, 2300.0, 2310.0, None, None, "2024-05-01", f"10:{i // 60:02d}:{i % 60:02d}", None,
+             1.0, 16000.0, 0.1, "2024-05-01T10:00:00") for i in range(95)]
+    app.gettradewriter().submit(app.tradebulkinsertop, rows).result()
+    curve = app.getanalytics(1)['equity']
+    assert len(curve) <= 2 * app.EQUITYPOINTS
+    assert (curve['equity'].iloc[0], curve['equity'].iloc[-1]) == (1.0, 95.0)
+
+
+def test_cached_until_the_users_data_changes(history):
+    cache = app.getanalyticscache()
+    first = app.getanalytics(1)
+    assert app.getanalytics(1) is first
+    addtrade(10.0, "2024-05-01", userid=2)  # another user's write keeps user 1 cached
+    assert app.getanalytics(1) is first
+    addtrade(10.0, "2024-05-10")
+    second = app.getanalytics(1)
+    assert second is not first and second['summary']['trades'] == 5
+    # the superseded entry is dropped, not left to age out
+    assert sum(1 for key in cache.data if key[0] == 1) == 1
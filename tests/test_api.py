@@ -0,0 +1,187 @@
+import asyncio
+import io
+import socket
+import threading
+
+import pandas as pd
+import pytest
+
+import trading_api as api
+import trading_app_full as app
+
+
+@pytest.fixture
+def server(db):
+    """ApiServer on an ephemeral port, prices from a replay provider"""
+    prices = app.PriceService(providers=[app.ReplayProvider({"XAUUSD": [2350.0], "BTCUSD": [65000.0]})])
+    srv = api.ApiServer(priceservice=prices, workers=4)
+    loop = asyncio.new_event_loop()
+    host, port = loop.run_until_complete(srv.start("127.0.0.1", 0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    srv.url = f"http://{host}:{port}"
+    srv.loop = loop
+    yield srv
+    asyncio.run_coroutine_threadsafe(srv.close(), loop).result(10)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+    loop.close()
+
+
+@pytest.fixture
+def client(server):
+    app.adduser("bot", "botpw", "user")
+    c = api.ApiClient(server.url)
+    c.login("bot", "botpw")
+    yield c
+    c.close()
+
+
+def trade(**overrides):
+    item = {"pair": "XAUUSD", "type": "BUY", "lot": 0.1, "openprice": 2300.0, "closeprice": 2310.0,
+            "date": "2024-05-01", "time": "10:00:00"}
+    item.update(overrides)
+    return item
+
+
+def rawrequest(server, request):
+    host, port = server.url[len("http://"):].split(":")
+    with socket.create_connection((host, int(port)), timeout=5) as sock:
+        sock.sendall(request)
+        return sock.recv(4096).decode().split("\r\n")[0]
+
+
+def test_login_insert_and_history(client):
+    result = client.inserttrades([trade(), trade(pair="EURUSD", type="SELL", openprice=1.09, closeprice=1.08, lot=1)])
+    assert result["inserted"] == 2
+    page = client.trades(pagesize=10)
+    assert [t["id"] for t in page["trades"]] == sorted(result["ids"], reverse=True)
+    xau = next(t for t in page["trades"] if t["pair"] == "XAUUSD")
+    # same P&L rules as the Streamlit form
+    assert xau["profitusd"] == round(app.calculateprofitusd("XAUUSD", 2300.0, 2310.0, 0.1, "BUY"), 2)
+    assert xau["pips"] == round(app.calculatepips("XAUUSD", 2300.0, 2310.0), 4)
+    assert client.trades(pair="EURUSD")["trades"][0]["type"] == "SELL"
+
+
+def test_history_pages_with_afterid(client):
+    ids = client.inserttrades([trade(note=str(i)) for i in range(5)])["ids"]
+    first = client.trades(pagesize=3)
+    second = client.trades(pagesize=3, afterid=first["nextafterid"])
+    assert [t["id"] for t in first["trades"] + second["trades"]] == sorted(ids, reverse=True)
+    assert second["nextafterid"] is None
+
+
+def test_bulk_insert_updates_stats(client):
+    client.inserttrades([trade(closeprice=2310.0 if i % 2 else 2290.0) for i in range(api.APIBULKMIN + 8)])
+    stats = client.stats()
+    assert stats["total"]["tradecount"] == api.APIBULKMIN + 8
+    assert stats["total"]["wins"] == stats["total"]["losses"] == (api.APIBULKMIN + 8) // 2
+    assert [p["pair"] for p in stats["bypair"]] == ["XAUUSD"]
+
+
+def test_invalid_batch_inserts_nothing(client):
+    with pytest.raises(api.ApiError) as err:
+        client.inserttrades([trade(), trade(pair="NOPE"), trade(lot=0)])
+    assert err.value.status == 400
+    assert [d["index"] for d in err.value.details] == [1, 2]
+    assert client.trades()["trades"] == []
+
+
+def test_prices_come_from_the_injected_service(client):
+    assert client.prices(["XAUUSD"])["prices"]["XAUUSD"]["price"] == 2350.0
+
+
+def test_export_streams_the_filtered_trades(client):
+    client.inserttrades([trade(), trade(pair="EURUSD", openprice=1.09, closeprice=1.1, lot=1)])
+    buf = io.BytesIO()
+    assert client.export(buf, "csv", pair="XAUUSD") == len(buf.getvalue())
+    df = pd.read_csv(io.BytesIO(buf.getvalue()))
+    assert list(df.columns) == app.USEREXPORTCOLUMNS
+    assert df["pair"].tolist() == ["XAUUSD"]
+
+
+def test_auth_errors(server, client):
+    anonymous = api.ApiClient(server.url)
+    with pytest.raises(api.ApiError) as err:
+        anonymous.trades()
+    assert err.value.status == 401
+    with pytest.raises(api.ApiError) as err:
+        anonymous.login("bot", "wrong")
+    assert err.value.status == 401
+    assert anonymous.health()["status"] == "ok"
+
+
+def test_malformed_content_length_is_a_400(server):
+    for value in (b"abc", b"-1"):
+        line = rawrequest(server, b"POST /api/login HTTP/1.1\r\nContent-Length: " + value + b"\r\n\r\n")
+        assert line == "HTTP/1.1 400 Bad Request"
+
+
+def test_internal_errors_do_not_leak_details(server, client, capsys):
+    def broken(session, query):
+        raise app.sqlite3.OperationalError("no such table: ttrading_secret")
+    server.routes[("GET", "/api/stats")] = (broken, True)
+    with pytest.raises(api.ApiError) as err:
+        client.stats()
+    assert err.value.status == 500
+    assert "ttrading_secret" not in str(err.value)
+    assert "ttrading_secret" in capsys.readouterr().err
+
+
+def test_expired_tokens_are_purged_on_issue():
+    tokens = api.TokenStore(ttl=-1)
+    stale = [tokens.issue({'id': i, 'username': "u", 'role': "user"}) for i in range(3)]
+    assert tokens.lookup(stale[0]) is None
+    tokens.ttl = 60
+    tokens.nextpurge = 0
+    fresh = tokens.issue({'id': 9, 'username': "u", 'role': "user"})
+    assert list(tokens.tokens) == [fresh]
+
+
+def test_close_during_an_export_does_not_hang(server):
+    row = (1, "XAUUSD", "BUY", 0.1, 2300.0, 2310.0, None, None, "2024-05-01", "10:00:00", None,
+           10.0, 160000.0, 100.0, "2024-05-01T10:00:00")
+    app.gettradewriter().submit(app.tradebulkinsertop, [row] * 50000).result()
+    c = api.ApiClient(server.url)
+    c.login("admin", "admin123")
+    response = c.session.get(server.url + "/api/export", headers={'Authorization': f"Bearer {c.token}"}, stream=True)
+    next(response.iter_content(1024))  # export running, client not reading: the queue fills up
+    asyncio.run_coroutine_threadsafe(server.close(), server.loop).result(10)
+    response.close()
+    c.close()
+
+
+def test_deactivated_user_loses_api_access(server, client):
+    assert client.trades()["trades"] == []
+    user = app.getuserbyusername("bot")
+    app.setusersstatus([user['id']], "inactive")
+    with pytest.raises(api.ApiError) as err:
+        client.trades()
+    assert err.value.status == 403
+    # the token is revoked, not just refused while inactive
+    app.setusersstatus([user['id']], "active")
+    with pytest.raises(api.ApiError) as err:
+        client.trades()
+    assert err.value.status == 401
+
+
+def test_role_downgrade_applies_to_the_next_request(server, client):
+    client.inserttrades([trade()])
+    admin = api.ApiClient(server.url)
+    admin.login("admin", "admin123")
+    assert len(admin.trades(all=1)["trades"]) == 1
+    with app.getdb().transaction() as conn:
+        conn.execute("UPDATE tuser SET role='user' WHERE username='admin'")
+    assert admin.trades(all=1)["trades"] == []
+    admin.close()
+
+
+def test_malformed_stored_hash_is_a_401(server):
+    app.adduser("broken", "pw", "user")
+    user = app.getuserbyusername("broken")
+    app.updateuserpasswordhash(user['id'], "pbkdf2_sha256$oops")
+    c = api.ApiClient(server.url)
+    with pytest.raises(api.ApiError) as err:
+        c.login("broken", "pw")
+    assert err.value.status == 401
+    c.close()
@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+import trading_app_full as app
+from bench import datagen
+from bench.__main__ import buildcli
+
+
+@pytest.fixture
+def generated(tmp_path, monkeypatch):
+    """generate() into tmp_path; DBPATH, writers and pools are restored/closed afterwards"""
+    monkeypatch.setattr(app, "DBPATH", app.DBPATH)
+    paths = []
+
+    def make(name, **kwargs):
+        path = str(tmp_path / name)
+        paths.append(path)
+        return datagen.generate(path, **kwargs)
+
+    yield make
+    for path in paths:
+        app.gettradewriterfor(path).close()
+        app.getdbpool(path).closeall()
+
+
+def tradedump(path):
+    with app.getdbpool(path).read() as conn:
+        return [tuple(r) for r in conn.execute("SELECT userid, pair, type, lot, openprice, closeprice, date, time, "
+                                               "profitusd, profitidr, pips FROM ttrading ORDER BY id")]
+
+
+def test_generation_is_deterministic_and_skewed(generated):
+    generated("a.db", users=20, trades=3000, seed=7, chunksize=1000)
+    generated("b.db", users=20, trades=3000, seed=7, chunksize=1000)
+    a, b = tradedump(app.DBPATH.replace("b.db", "a.db")), tradedump(app.DBPATH)
+    assert a == b and len(a) == 3000
+    assert [r[6] + r[7] for r in a] == sorted(r[6] + r[7] for r in a)  # ids follow trade time
+    counts = {}
+    for r in a:
+        counts[r[0]] = counts.get(r[0], 0) + 1
+    assert max(counts, key=counts.get) == min(counts)  # the first generated user is the heaviest
+    for userid, pair, position, lot, openprice, closeprice, *_, profitusd, _, pips in a[:200]:
+        assert profitusd == round(app.calculateprofitusd(pair, openprice, closeprice, lot, position), 2)
+    assert app.checktradestats() == []
+
+
+def test_existing_database_needs_force(generated, tmp_path):
+    path = tmp_path / "e.db"
+    with app.sqlite3.connect(path) as conn:  # left by an earlier `python -m bench generate`
+        conn.execute("CREATE TABLE leftover (x)")
+    with pytest.raises(FileExistsError):
+        generated("e.db", users=2, trades=10)
+    assert generated("e.db", users=3, trades=20, force=True)['trades'] == 20
+    assert len(tradedump(str(path))) == 20
+    with app.getdbpool(str(path)).read() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='leftover'").fetchone()[0] == 0
+
+
+def test_run_and_compare(generated, tmp_path, capsys):
+    from bench.scenarios import runall
+    generated("d.db", users=10, trades=500)
+    report = runall(app.DBPATH, only=["gettradespage", "dashboard"], repeatscale=0.02)
+    assert set(report['scenarios']) == {"gettradespage.heavy", "gettradespage.cached", "dashboard.admin",
+                                        "dashboard.user"}
+    assert report['dataset']['trades'] == 500 and report['dataset']['users'] == 11
+    old, new = tmp_path / "old.json", tmp_path / "new.json"
+    old.write_text(json.dumps(report))
+    slower = json.loads(json.dumps(report))
+    slower['scenarios']["dashboard.user"]['medianms'] *= 2
+    new.write_text(json.dumps(slower))
+    args = buildcli().parse_args(["compare", str(old), str(new)])
+    assert args.func(args) == 1
+    assert "dashboard.user" in capsys.readouterr().out.split("REGRESSED")[0].splitlines()[-1]
+    args = buildcli().parse_args(["compare", str(old), str(old)])
+    assert args.func(args) == 0
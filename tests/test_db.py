@@ -0,0 +1,90 @@
+import sqlite3
+import threading
+
+import pytest
+
+import trading_app_full as app
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = app.DBPool(str(tmp_path / "pool.db"), size=2, timeout=0.2)
+    with pool.transaction() as conn:
+        conn.execute("CREATE TABLE t (v INTEGER)")
+    yield pool
+    pool.closeall()
+
+
+def count(pool):
+    with pool.read() as conn:
+        return conn.execute("SELECT COUNT(*) FROM t").fetchone()[0]
+
+
+def test_connections_are_tuned_and_reused(pool):
+    with pool.read() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == app.DBPRAGMAS["busy_timeout"]
+        first = conn
+    with pool.read() as conn:
+        assert conn is first
+    assert pool.created == 1
+
+
+def test_nested_helpers_join_the_outer_transaction(pool):
+    with pytest.raises(RuntimeError):
+        with pool.transaction() as outer:
+            outer.execute("INSERT INTO t VALUES (1)")
+            with pool.transaction() as inner:
+                assert inner is outer
+                inner.execute("INSERT INTO t VALUES (2)")
+            with pool.read() as conn:
+                assert conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 2
+            raise RuntimeError("roll it all back")
+    assert count(pool) == 0
+
+
+def test_transaction_commits(pool):
+    with pool.transaction() as conn:
+        conn.execute("INSERT INTO t VALUES (1)")
+    assert count(pool) == 1
+
+
+def test_a_left_open_transaction_is_rolled_back_on_release(pool):
+    with pool.read() as conn:
+        conn.execute("BEGIN")
+        conn.execute("INSERT INTO t VALUES (1)")
+    assert count(pool) == 0
+
+
+def test_exhausted_pool_times_out(pool):
+    held, release = threading.Event(), threading.Event()
+
+    def hold():
+        with pool.read():
+            held.set()
+            release.wait(5)
+
+    threads = [threading.Thread(target=hold) for _ in range(2)]
+    for t in threads:
+        t.start()
+    while pool.idle.qsize() or pool.created < 2:
+        held.wait(0.01)
+    try:
+        with pytest.raises(sqlite3.OperationalError, match="exhausted"):
+            with pool.read():
+                pass
+    finally:
+        release.set()
+        for t in threads:
+            t.join()
+    assert count(pool) == 0 and pool.created == 2
+
+
+def test_readers_run_next_to_an_open_write(pool):
+    with pool.transaction() as conn:
+        conn.execute("INSERT INTO t VALUES (1)")
+        seen = []
+        reader = threading.Thread(target=lambda: seen.append(count(pool)))
+        reader.start()
+        reader.join(5)
+    assert seen == [0] and count(pool) == 1
@@ -0,0 +1,68 @@
+import gzip
+import io
+
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+import trading_app_full as app
+
+
+@pytest.fixture
+def trades(db):
+    app.adduser("trader", "pw", "user")
+    uid = app.getuserbyusername("trader")['id']
+    rows = [(uid if i % 3 else 1, "XAUUSD" if i % 2 else "EURUSD", "BUY", 0.1, 2300.0, 2310.0 if i % 5 else None,
+             None, None, "2024-05-01", "10:00:00", f"note {i}" if i % 4 == 0 else None, 10.0, 160000.0, 100.0,
+             "2024-05-01T10:00:00") for i in range(50)]
+    app.gettradewriter().submit(app.tradebulkinsertop, rows).result()
+    return uid
+
+
+def expected(userid=None, allifadmin=False, **filters):
+    where, params = app.tradefiltersql(userid, allifadmin, **filters)
+    with app.getdb().read() as conn:
+        return [r[0] for r in conn.execute(f"SELECT t.id FROM ttrading t WHERE {' AND '.join(where) or '1'} "
+                                           f"ORDER BY t.id DESC", params)]
+
+
+@pytest.mark.parametrize("fmt", ["csv", "csv.gz", "parquet"])
+def test_every_format_round_trips_in_small_chunks(trades, tmp_path, fmt):
+    dest = tmp_path / f"out{app.EXPORTFORMATS[fmt]}"
+    progress = []
+    written = app.exporttrades(str(dest), fmt, userid=trades, chunksize=7, progress=progress.append)
+    assert written == len(expected(trades)) == progress[-1]
+    df = pd.read_parquet(dest) if fmt == "parquet" else pd.read_csv(dest, compression="infer")
+    assert list(df.columns) == app.EXPORTCOLUMNS
+    assert df['id'].tolist() == expected(trades)
+    assert set(df['username']) == {"trader"}
+    assert df['status'].value_counts().to_dict() == {"closed": written - df['closeprice'].isna().sum(),
+                                                     "open": df['closeprice'].isna().sum()}
+
+
+def test_filters_and_user_columns(trades):
+    buf = io.BytesIO()
+    app.exporttrades(buf, "csv", userid=None, allifadmin=True, columns=app.USEREXPORTCOLUMNS,
+                     pair="XAUUSD", status="closed")
+    df = pd.read_csv(io.BytesIO(buf.getvalue()))
+    assert list(df.columns) == app.USEREXPORTCOLUMNS
+    assert df['id'].tolist() == expected(allifadmin=True, pair="XAUUSD", status="closed")
+    assert not buf.closed
+
+
+def test_exportfile_hands_over_a_rewound_temp_file(trades):
+    with app.exportfile("csv.gz", userid=trades) as raw:
+        assert isinstance(raw, io.RawIOBase) and raw.tell() == 0
+        df = pd.read_csv(io.BytesIO(gzip.decompress(raw.read())))
+    assert df['id'].tolist() == expected(trades)
+
+
+def test_unknown_format(trades, tmp_path):
+    with pytest.raises(ValueError):
+        app.exporttrades(str(tmp_path / "x"), "xlsx", userid=trades)
+
+
+def test_parquet_is_written_in_row_groups(trades, tmp_path):
+    dest = str(tmp_path / "out.parquet")
+    app.exporttrades(dest, "parquet", userid=trades, chunksize=10)
+    assert pq.ParquetFile(dest).num_row_groups == -(-len(expected(trades)) // 10)
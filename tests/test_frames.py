@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+
+import trading_app_full as app
+
+
+def addtrade(userid=1, pair="EURUSD", position="BUY", openprice=1.08, closeprice=1.0800667, lot=0.01, time="10:00:00"):
+    pips = round(app.calculatepips(pair, openprice, closeprice), 4) if closeprice is not None else 0.0
+    profitusd = round(app.calculateprofitusd(pair, openprice, closeprice, lot, position), 2) if closeprice else 0.0
+    return app.inserttradedata({'userid': userid, 'pair': pair, 'type': position, 'lot': lot, 'openprice': openprice,
+                                'closeprice': closeprice, 'date': "2024-05-01", 'time': time, 'profitusd': profitusd,
+                                'profitidr': profitusd * 16000, 'pips': pips})
+
+
+def test_frame_types_and_values(db):
+    app.adduser("trader", "pw", "user")
+    uid = app.getuserbyusername("trader")['id']
+    addtrade(uid)
+    addtrade(uid, pair="XAUUSD", position="SELL", openprice=2300.0, closeprice=None, lot=0.1, time="11:00:00")
+    df = app.loadtradesframe(uid, columns=app.TRADEFRAMEDEFAULT + ['status'])
+    assert df['username'].tolist() == ["trader", "trader"]
+    assert isinstance(df['pair'].dtype, pd.CategoricalDtype) and df['pair'].tolist() == ["EURUSD", "XAUUSD"]
+    assert df['type'].tolist() == ["BUY", "SELL"] and df['status'].tolist() == ["closed", "open"]
+    assert df['tradeat'].iloc[0] == pd.Timestamp("2024-05-01 10:00:00")
+    assert np.isnan(df['closeprice'].iloc[1])
+    assert app.loadtradesframe(uid, status='open')['id'].tolist() == [df['id'].iloc[1]]
+
+
+def test_fx_pips_and_lots_keep_full_precision(db):
+    for _ in range(3):
+        addtrade(pair="USDJPY", openprice=150.0, closeprice=156.67)
+    df = app.loadtradesframe(1, columns=['lot', 'pips', 'profitusd'])
+    assert df['pips'].dtype == df['lot'].dtype == np.float64
+    assert df['pips'].tolist() == [0.0667] * 3 and df['lot'].tolist() == [0.01] * 3
+    # the analytics average is the stored value, not a float32 approximation of it
+    assert app.getanalytics(1)['summary']['avgpips'] == np.mean([0.0667] * 3)
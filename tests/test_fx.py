@@ -0,0 +1,70 @@
+import numpy as np
+
+import trading_app_full as app
+
+
+def trade(date, profitusd=10.0, closeprice=2310.0):
+    return {'userid': 1, 'pair': "XAUUSD", 'type': "BUY", 'lot': 0.01, 'openprice': 2300.0, 'closeprice': closeprice,
+            'date': date, 'time': "10:00:00", 'profitusd': profitusd, 'profitidr': profitusd * 16500, 'pips': 0.1}
+
+
+def test_rates_are_as_of_the_date(db, tmp_path):
+    ratefile = tmp_path / "rates.csv"
+    ratefile.write_text("Date;USDIDR\n2024-05-01;15,900\n2024-05-03;16,100\nbad;1\n2024-05-04;-5\n")
+    assert app.upsertfxrates(app.loadfxrates(str(ratefile)), "file") == 2
+    cache = app.getfxratecache()
+    cache.autorefresh = False
+    got = cache.ratesfor(["2024-04-30", "2024-05-01", "2024-05-02", "2024-05-03", "2024-12-31"])
+    assert np.isnan(got[0]) and list(got[1:]) == [15900.0, 15900.0, 16100.0, 16100.0]
+    assert app.getusdtoidr("2024-05-02T08:00:00") == 15900.0
+    assert app.getusdtoidr("2024-04-30") is None
+
+
+def test_upsert_invalidates_the_memory_copy(db):
+    cache = app.getfxratecache()
+    cache.autorefresh = False
+    app.upsertfxrates([("2024-05-01", 15900)])
+    assert app.getusdtoidr("2024-05-01") == 15900.0
+    misses = cache.stats()['misses']
+    assert app.getusdtoidr("2024-05-01") == 15900.0 and cache.stats()['misses'] == misses  # served from memory
+    app.upsertfxrates([("2024-05-01", 15950)], "api")
+    assert app.getusdtoidr("2024-05-01") == 15950.0
+    assert cache.stats()['misses'] == misses + 1
+
+
+def test_stale_rates_refresh_in_the_background(db, monkeypatch):
+    calls = []
+    monkeypatch.setattr(app, "fetchfxrates", lambda datefrom=None, dateto=None: calls.append(datefrom) or [])
+    app.upsertfxrates([("2024-05-01", 15900)])
+    cache = app.getfxratecache()
+    assert cache.rate() == 15900.0  # answered at once from the stored rate
+    cache.rate()
+    for thread in [t for t in app.threading.enumerate() if t.name == "fxrefresh"]:
+        thread.join(5)
+    assert calls == ["2024-05-01"]  # once per FXREFRESHINTERVAL
+
+
+def test_revalue_reprices_closed_trades(db):
+    app.getfxratecache().autorefresh = False
+    app.upsertfxrates([("2024-05-01", 15000), ("2024-05-10", 16000)])
+    early = app.inserttradedata(trade("2024-05-05"))
+    late = app.inserttradedata(trade("2024-05-12", profitusd=-2.5))
+    before = app.inserttradedata(trade("2024-04-01"))  # no rate yet: left alone
+    openid = app.openposition(trade("2024-05-05", profitusd=0.0, closeprice=None))
+    version = app.getdataversion(1)
+    assert app.revaluetrades() == 2
+    profit = {r['id']: r['profitidr'] for r in app.gettradesforuser(1)}
+    assert profit == {early: 150000.0, late: -40000.0, before: 165000.0, openid: 0.0}
+    assert app.getdataversion(1) > version
+    assert app.checktradestats() == []
+    assert app.revaluetrades() == 0  # already at the right value
+
+
+def test_revalue_respects_the_date_range(db):
+    app.getfxratecache().autorefresh = False
+    app.upsertfxrates([("2024-05-01", 15000)])
+    inside = app.inserttradedata(trade("2024-05-05"))
+    outside = app.inserttradedata(trade("2024-06-05"))
+    assert app.revaluetrades("2024-05-01", "2024-05-31") == 1
+    profit = {r['id']: r['profitidr'] for r in app.gettradesforuser(1)}
+    assert profit == {inside: 150000.0, outside: 165000.0}
@@ -0,0 +1,57 @@
+import trading_app_full as app
+
+
+def addtrades(userid, n, **overrides):
+    rows = []
+    for i in range(n):
+        data = {'pair': "XAUUSD" if i % 2 else "EURUSD", 'type': "BUY" if i % 3 else "SELL",
+                'date': f"2024-05-{1 + i % 28:02d}", 'closeprice': 2310.0}
+        data.update(overrides)
+        rows.append((userid, data['pair'], data['type'], 0.1, 2300.0, data['closeprice'], None, None, data['date'],
+                     "10:00:00", None, 10.0, 160000.0, 100.0, "2024-05-01T10:00:00"))
+    app.gettradewriter().submit(app.tradebulkinsertop, rows).result()
+
+
+def allpages(userid, pagesize, **filters):
+    ids, afterid, pages = [], None, 0
+    while True:
+        rows, afterid = app.gettradespage(userid, afterid=afterid, pagesize=pagesize, **filters)
+        ids += [r['id'] for r in rows]
+        pages += 1
+        if afterid is None:
+            return ids, pages
+
+
+def test_keyset_pages_walk_the_history_newest_first(db):
+    addtrades(1, 23)
+    addtrades(2, 5)
+    ids, pages = allpages(1, 5)
+    with app.getdb().read() as conn:
+        expected = [r[0] for r in conn.execute("SELECT id FROM ttrading WHERE userid=1 ORDER BY id DESC")]
+    assert ids == expected and pages == 5
+    # an exact multiple of the page size ends without an empty extra page
+    assert allpages(2, 5)[1] == 1
+
+
+def test_filters_narrow_every_page(db):
+    addtrades(1, 30)
+    addtrades(1, 4, closeprice=None)
+    with app.getdb().read() as conn:
+        def where(sql):
+            return [r[0] for r in conn.execute(f"SELECT id FROM ttrading WHERE userid=1 AND {sql} ORDER BY id DESC")]
+        assert allpages(1, 4, pair="XAUUSD")[0] == where("pair='XAUUSD'")
+        assert allpages(1, 4, position="SELL", datefrom="2024-05-03", dateto="2024-05-20")[0] \
+            == where("type='SELL' AND date BETWEEN '2024-05-03' AND '2024-05-20'")
+        assert allpages(1, 4, status="open")[0] == where("closeprice IS NULL")
+    assert len(allpages(None, 10, allifadmin=True)[0]) == 34
+
+
+def test_history_query_uses_the_user_index(db):
+    addtrades(1, 10)
+    where, params = app.tradefiltersql(1)
+    sql = (f"SELECT t.*, u.username FROM ttrading t JOIN tuser u ON t.userid=u.id WHERE {' AND '.join(where)} "
+           f"AND t.id<? ORDER BY t.id DESC LIMIT ?")
+    with app.getdb().read() as conn:
+        plan = " ".join(r[-1] for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params + [100, 11]))
+    assert "idxttradinguserid" in plan
+    assert "TEMP B-TREE" not in plan
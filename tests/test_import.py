@@ -0,0 +1,77 @@
+import io
+
+import trading_app_full as app
+
+
+def stored(userid=1):
+    with app.getdb().read() as conn:
+        return conn.execute("SELECT pair, type, lot, openprice, closeprice, date, time, note, profitusd, pips "
+                            "FROM ttrading WHERE userid=? ORDER BY id", (userid,)).fetchall()
+
+
+def test_broker_statement_with_aliases_and_line_numbered_errors(db, tmp_path):
+    path = tmp_path / "statement.csv"
+    path.write_text(
+        "Time;Type;Size;Symbol;Price;Time;Price;Comment\n"
+        "2024.05.01 10:00;buy;0.10;XAUUSDm;2300;2024.05.01 11:00;2310;\"first\n"
+        "line two\"\n"
+        "2024.05.02 09:00;short;1;EURUSD.a;1.0800;2024.05.02 10:00;1.0750;\n"
+        "2024.05.03 09:00;buy;1;DOGE;1;2024.05.03 10:00;2;\n"
+        "2024.05.04 09:00;buy;0;GOLD;2300;2024.05.04 10:00;2310;\n"
+        "2024.05.05 09:00;buy;1;GOLD;2300;2024.05.05 10:00;2310;x;extra\n"
+        "2024.05.06 09:00;sell;0.5;NAS100;18000;2024.05.06 10:00;17990;NA\n")
+    result = app.importtrades(str(path), 1)
+    assert (result['rows'], result['imported'], result['failed']) == (6, 3, 3)
+    assert result['errors'] == [(5, "unknown pair ('DOGE')"), (6, "lot must be > 0 ('0')"),
+                                (7, "expected 8 fields, got 9")]
+    rows = [tuple(r) for r in stored()]
+    assert [r[:7] for r in rows] == [
+        ("XAUUSD", "BUY", 0.1, 2300.0, 2310.0, "2024-05-01", "10:00:00"),
+        ("EURUSD", "SELL", 1.0, 1.08, 1.075, "2024-05-02", "09:00:00"),
+        ("USTEC", "SELL", 0.5, 18000.0, 17990.0, "2024-05-06", "09:00:00")]
+    assert rows[0][7] == "first\nline two" and rows[2][7] is None
+    for pair, position, lot, openprice, closeprice, *_, profitusd, pips in rows:
+        assert profitusd == round(app.calculateprofitusd(pair, openprice, closeprice, lot, position), 2)
+        assert pips == round(app.calculatepips(pair, openprice, closeprice), 4)
+    assert app.checktradestats() == []
+
+
+def csvfile(n, badevery=0):
+    lines = ["pair,type,lot,openprice,closeprice,date,time"]
+    for i in range(n):
+        pair = "NOPE" if badevery and i % badevery == 0 else "XAUUSD"
+        lines.append(f"{pair},BUY,0.1,2300,2310,2024-05-01,10:00:00")
+    return io.BytesIO(("\n".join(lines) + "\n").encode())
+
+
+def test_chunks_from_a_binary_file_object(db):
+    source = csvfile(25, badevery=10)
+    progress = []
+    result = app.importtrades(source, 1, chunksize=7, progress=lambda *a: progress.append(a))
+    assert (result['rows'], result['imported'], result['failed']) == (25, 22, 3)
+    assert [line for line, _ in result['errors']] == [2, 12, 22]
+    assert progress[-1] == (25, 22, 3)
+    assert not source.closed
+    assert len(stored()) == 22
+
+
+def test_dry_run_writes_nothing(db):
+    result = app.importtrades(csvfile(5), 1, dryrun=True)
+    assert result['imported'] == 5 and stored() == []
+
+
+def test_rejected_chunk_is_reported_and_the_rest_imported(db, monkeypatch):
+    bulkinsert = app.tradebulkinsertop
+    calls = []
+
+    def failsecond(conn, params):
+        calls.append(len(params))
+        if len(calls) == 2:
+            raise app.sqlite3.IntegrityError("disk says no")
+        return bulkinsert(conn, params)
+
+    monkeypatch.setattr(app, "tradebulkinsertop", failsecond)
+    result = app.importtrades(csvfile(12), 1, chunksize=5)
+    assert (result['imported'], result['failed']) == (7, 5)
+    assert result['errors'] == [(7, "lines 7-11 not imported: disk says no")]
+    assert len(stored()) == 7
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+import trading_app_full as app
+
+
+def test_timed_records_calls_rows_and_errors():
+    registry = app.getmetrics()
+
+    @app.timed("test.sometimesfails")
+    def sometimesfails(n):
+        if n < 0:
+            raise ValueError(n)
+        if n == 0:
+            raise KeyboardInterrupt  # stands in for st.rerun(): control flow, not an error
+        return list(range(n))
+
+    sometimesfails(3)
+    sometimesfails(4)
+    with pytest.raises(ValueError):
+        sometimesfails(-1)
+    with pytest.raises(KeyboardInterrupt):
+        sometimesfails(0)
+    t = registry.snapshot()['timers']["test.sometimesfails"]
+    assert (t['count'], t['rows'], t['errors']) == (4, 7, 1)
+    assert sum(t['buckets']) == 4 and t['maxms'] >= t['p50ms'] >= 0
+
+
+def test_percentiles_interpolate_inside_buckets():
+    registry = app.Metrics()
+    for ms in [0.05] * 90 + [3.0] * 8 + [40.0] * 2:
+        registry.record("q", ms / 1000)
+    t = registry.snapshot()['timers']["q"]
+    assert t['p50ms'] <= 0.1
+    assert 2.5 < t['p95ms'] <= 5
+    assert 25 < t['p99ms'] <= 40 and t['maxms'] == pytest.approx(40.0)
+
+
+def test_cache_collectors_and_exports(tmp_path):
+    registry = app.Metrics()
+    registry.record("db.read", 0.002, rows=5)
+    cache = app.LRUCache(4)
+    registry.register("lru", cache.stats)
+    cache.put("a", 1)
+    cache.get("a")
+    cache.get("b")
+    snap = registry.snapshot()
+    assert snap['caches']["lru"] == {'hits': 1, 'misses': 1, 'hitratio': 0.5}
+    text = registry.prometheus()
+    assert 'tradingapp_call_duration_ms_count{fn="db.read"} 1' in text
+    assert 'tradingapp_call_duration_ms_bucket{fn="db.read",le="+Inf"} 1' in text
+    assert 'tradingapp_call_rows_total{fn="db.read"} 5' in text
+    assert 'tradingapp_cache_lookups_total{cache="lru",result="hit"} 1' in text
+    registry.dump(str(tmp_path / "metrics.json"))
+    assert json.loads((tmp_path / "metrics.json").read_text())['timers']["db.read"]['rows'] == 5
+    registry.dump(str(tmp_path / "metrics.prom"))
+    assert (tmp_path / "metrics.prom").read_text() == text
+    registry.reset()
+    assert registry.snapshot()['timers'] == {}
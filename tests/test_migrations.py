@@ -0,0 +1,70 @@
+import sqlite3
+
+import pytest
+
+import trading_app_full as app
+
+
+def userversion(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def test_fresh_database_is_fully_migrated_and_seeded_once(db):
+    assert app.initdb() == len(app.MIGRATIONS)
+    with app.getdb().read() as conn:
+        assert userversion(conn) == len(app.MIGRATIONS)
+        assert conn.execute("SELECT COUNT(*) FROM tuser WHERE role='admin'").fetchone()[0] == 1
+    assert app.getsetting('storestatus') == "open"
+
+
+def test_legacy_database_is_upgraded_in_place(tmp_path):
+    """A database written by the pre-migration app: base tables, rows, user_version 0"""
+    conn = app.getdbconnection(str(tmp_path / "legacy.db"))
+    app.migrate001basetables(conn.cursor())
+    conn.execute("INSERT INTO tuser(username,passwordhash,role,status,createdat) VALUES ('old','x','user','active','')")
+    conn.executemany("INSERT INTO ttrading(userid,pair,type,lot,openprice,closeprice,date,time,profitusd,profitidr,pips,"
+                     "createdat) VALUES (1,?,?,0.1,2300,2310,'2024-05-01','10:00:00',?,0,1,'')",
+                     [("XAUUSD", "BUY", 100.0), ("XAUUSD", "SELL", -100.0), ("GBPUSD", "BUY", 5.0)])
+    assert userversion(conn) == 0
+    assert app.migratedb(conn) == len(app.MIGRATIONS)
+    rows = conn.execute("SELECT pair, paircode, isbuy, tradeat FROM ttrading ORDER BY id").fetchall()
+    assert [tuple(r) for r in rows[:2]] == [("XAUUSD", 0, 1, 1714557600), ("XAUUSD", 0, 0, 1714557600)]
+    assert rows[2]['paircode'] >= len(app.PAIROPTIONS)  # unknown pair gets a code of its own
+    stats = conn.execute("SELECT tradecount, profitusd, wins, losses FROM tuserstats WHERE userid=1").fetchone()
+    assert tuple(stats) == (3, 5.0, 2, 1)
+    # running it again is a no-op
+    assert app.migratedb(conn) == len(app.MIGRATIONS)
+    conn.close()
+
+
+def test_failed_step_rolls_back_and_keeps_the_version(db, monkeypatch):
+    def broken(c):
+        c.execute("CREATE TABLE tnew (x)")
+        raise sqlite3.OperationalError("boom")
+
+    monkeypatch.setattr(app, "MIGRATIONS", app.MIGRATIONS + [broken])
+    with app.getdb().connection() as conn:
+        with pytest.raises(sqlite3.OperationalError):
+            app.migratedb(conn)
+        assert userversion(conn) == len(app.MIGRATIONS) - 1
+        assert conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='tnew'").fetchone()[0] == 0
+
+
+def test_settings_are_cached_and_written_through(db):
+    cache = app.getsettingscache()
+    app.getsetting('storestatus')
+    misses = cache.stats()['misses']
+    for _ in range(5):
+        assert app.getsetting('storestatus') == "open"
+    assert cache.stats()['misses'] == misses
+    app.setsetting('storestatus', "close")
+    assert app.getsetting('storestatus') == "close"
+    assert cache.stats()['misses'] == misses + 1
+
+
+def test_settings_written_elsewhere_show_up_after_the_ttl(db):
+    cache = app.SettingsCache(ttl=0)
+    assert cache.get('storestatus') == "open"
+    with app.getdb().transaction() as conn:  # another process writing the table directly
+        conn.execute("UPDATE tsettings SET value='close' WHERE key='storestatus'")
+    assert cache.get('storestatus') == "close"
@@ -0,0 +1,88 @@
+import itertools
+
+import numpy as np
+import pytest
+
+import trading_app_full as app
+
+PRICES = {"XAUUSD": (2300.0, 2311.37), "BTCUSD": (65000.0, 64123.5), "ETHUSD": (3200.0, 3255.25),
+          "USTEC": (18000.0, 17950.75), "USOIL": (78.4, 79.13), "EURUSD": (1.0812, 1.07985),
+          "USDJPY": (151.3, 151.872), "GBPUSD": (1.25, 1.2611)}  # GBPUSD: outside PAIROPTIONS, fallback rules
+
+
+def grid():
+    """Every pair (plus an unknown one and a lowercase spelling) x BUY/SELL x both price moves x a few lots"""
+    rows = []
+    for pair, position, flip, lot in itertools.product(PRICES, ("BUY", "SELL"), (False, True), (0.01, 0.1, 1.5)):
+        openprice, closeprice = PRICES[pair][::-1] if flip else PRICES[pair]
+        rows.append((pair.lower() if lot == 1.5 else pair, position, lot, openprice, closeprice))
+    return rows
+
+
+def test_vectorized_matches_scalar_for_every_pair_and_direction():
+    rows = grid()
+    pairs, positions, lots, opens, closes = (list(c) for c in zip(*rows))
+    pips, profitusd = app.calculatetradesvec(pairs, positions, lots, opens, closes)
+    assert pips.tolist() == [app.calculatepips(p, o, c) for p, _, _, o, c in rows]
+    assert profitusd.tolist() == [app.calculateprofitusd(p, o, c, lot, pos) for p, pos, lot, o, c in rows]
+    assert (profitusd[np.array(positions) == "SELL"] != 0).all()
+
+
+def test_open_positions_have_no_vectorized_pnl():
+    pips, profitusd = app.calculatetradesvec(["XAUUSD", "EURUSD"], ["BUY", "SELL"], [0.1, 1.0],
+                                             [2300.0, 1.08], [None, 1.09])
+    assert np.isnan(pips[0]) and np.isnan(profitusd[0])
+    assert profitusd[1] == app.calculateprofitusd("EURUSD", 1.08, 1.09, 1.0, "SELL")
+
+
+def storedtrade(pair, position, lot, openprice, closeprice):
+    data = {'userid': 1, 'pair': pair.upper(), 'type': position, 'lot': lot, 'openprice': openprice,
+            'closeprice': closeprice, 'date': "2024-05-01", 'time': "10:00:00", 'profitusd': 0.0,
+            'profitidr': 0.0, 'pips': 0.0}
+    if closeprice is not None:
+        profitusd = app.calculateprofitusd(pair, openprice, closeprice, lot, position)
+        data.update(profitusd=round(profitusd, 2), profitidr=round(profitusd * 16000, 0),
+                    pips=round(app.calculatepips(pair, openprice, closeprice), 4))
+    return app.inserttradedata(data)
+
+
+def test_recalculation_keeps_scalar_values_and_skips_open_positions(db):
+    for row in grid():
+        if row[0].upper() in app.PAIROPTIONS:
+            storedtrade(*row)
+    openid = storedtrade("XAUUSD", "SELL", 0.1, 2300.0, None)
+    assert app.recalculatetrades(chunksize=7) == (len(app.PAIROPTIONS) * 12, 0)
+    with app.getdb().read() as conn:
+        assert tuple(conn.execute("SELECT closeprice, profitusd, pips FROM ttrading WHERE id=?", (openid,)).fetchone()) \
+            == (None, 0.0, 0.0)
+    # a row stored with wrong figures is brought back to the scalar result
+    badid = storedtrade("EURUSD", "SELL", 1.0, 1.0812, 1.07985)
+    with app.getdb().transaction() as conn:
+        conn.execute("UPDATE ttrading SET profitusd=0, pips=0 WHERE id=?", (badid,))
+    assert app.recalculatetrades()[1] == 1
+    with app.getdb().read() as conn:
+        row = conn.execute("SELECT profitusd, pips FROM ttrading WHERE id=?", (badid,)).fetchone()
+    assert row['profitusd'] == round(app.calculateprofitusd("EURUSD", 1.0812, 1.07985, 1.0, "SELL"), 2)
+    assert row['pips'] == round(app.calculatepips("EURUSD", 1.0812, 1.07985), 4)
+
+
+def test_mark_to_market_matches_closing_at_the_live_price(db):
+    live = {pair: close for pair, (_, close) in PRICES.items()}
+    for pair, (openprice, _) in PRICES.items():
+        if pair in app.PAIROPTIONS:
+            for position in ("BUY", "SELL"):
+                app.openposition({'userid': 1, 'pair': pair, 'type': position, 'lot': 0.1, 'openprice': openprice,
+                                  'date': "2024-05-01", 'time': "10:00:00"})
+    frame = app.MarkToMarket(pricefn=lambda pair: live.get(pair)).mark()
+    assert len(frame) == len(app.PAIROPTIONS) * 2
+    for r in frame.itertuples():
+        assert r.profitusd == round(app.calculateprofitusd(r.pair, r.openprice, live[r.pair], r.lot, r.type), 2)
+        assert r.pips == pytest.approx(round(app.calculatepips(r.pair, r.openprice, live[r.pair]), 4), abs=1e-12)
+
+
+def test_roundvec_matches_round():
+    rng = np.random.default_rng(7)
+    values = np.concatenate([rng.integers(-10 ** 7, 10 ** 7, 20000) / 1000, rng.normal(0, 1e4, 20000), [5.525, np.nan]])
+    for ndigits in (0, 2, 4):
+        expected = [round(v, ndigits) for v in values.tolist()]
+        np.testing.assert_array_equal(app.roundvec(values, ndigits), expected)
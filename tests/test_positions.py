@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+import trading_app_full as app
+
+
+@pytest.fixture
+def prices(db, monkeypatch):
+    """Latest price per pair for a MarkToMarket engine; USD/IDR fixed at 16000"""
+    app.getfxratecache().autorefresh = False
+    app.upsertfxrates([("2024-01-01", 16000)])
+    return {"XAUUSD": 2310.0, "EURUSD": 1.09}
+
+
+def position(userid=1, pair="XAUUSD", position="BUY", openprice=2300.0, lot=0.1):
+    return {'userid': userid, 'pair': pair, 'type': position, 'lot': lot, 'openprice': openprice,
+            'date': "2024-05-01", 'time': "10:00:00"}
+
+
+def test_mark_values_open_positions_at_the_latest_price(prices):
+    engine = app.MarkToMarket(pricefn=prices.get)
+    gold = app.openposition(position())
+    euro = app.openposition(position(userid=2, pair="EURUSD", position="SELL", openprice=1.08, lot=1))
+    usdjpy = app.openposition(position(pair="USDJPY", openprice=151.0))  # no price known
+    frame = engine.mark().set_index('id')
+    assert frame.loc[gold, 'profitusd'] == 100.0 and frame.loc[gold, 'profitidr'] == 1600000.0
+    assert frame.loc[gold, 'pips'] == round(app.calculatepips("XAUUSD", 2300.0, 2310.0), 4)
+    assert frame.loc[euro, 'profitusd'] == round(app.calculateprofitusd("EURUSD", 1.08, 1.09, 1, "SELL"), 2)
+    assert np.isnan(frame.loc[usdjpy, 'price'])
+    assert list(engine.foruser(2)['id']) == [euro]
+    assert list(engine.foruser(3)['id']) == []
+
+
+def test_idle_reruns_reuse_the_last_result(prices):
+    engine = app.MarkToMarket(pricefn=prices.get)
+    app.openposition(position())
+    first = engine.mark()
+    assert engine.mark() is first
+    assert engine.stats() == {'hits': 1, 'misses': 1, 'reloads': 1, 'positions': 1}
+    prices["XAUUSD"] = 2320.0  # new tick: recompute, no reload
+    assert engine.mark()['profitusd'].tolist() == [200.0]
+    assert engine.stats()['reloads'] == 1 and engine.stats()['misses'] == 2
+    app.inserttradedata(dict(position(), closeprice=2305.0, profitusd=50.0, profitidr=800000.0, pips=0.05))
+    engine.mark()
+    assert engine.stats()['reloads'] == 1  # a closed trade does not touch the open set
+
+
+def test_open_close_delete_reload_the_open_set(prices):
+    engine = app.MarkToMarket(pricefn=prices.get)
+    first = app.openposition(position())
+    second = app.openposition(position(openprice=2290.0))
+    assert list(engine.mark()['id']) == [first, second]
+    assert app.closeposition(first, 2315.0)
+    assert list(engine.mark()['id']) == [second]
+    app.deletetrade(second)
+    assert engine.mark().empty
+    assert engine.stats()['reloads'] == 3
+
+
+def test_close_is_realized_once(prices):
+    tradeid = app.openposition(position())
+    assert not app.closeposition(tradeid, 2315.0, userid=2)  # not the user's
+    assert app.closeposition(tradeid, 2315.0, userid=1)
+    assert not app.closeposition(tradeid, 2400.0)  # second close (other tab) is a no-op
+    row = next(r for r in app.gettradesforuser(1) if r['id'] == tradeid)
+    assert (row['closeprice'], row['profitusd'], row['profitidr']) == (2315.0, 150.0, 2400000.0)
+    assert app.checktradestats() == []
+
+
+def test_openpositions_uses_the_shared_engine(prices, monkeypatch):
+    engine = app.getmarktomarket()
+    monkeypatch.setattr(engine, "pricefn", prices.get)
+    tradeid = app.openposition(position(userid=3))
+    assert list(app.openpositions(3)['id']) == [tradeid]
+    assert app.openpositions(1).empty
+    assert engine.stats()['hits'] == 1
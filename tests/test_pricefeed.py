@@ -0,0 +1,74 @@
+import time
+
+import numpy as np
+
+import trading_app_full as app
+
+
+def replayservice(ticks, size=app.TICKBUFFERSIZE, loop=False):
+    return app.PriceService(providers=[app.ReplayProvider(ticks, loop=loop)], store=app.TickStore(size=size))
+
+
+def test_replay_drives_the_feed_one_step_per_poll():
+    service = replayservice({"XAUUSD": [2300.0, 2301.5, 2299.0], "BTCUSD": [65000.0, 65100.0]})
+    feed = app.PriceFeed(service, interval=60)
+    for _ in range(3):
+        feed.pollonce()
+    assert feed.polls == 3
+    assert feed.store.latest("XAUUSD")[0] == 2299.0
+    ts, px = feed.store.last("XAUUSD", 10)
+    assert px.tolist() == [2300.0, 2301.5, 2299.0]
+    assert np.all(np.diff(ts) >= 0)
+    # BTCUSD ran out after two ticks: the last one repeats
+    assert feed.store.last("BTCUSD", 10)[1].tolist() == [65000.0, 65100.0, 65100.0]
+
+
+def test_ring_buffer_keeps_only_the_newest_ticks():
+    service = replayservice({"EURUSD": [1.0 + i / 100 for i in range(10)]}, size=4)
+    feed = app.PriceFeed(service, interval=60)
+    for _ in range(10):
+        feed.pollonce()
+    ring = feed.store.ring("EURUSD")
+    assert ring.count == 10
+    assert feed.store.last("EURUSD", 100)[1].tolist() == [1.06, 1.07, 1.08, 1.09]
+    assert feed.store.lastframe("EURUSD", 2)['price'].tolist() == [1.08, 1.09]
+
+
+def test_looping_replay_wraps_around():
+    service = replayservice({"USDJPY": [150.0, 151.0]}, loop=True)
+    feed = app.PriceFeed(service, interval=60)
+    for _ in range(5):
+        feed.pollonce()
+    assert feed.store.last("USDJPY", 5)[1].tolist() == [150.0, 151.0, 150.0, 151.0, 150.0]
+
+
+def test_replay_from_csv(tmp_path):
+    path = tmp_path / "ticks.csv"
+    path.write_text("pair,price\nxauusd,2300\nETHUSD,3200\nxauusd,2310\n")
+    service = replayservice(str(path))
+    feed = app.PriceFeed(service, interval=60)
+    feed.pollonce()
+    feed.pollonce()
+    assert feed.store.snapshot()["XAUUSD"][0] == 2310.0
+    assert feed.store.latest("ETHUSD")[0] == 3200.0
+
+
+def test_daemon_thread_polls_on_schedule_and_stops():
+    service = replayservice({"XAUUSD": list(np.linspace(2300, 2400, 50))})
+    feed = app.PriceFeed(service, interval=0.01).start()
+    try:
+        deadline = time.monotonic() + 5
+        while feed.polls < 5 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        feed.stop()
+    assert feed.polls >= 5
+    assert not feed.thread.is_alive()
+    assert feed.store.ring("XAUUSD").count == feed.polls
+
+
+def test_getmarketpriceapi_reads_the_shared_tick_store(monkeypatch):
+    service = replayservice({"XAUUSD": [2345.6]})
+    app.PriceFeed(service, interval=60).pollonce()
+    monkeypatch.setattr(app, "gettickstore", lambda: service.store)
+    assert app.getmarketpriceapi("xauusd") == 2345.6
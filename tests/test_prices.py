@@ -0,0 +1,66 @@
+import time
+
+import pytest
+
+import trading_app_full as app
+
+
+def localproviders(upstream):
+    return [app.BinanceProvider(upstream.url), app.FMPProvider(upstream.url), app.TwelveDataProvider(upstream.url)]
+
+
+def test_cold_getall_batches_one_request_per_provider(upstream):
+    service = app.PriceService(providers=localproviders(upstream))
+    prices = service.getall()
+    assert prices == {"BTCUSD": 65000.5, "ETHUSD": 3200.25, "XAUUSD": 2350.1, "USOIL": 78.4,
+                      "USTEC": 18000.0, "EURUSD": 1.0812, "USDJPY": 151.3}
+    assert len(upstream.requests) == 3
+    assert upstream.count("/api/v3/quote/XAUUSD,WTIUSD,NDX") == 1
+    assert dict(upstream.requests)["/price"]["symbol"] == "EURUSD,USDJPY"
+
+
+def test_fresh_prices_come_from_cache(upstream):
+    service = app.PriceService(providers=localproviders(upstream), ttl=60)
+    service.getall()
+    upstream.prices["BTCUSDT"] = 1.0
+    assert service.get("btcusd") == 65000.5
+    assert len(upstream.requests) == 3
+    assert service.stats()["hits"] == 1
+
+
+def test_stale_price_is_served_while_refreshing(upstream):
+    service = app.PriceService(providers=localproviders(upstream), ttl=0)
+    service.getall()
+    upstream.prices["BTCUSDT"] = 70000.0
+    upstream.delay = 0.5
+    started = time.monotonic()
+    assert service.get("BTCUSD") == 65000.5
+    assert time.monotonic() - started < 0.25
+    for fut in service.refresh(["BTCUSD"]).values():
+        fut.result(timeout=5)
+    assert service.peek("BTCUSD")[0] == 70000.0
+    assert upstream.count("/api/v3/ticker/price") == 2
+
+
+def test_failing_provider_does_not_block_the_others(upstream):
+    upstream.failing.add("/api/v3/ticker/price")
+    service = app.PriceService(providers=localproviders(upstream))
+    prices = service.getall()
+    assert prices["BTCUSD"] is None and prices["ETHUSD"] is None
+    assert prices["XAUUSD"] == 2350.1 and prices["EURUSD"] == 1.0812
+    assert service.stats()["errors"] == 1
+
+
+def test_single_symbol_twelvedata_response(upstream):
+    provider = app.TwelveDataProvider(upstream.url)
+    service = app.PriceService(providers=[provider])
+    assert provider.fetch(service.session, ["USDJPY"]) == {"USDJPY": 151.3}
+
+
+def test_fetched_prices_feed_the_tick_store(upstream):
+    store = app.TickStore()
+    service = app.PriceService(providers=localproviders(upstream), store=store)
+    service.getall()
+    price, ts = store.latest("XAUUSD")
+    assert price == 2350.1
+    assert ts == pytest.approx(time.time(), abs=5)
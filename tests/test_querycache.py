@@ -0,0 +1,64 @@
+import pytest
+
+import trading_app_full as app
+
+
+@pytest.fixture
+def users(db):
+    """ids of two traders (the admin is id 1)"""
+    app.adduser("budi", "rahasia1", "user")
+    app.adduser("sari", "rahasia2", "user")
+    return app.getuserbyusername("budi")['id'], app.getuserbyusername("sari")['id']
+
+
+def trade(userid, time="10:00:00"):
+    return {'userid': userid, 'pair': "XAUUSD", 'type': "BUY", 'lot': 0.1, 'openprice': 2300.0, 'closeprice': 2310.0,
+            'date': "2024-05-01", 'time': time, 'profitusd': 100.0, 'profitidr': 1600000.0, 'pips': 0.1}
+
+
+def counts():
+    stats = app.getquerycache().stats()
+    return stats['hits'], stats['misses']
+
+
+def test_repeated_page_is_served_from_the_cache(users):
+    budi, _ = users
+    app.inserttradedata(trade(budi))
+    first = app.gettradespage(budi, pagesize=10)
+    assert app.gettradespage(budi, pagesize=10) is first
+    assert app.gettradespage(budi, pair="XAUUSD", pagesize=10) is not first  # other filters, other entry
+    assert counts() == (1, 2)
+    assert "queries" in app.getmetrics().snapshot()['caches']
+
+
+def test_write_invalidates_only_that_users_entries(users):
+    budi, sari = users
+    app.inserttradedata(trade(budi))
+    app.inserttradedata(trade(sari))
+    budipage, saripage = app.gettradespage(budi), app.gettradespage(sari)
+    tradeid = app.inserttradedata(trade(budi, "11:00:00"))
+    rows, _ = app.gettradespage(budi)
+    assert [r['id'] for r in rows][0] == tradeid and rows is not budipage[0]
+    assert app.gettradespage(sari) is saripage
+    app.deletetrade(tradeid)
+    assert [r['id'] for r in app.gettradespage(budi)[0]] == [r['id'] for r in budipage[0]]
+    assert len(app.getquerycache()) == 2  # superseded versions of budi's page are dropped
+
+
+def test_admin_scope_follows_every_users_writes(users):
+    budi, sari = users
+    app.inserttradedata(trade(budi))
+    everyone = app.gettradespage(1, allifadmin=True)
+    assert len(everyone[0]) == 1 and app.gettradespage(1, allifadmin=True) is everyone
+    app.inserttradedata(trade(sari))
+    assert len(app.gettradespage(1, allifadmin=True)[0]) == 2
+
+
+def test_large_results_are_not_kept(users, monkeypatch):
+    budi, _ = users
+    monkeypatch.setattr(app, "QUERYCACHEMAXROWS", 1)
+    app.inserttradedata(trade(budi))
+    app.inserttradedata(trade(budi, "11:00:00"))
+    first = app.gettradespage(budi)
+    assert app.gettradespage(budi) is not first and len(app.getquerycache()) == 0
+    assert app.gettradespage(budi, pagesize=1) is app.gettradespage(budi, pagesize=1)
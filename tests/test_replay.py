@@ -0,0 +1,113 @@
+import calendar
+
+import numpy as np
+import pytest
+
+import trading_app_full as app
+
+START = calendar.timegm((2024, 5, 1, 10, 0, 0))  # first candle, UTC
+
+
+@pytest.fixture
+def store(tmp_path):
+    return app.CandleStore(str(tmp_path / "candles"))
+
+
+def flat(n, price=2300.0):
+    ts = START + 60 * np.arange(n)
+    return ts, np.full(n, price), np.full(n, price + 1), np.full(n, price - 1), np.full(n, price)
+
+
+def closed(minute, position="BUY", takeprofit=None, stoploss=None, pair="XAUUSD", closeprice=2305.0):
+    at = app.datetime.utcfromtimestamp(START + 60 * minute)
+    profitusd = round(app.calculateprofitusd(pair, 2300.0, closeprice, 0.1, position), 2)
+    return {'userid': 1, 'pair': pair, 'type': position, 'lot': 0.1, 'openprice': 2300.0, 'closeprice': closeprice,
+            'takeprofit': takeprofit, 'stoploss': stoploss, 'date': at.strftime('%Y-%m-%d'),
+            'time': at.strftime('%H:%M:%S'), 'profitusd': profitusd, 'profitidr': profitusd * 16000, 'pips': 0.0}
+
+
+def test_replay_outcomes(db, store):
+    ts, o, h, l, c = flat(60)
+    h[5] = 2320.0                   # spike up
+    l[10] = 2280.0                  # spike down
+    h[20], l[20] = 2340.0, 2260.0   # both levels in one candle
+    o[30], h[30], l[30] = 2250.0, 2252.0, 2248.0  # gap down through the stop
+    store.write("XAUUSD", ts, o, h, l, c)
+    ids = {name: app.inserttradedata(data) for name, data in {
+        'tp': closed(0, takeprofit=2315.0, stoploss=2285.0),
+        'sl': closed(0, takeprofit=2330.0, stoploss=2285.0),
+        'sellsl': closed(0, "SELL", takeprofit=2290.0, stoploss=2310.0),
+        'both': closed(15, takeprofit=2335.0, stoploss=2265.0),
+        'gap': closed(25, stoploss=2270.0),
+        'none': closed(40, takeprofit=2500.0),
+        'early': closed(-5, takeprofit=2315.0),
+        'nocandles': closed(0, pair="EURUSD", takeprofit=1.2, closeprice=1.1),
+    }.items()}
+    app.inserttradedata(closed(0))  # no TP/SL: not replayed
+    df = app.replaytrades(1, store=store).set_index('id')
+    got = {name: (df.loc[i, 'outcome'], df.loc[i, 'exitprice'], bool(df.loc[i, 'ambiguous'])) for name, i in ids.items()}
+    assert {k: v for k, v in got.items() if k not in ('early', 'nocandles')} == {
+        'tp': ("tp", 2315.0, False), 'sl': ("sl", 2285.0, False), 'sellsl': ("sl", 2310.0, False),
+        'both': ("sl", 2265.0, True), 'gap': ("sl", 2250.0, False), 'none': ("none", 2305.0, False)}
+    assert got['early'][0] == got['nocandles'][0] == "nodata" and np.isnan(got['early'][1])
+    assert df.loc[ids['tp'], 'hitat'] == np.datetime64(START + 300, 's')
+    assert df.loc[ids['tp'], 'replayusd'] == round(app.calculateprofitusd("XAUUSD", 2300.0, 2315.0, 0.1, "BUY"), 2)
+    assert df.loc[ids['none'], 'diffusd'] == 0.0
+    summary = app.replaysummary(df.reset_index()).set_index('outcome')
+    assert summary.loc["sl", 'trades'] == 4 and summary.loc["sl", 'ambiguous'] == 1
+
+
+def bruteforce(ts, high, low, tradeat, isbuy, takeprofit, stoploss, horizon):
+    start = np.searchsorted(ts, tradeat)
+    if start >= len(ts) or tradeat < ts[0]:
+        return 0, None
+    window = slice(start, np.searchsorted(ts, tradeat + horizon, side='right'))
+    up, down = (takeprofit, stoploss) if isbuy else (stoploss, takeprofit)
+    hits = []
+    if not np.isnan(up):
+        hits.append((np.flatnonzero(high[window] >= up), 2 if isbuy else 3))
+    if not np.isnan(down):
+        hits.append((np.flatnonzero(low[window] <= down), 3 if isbuy else 2))
+    firsts = sorted((idx[0], code == 2) for idx, code in hits if len(idx))  # same candle: SL sorts first
+    if not firsts:
+        return 1, None
+    return (2 if firsts[0][1] else 3), start + firsts[0][0]
+
+
+def test_replay_matches_a_candle_by_candle_scan(store):
+    rng = np.random.default_rng(3)
+    n = 3 * app.CANDLEBLOCK * app.REPLAYBLOCKSCAN + 123  # several summary scans and a partial last block
+    close = 2300 + np.cumsum(rng.normal(0, 0.5, n))
+    high, low = close + rng.uniform(0, 1, n), close - rng.uniform(0, 1, n)
+    ts = START + 60 * np.arange(n)
+    store.write("XAUUSD", ts, close, high, low, close)
+    candles = store.load("XAUUSD")
+    m = 300
+    tradeat = START + 60 * rng.integers(-10, n + 10, m) + rng.integers(0, 60, m)
+    isbuy = rng.random(m) < 0.5
+    distance = rng.choice([2.0, 20.0, 200.0], m)
+    takeprofit = np.where(isbuy, 2300 + distance, 2300 - distance) + rng.normal(0, 5, m)
+    stoploss = np.where(isbuy, 2300 - distance, 2300 + distance) + rng.normal(0, 5, m)
+    takeprofit[rng.random(m) < 0.2] = np.nan
+    stoploss[rng.random(m) < 0.2] = np.nan
+    horizon = 20 * 86400
+    outcome, hitat, exitprice, ambiguous = app.replaycandles(candles, tradeat, isbuy, takeprofit, stoploss, horizon)
+    for i in range(m):
+        code, at = bruteforce(ts, high, low, tradeat[i], isbuy[i], takeprofit[i], stoploss[i], horizon)
+        assert outcome[i] == code, i
+        if at is not None:
+            assert hitat[i] == ts[at], i
+
+
+def test_store_merges_and_reloads_on_change(store, tmp_path):
+    ts, o, h, l, c = flat(10)
+    assert store.write("xauusd", ts, o, h, l, c) == 10
+    assert store.load("XAUUSD") is store.load("XAUUSD") and store.stats()['hits'] == 1
+    assert store.write("XAUUSD", ts[5:] + 300, o[5:] + 1, h[5:] + 1, l[5:] + 1, c[5:] + 1) == 15
+    candles = store.load("XAUUSD")
+    assert len(candles['ts']) == 15 and candles['open'][5] == 2300.0 and candles['open'][10] == 2301.0
+    assert store.pairs() == ["XAUUSD"] and store.describe()[0]['candles'] == 15
+    ohlc = tmp_path / "XAUUSD_M1.csv"
+    ohlc.write_text("2024.05.01,10:00,2300.5,2301,2299,2300.2,12\n2024.05.01,10:01,2300.2,2299,2301,2300,7\n")
+    ts, o, h, l, c = app.loadcandlefile(str(ohlc))  # MT4 history export; high < low rows are dropped
+    assert list(ts) == [START] and list(o) == [2300.5]
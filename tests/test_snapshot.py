@@ -0,0 +1,112 @@
+import trading_app_full as app
+
+
+def addtrades(n):
+    row = (1, "XAUUSD", "BUY", 0.1, 2300.0, 2310.0, None, None, "2024-05-01", "10:00:00", None,
+           10.0, 160000.0, 100.0, "2024-05-01T10:00:00")
+    app.gettradewriter().submit(app.tradebulkinsertop, [row] * n).result()
+
+
+def deletetrades(n):
+    with app.getdb().read() as conn:
+        ids = [r[0] for r in conn.execute("SELECT id FROM ttrading ORDER BY id LIMIT ?", (n,))]
+    for tradeid in ids:
+        app.deletetrade(tradeid)
+
+
+def tradecount():
+    with app.getdb().read() as conn:
+        return conn.execute("SELECT COUNT(*) FROM ttrading").fetchone()[0]
+
+
+def test_deletes_after_a_prune_still_reach_the_replica(db, tmp_path):
+    addtrades(2000)
+    snapshot = app.TradeSnapshot(str(tmp_path / "replica"))
+    snapshot.refresh()
+    deletetrades(200)
+    assert snapshot.refresh()['deleted'] == 200
+    deletetrades(2)
+    assert snapshot.refresh()['deleted'] == 2
+    assert snapshot.table(['id']).num_rows == tradecount() == 1798
+
+
+def test_tombstones_are_kept_until_every_replica_has_them(db, tmp_path):
+    addtrades(100)
+    first, second = app.TradeSnapshot(str(tmp_path / "a")), app.TradeSnapshot(str(tmp_path / "b"))
+    first.refresh()
+    second.refresh()
+    deletetrades(10)
+    first.refresh()
+    first.refresh()
+    assert second.refresh()['deleted'] == 10
+    assert first.table(['id']).num_rows == second.table(['id']).num_rows == 90
+    with app.getdb().read() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM tdeletedtrade").fetchone()[0] == 0
+
+
+def test_forgotten_replica_no_longer_holds_tombstones_back(db, tmp_path):
+    addtrades(10)
+    kept, dropped = app.TradeSnapshot(str(tmp_path / "a")), app.TradeSnapshot(str(tmp_path / "b"))
+    kept.refresh()
+    dropped.refresh()
+    deletetrades(3)
+    kept.refresh()
+    assert dropped.forget()
+    kept.refresh()
+    with app.getdb().read() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM tdeletedtrade").fetchone()[0] == 0
+
+
+def test_unregistered_replica_resyncs(db, tmp_path):
+    addtrades(50)
+    snapshot = app.TradeSnapshot(str(tmp_path / "replica"))
+    snapshot.refresh()
+    # a replica built before watermarks were registered, whose tombstones were pruned meanwhile
+    app.gettradewriter().submit(app.snapshotforgetop, snapshot.key).result()
+    deletetrades(5)
+    app.gettradewriter().submit(lambda conn: conn.execute("DELETE FROM tdeletedtrade")).result()
+    result = snapshot.refresh()
+    assert result['resynced'] and result['rows'] == 45
+    assert snapshot.table(['id']).num_rows == 45
+    assert not snapshot.refresh()['resynced']
+
+
+def tombstones():
+    with app.getdb().read() as conn:
+        return conn.execute("SELECT COUNT(*) FROM tdeletedtrade").fetchone()[0]
+
+
+def test_deletes_without_a_replica_leave_no_tombstones(db, tmp_path):
+    addtrades(20)
+    deletetrades(5)
+    assert tombstones() == 0
+    snapshot = app.TradeSnapshot(str(tmp_path / "replica"))
+    snapshot.refresh()
+    deletetrades(5)
+    assert snapshot.refresh()['deleted'] == 5
+    assert snapshot.table(['id']).num_rows == tradecount() == 10
+    deletetrades(1)
+    assert tombstones() == 1
+    snapshot.forget()
+    assert tombstones() == 0
+    deletetrades(1)
+    assert tombstones() == 0
+
+
+def test_refresh_reads_one_consistent_cut(db, tmp_path, monkeypatch):
+    addtrades(10)
+    snapshot = app.TradeSnapshot(str(tmp_path / "replica"))
+    snapshot.refresh()
+    addtrades(5)
+    writemonths = app.TradeSnapshot.writemonths
+
+    def deletemidway(self, pq, table, name):
+        monkeypatch.setattr(app.TradeSnapshot, "writemonths", writemonths)
+        deletetrades(1)  # committed while the refresh is still reading
+        return writemonths(self, pq, table, name)
+
+    monkeypatch.setattr(app.TradeSnapshot, "writemonths", deletemidway)
+    assert snapshot.refresh()['deleted'] == 0
+    assert snapshot.table(['id']).num_rows == 15
+    assert snapshot.refresh()['deleted'] == 1
+    assert snapshot.table(['id']).num_rows == tradecount() == 14
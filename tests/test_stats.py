@@ -0,0 +1,89 @@
+import trading_app_full as app
+
+
+def trade(userid=1, pair="XAUUSD", position="BUY", openprice=2300.0, closeprice=2310.0, lot=0.1, time="10:00:00"):
+    data = {'userid': userid, 'pair': pair, 'type': position, 'lot': lot, 'openprice': openprice,
+            'closeprice': closeprice, 'date': "2024-05-01", 'time': time, 'profitusd': 0.0, 'profitidr': 0.0, 'pips': 0.0}
+    if closeprice is not None:
+        profitusd = round(app.calculateprofitusd(pair, openprice, closeprice, lot, position), 2)
+        data.update(profitusd=profitusd, profitidr=profitusd * 16000,
+                    pips=round(app.calculatepips(pair, openprice, closeprice), 4))
+    return data
+
+
+def bulkrow(data):
+    return (data['userid'], data['pair'], data['type'], data['lot'], data['openprice'], data['closeprice'], None, None,
+            data['date'], data['time'], None, data['profitusd'], data['profitidr'], data['pips'], "2024-05-01T10:00:00")
+
+
+def stats(userid=1, pair=None):
+    row = app.getuserstats(userid, pair)
+    return None if row is None else {k: row[k] for k in ('tradecount', 'profitusd', 'wins', 'losses', 'lasttradeat')}
+
+
+def test_insert_update_delete_keep_the_aggregates_current(db):
+    win = app.inserttradedata(trade())
+    app.inserttradedata(trade(closeprice=2290.0, time="11:00:00"))
+    app.inserttradedata(trade(pair="EURUSD", openprice=1.08, closeprice=1.09, lot=1, time="09:00:00"))
+    app.openposition(trade(time="12:00:00"))  # no realized P&L: stays out
+    assert stats() == {'tradecount': 3, 'profitusd': 100.0 - 100.0 + 1000.0, 'wins': 2, 'losses': 1,
+                       'lasttradeat': "2024-05-01 11:00:00"}
+    assert stats(pair="XAUUSD")['tradecount'] == 2
+    app.updatetrade(win, trade(position="SELL", time="13:00:00"))
+    assert stats() == {'tradecount': 3, 'profitusd': -100.0 - 100.0 + 1000.0, 'wins': 1, 'losses': 2,
+                       'lasttradeat': "2024-05-01 13:00:00"}
+    app.deletetrade(win)
+    assert stats() == {'tradecount': 2, 'profitusd': 900.0, 'wins': 1, 'losses': 1,
+                       'lasttradeat': "2024-05-01 11:00:00"}
+    assert app.checktradestats() == []
+
+
+def test_closing_a_position_adds_it(db):
+    tradeid = app.openposition(trade())
+    assert stats() is None or stats()['tradecount'] == 0
+    assert app.closeposition(tradeid, 2310.0)
+    assert stats()['tradecount'] == 1 and stats()['profitusd'] == 100.0
+    assert app.checktradestats() == []
+
+
+def test_deferred_bulk_insert_merges_once(db):
+    app.inserttradedata(trade())
+    rows = [bulkrow(trade(userid=u, pair=p, closeprice=c)) for u in (1, 2) for p in ("XAUUSD", "USOIL")
+            for c in (2310.0, 2290.0)]
+    app.gettradewriter().submit(app.tradebulkinsertop, rows).result()
+    assert stats()['tradecount'] == 5
+    assert stats(2)['tradecount'] == 4
+    assert stats(2, "USOIL")['tradecount'] == 2
+    with app.getdb().read() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM tstatsdefer").fetchone()[0] == 0
+    assert app.checktradestats() == []
+
+
+def test_check_finds_drift_and_rebuild_repairs_it(db):
+    app.inserttradedata(trade())
+    app.inserttradedata(trade(userid=2))
+    with app.getdb().transaction() as conn:
+        conn.execute("UPDATE tuserstats SET profitusd = profitusd + 5 WHERE userid=1")
+        conn.execute("DELETE FROM tuserpairstats WHERE userid=2")
+    found = {(m['table'], m['key'], m['column']) for m in app.checktradestats()}
+    assert found == {("tuserstats", (1,), "profitusd"), ("tuserpairstats", (2, "XAUUSD"), None)}
+    app.rebuildtradestats()
+    assert app.checktradestats() == []
+
+
+def test_check_reads_one_snapshot(db):
+    app.inserttradedata(trade())
+
+    def commitbetween(sql):
+        # a trade commits after the GROUP BY ran and before the stored totals are read
+        if sql.startswith("SELECT userid, tradecount") and not committed:
+            committed.append(app.gettradewriter().submit(app.tradeinsertop, trade(time="11:00:00")).result(5))
+
+    committed = []
+    with app.getdb().connection() as conn:
+        conn.set_trace_callback(commitbetween)
+        try:
+            assert app.checktradestats() == []
+        finally:
+            conn.set_trace_callback(None)
+    assert committed and stats()['tradecount'] == 2
@@ -0,0 +1,91 @@
+import pytest
+
+import trading_app_full as app
+
+
+@pytest.mark.parametrize("storedhash", [
+    "pbkdf2_sha256$100000$abc",                 # missing field
+    "pbkdf2_sha256$100000$zz$00",               # salt is not hex
+    "pbkdf2_sha256$many$00$00",                 # iterations not a number
+    "pbkdf2_sha256$0$00$00",                    # iterations rejected by pbkdf2_hmac
+    "pbkdf2_sha256$100000$00$00$extra",         # too many fields
+    "ünïcode",                                  # legacy branch, not ASCII
+])
+def test_malformed_hash_never_matches(storedhash):
+    assert app.verifypassword("secret", storedhash) is False
+
+
+def test_hash_round_trip_and_legacy_hashes():
+    stored = app.hashpassword("secret")
+    assert app.verifypassword("secret", stored)
+    assert not app.verifypassword("wrong", stored)
+    assert not app.needsrehash(stored)
+    legacy = app.hashlib.pbkdf2_hmac('sha256', b"secret", app.SALT, 100000).hex()
+    assert app.verifypassword("secret", legacy)
+    assert app.needsrehash(legacy)
+
+
+def test_bulk_reset_gives_each_user_its_own_password(db):
+    for name in ("ana", "budi"):
+        app.adduser(name, "oldpw", "user")
+    ids = [app.getuserbyusername(n)['id'] for n in ("ana", "budi")]
+    reset = dict(app.resetuserspasswords(ids + [9999]))
+    assert sorted(reset) == ["ana", "budi"]
+    assert reset["ana"] != reset["budi"] and "password123" not in reset.values()
+    for name, password in reset.items():
+        stored = app.getuserbyusername(name)['passwordhash']
+        assert app.verifypassword(password, stored) and not app.verifypassword("oldpw", stored)
+
+
+def test_provisioning_reports_every_bad_row_and_creates_the_rest(db):
+    app.adduser("taken", "pw", "user")
+    rows = [("ana", "user", "secret1"), ("budi", "ADMIN"), (" ", "user"), ("cici", "boss"),
+            ("ana", "user"), ("taken", "user"), ("dewi", float("nan"), float("nan")), ("eko", "", "")]
+    created, errors = app.provisionusers(rows)
+    assert [c[:2] for c in created] == [("ana", "user"), ("budi", "admin"), ("dewi", "user"), ("eko", "user")]
+    assert errors == [(2, "username is empty"), (3, "invalid role: boss"), (4, "duplicate username in file: ana"),
+                      (5, "username already exists: taken")]
+    passwords = dict((c[0], c[2]) for c in created)
+    assert passwords["ana"] == "secret1"
+    assert len({passwords["budi"], passwords["dewi"], passwords["eko"]}) == 3
+    for name, password in passwords.items():
+        user = app.getuserbyusername(name)
+        assert user['status'] == "active" and app.verifypassword(password, user['passwordhash'])
+
+
+def test_provisioning_from_a_pandas_csv(db, tmp_path):
+    path = tmp_path / "users.csv"
+    path.write_text("username,role,password\nfani,user,\ngita,,pw2\n")
+    df = app.pd.read_csv(path, dtype=str)
+    created, errors = app.provisionusers(df.itertuples(index=False, name=None))
+    assert errors == [] and [c[:2] for c in created] == [("fani", "user"), ("gita", "user")]
+    assert created[1][2] == "pw2"
+
+
+def test_hashmany_salts_every_password():
+    hashes = app.gethashservice().hashmany(["same"] * 4)
+    assert len(set(hashes)) == 4
+    assert all(app.verifypassword("same", h) for h in hashes)
+
+
+def test_user_directory_search_and_paging(db):
+    app.provisionusers([(f"trader{i:02d}", "user", "pw") for i in range(12)] + [("tamu", "admin", "pw")])
+    app.setusersstatus([app.getuserbyusername(n)['id'] for n in ("trader03", "trader07")], "inactive")
+    names, afterid = [], None
+    while True:
+        rows, afterid = app.searchusers(query="trader", afterid=afterid, pagesize=5)
+        names += [r['username'] for r in rows]
+        if afterid is None:
+            break
+    assert names == [f"trader{i:02d}" for i in reversed(range(12))]
+    assert [r['username'] for r in app.searchusers(status="inactive")[0]] == ["trader07", "trader03"]
+    assert [r['username'] for r in app.searchusers(role="admin")[0]] == ["tamu", "admin"]
+    assert app.searchusers(query="zz")[0] == []
+
+
+def test_bulk_status_change(db):
+    app.provisionusers([("ana", "user", "pw"), ("budi", "user", "pw")])
+    ids = [app.getuserbyusername(n)['id'] for n in ("ana", "budi")]
+    assert app.setusersstatus(ids, "inactive") == 2
+    assert app.setusersstatus([], "inactive") == 0
+    assert {r['username'] for r in app.searchusers(status="inactive")[0]} == {"ana", "budi"}
@@ -0,0 +1,62 @@
+import threading
+import time
+
+import pytest
+
+import trading_app_full as app
+
+
+def trade(**overrides):
+    data = {'userid': 1, 'pair': "XAUUSD", 'type': "BUY", 'lot': 0.1, 'openprice': 2300.0, 'closeprice': 2310.0,
+            'date': "2024-05-01", 'time': "10:00:00", 'profitusd': 100.0, 'profitidr': 1600000.0, 'pips': 100.0}
+    data.update(overrides)
+    return data
+
+
+def tradecount():
+    with app.getdb().read() as conn:
+        return conn.execute("SELECT COUNT(*) FROM ttrading").fetchone()[0]
+
+
+def blockwriter():
+    """Occupy the writer thread until the returned event is set"""
+    release, started = threading.Event(), threading.Event()
+
+    def block(conn):
+        started.set()
+        release.wait(10)
+
+    fut = app.gettradewriter().submit(block)
+    started.wait(5)
+    return release, fut
+
+
+def test_queued_write_is_cancelled_on_timeout(db):
+    release, blocker = blockwriter()
+    fut = app.inserttradedata(trade(), wait=False)
+    with pytest.raises(TimeoutError, match="nothing was saved"):
+        app.waitwrite(fut, timeout=0.1)
+    release.set()
+    blocker.result(5)
+    # the writer skips the cancelled op: a retry does not save the trade twice
+    app.inserttradedata(trade())
+    assert fut.cancelled()
+    assert tradecount() == 1
+
+
+def test_running_write_is_waited_for(db):
+    def slowinsert(conn):
+        time.sleep(0.3)
+        return app.tradeinsertop(conn, trade())
+
+    fut = app.gettradewriter().submit(slowinsert)
+    time.sleep(0.05)
+    assert app.waitwrite(fut, timeout=0.05)
+    assert tradecount() == 1
+
+
+def test_dead_writer_fails_fast(db):
+    writer = app.gettradewriter()
+    writer.close()
+    with pytest.raises(RuntimeError):
+        app.inserttradedata(trade())
@@ -0,0 +1,555 @@
+"""Headless JSON API over the trading_app_full schema (for trade-copier bots).
+
+    python trading_api.py [--db tradingapp.db] [--host 127.0.0.1] [--port 8502]
+
+Plain asyncio + HTTP/1.1 keep-alive, no extra dependencies. Blocking work
+(SQLite, PBKDF2, price fetches) runs on a bounded thread pool; trade inserts
+go through the app's single TradeWriter, so concurrent requests are group
+committed together.
+
+    POST /api/login    {"username", "password"}        -> {"token", ...}
+    POST /api/trades   {"trades": [{pair, type, lot, openprice, closeprice,
+                        date, time, takeprofit?, stoploss?, note?}, ...]}
+    GET  /api/trades   ?afterid=&pagesize=&pair=&type=&status=open|closed&datefrom=&dateto=&all=1
+    GET  /api/export   ?format=csv|csv.gz|parquet + the /api/trades filters -> file, chunked
+    GET  /api/stats    per-user aggregates (overall and per pair)
+    GET  /api/prices   ?pairs=XAUUSD,BTCUSD
+    GET  /api/health
+
+Everything except /api/login and /api/health needs "Authorization: Bearer <token>".
+ApiClient below is a minimal client for bots and tests.
+"""
+import argparse
+import asyncio
+import io
+import json
+import secrets
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlsplit, parse_qsl
+
+import numpy as np
+import requests
+import streamlit.logger
+
+streamlit.logger.set_log_level("error")  # st.cache_resource outside a script run warns per call
+
+import trading_app_full as app
+
+APIHOST = "127.0.0.1"
+APIPORT = 8502
+APIWORKERS = app.DBPOOLSIZE    # one per pooled connection
+APIMAXINFLIGHT = 512           # requests admitted to the executor at once; the rest wait
+APIMAXBODY = 8 * 1024 * 1024
+APIMAXBATCH = 5000             # trades per POST /api/trades
+APIBULKMIN = 32                # smaller batches use the per-row stats triggers instead of a deferred merge
+APIMAXPAGESIZE = 1000
+APITOKENTTL = 12 * 3600
+APITOKENPURGE = 300            # seconds between sweeps of expired tokens
+APIIDLETIMEOUT = 60            # seconds a keep-alive connection may sit idle
+APIMAXEXPORTS = 2              # exports streaming at once (each holds a pool thread and a read connection)
+APIEXPORTQUEUE = 16            # ~8 KB chunks buffered between the export thread and the socket
+
+class ApiError(Exception):
+    def __init__(self, status, message, details=None):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+# -----------------------
+# auth: PBKDF2 once per login, then an in-memory bearer token
+
+class TokenStore:
+    """token -> (userid, username, role, expiresat); expired tokens are swept on issue().
+
+    authorize() re-reads the user's status and role on every request, so an
+    admin deactivating or downgrading someone takes effect right away instead
+    of when the token expires.
+    """
+
+    def __init__(self, ttl=APITOKENTTL):
+        self.ttl = ttl
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self.nextpurge = time.time() + APITOKENPURGE
+
+    def issue(self, user):
+        token = secrets.token_urlsafe(32)
+        now = time.time()
+        with self.lock:
+            if now >= self.nextpurge:
+                self.purge(now)
+            self.tokens[token] = (user['id'], user['username'], user['role'], now + self.ttl)
+        return token
+
+    def purge(self, now):
+        # caller holds the lock; one pass per APITOKENPURGE, so logins stay O(1) amortized
+        for token in [t for t, entry in self.tokens.items() if entry[3] < now]:
+            del self.tokens[token]
+        self.nextpurge = now + APITOKENPURGE
+
+    def lookup(self, token):
+        with self.lock:
+            entry = self.tokens.get(token)
+            if entry and entry[3] < time.time():
+                del self.tokens[token]
+                entry = None
+        return entry
+
+    def authorize(self, token):
+        """lookup() checked against tuser (blocking: run it on the executor)"""
+        entry = self.lookup(token)
+        if entry is None:
+            return None
+        user = app.getuserbyid(entry[0])
+        if user is None or user['status'] != 'active':
+            self.revoke(entry[0])
+            raise ApiError(403, "account disabled") if user else ApiError(401, "missing or expired token")
+        if user['role'] != entry[2]:
+            entry = (entry[0], user['username'], user['role'], entry[3])
+            with self.lock:
+                if token in self.tokens:
+                    self.tokens[token] = entry
+        return entry
+
+    def revoke(self, userid):
+        with self.lock:
+            for token in [t for t, entry in self.tokens.items() if entry[0] == userid]:
+                del self.tokens[token]
+
+def login(tokens, body):
+    user = app.getuserbyusername(str(body.get('username', '')))
+    if not user or not app.verifypassword(str(body.get('password', '')), user['passwordhash']):
+        raise ApiError(401, "invalid username or password")
+    if user['status'] != 'active':
+        raise ApiError(403, "account disabled")
+    if app.needsrehash(user['passwordhash']):
+        app.updateuserpasswordhash(user['id'], app.hashpassword(body['password']))
+    return {'token': tokens.issue(user), 'userid': user['id'], 'username': user['username'],
+            'role': user['role'], 'expiresin': tokens.ttl}
+
+# -----------------------
+# trade ingestion: validate the whole batch, price it vectorized, one writer op per request
+
+def parsetrades(items):
+    """Validated columns for a batch, or ApiError(400) listing every bad item"""
+    if not isinstance(items, list) or not items:
+        raise ApiError(400, "trades must be a non-empty list")
+    if len(items) > APIMAXBATCH:
+        raise ApiError(400, f"at most {APIMAXBATCH} trades per request")
+    rows, errors = [], []
+    for i, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise ValueError("trade must be an object")
+            pair = app.normalizepair(item.get('pair', ''))
+            if pair is None:
+                raise ValueError(f"unknown pair {item.get('pair')!r}")
+            position = app.normalizetype(item.get('type', ''))
+            if position is None:
+                raise ValueError("type must be BUY or SELL")
+            lot, openprice, closeprice = (float(item[k]) for k in ('lot', 'openprice', 'closeprice'))
+            if not (lot > 0 and openprice > 0 and closeprice > 0):
+                raise ValueError("lot, openprice and closeprice must be > 0")
+            when = datetime.strptime(f"{item['date']} {item.get('time') or '00:00:00'}", "%Y-%m-%d %H:%M:%S")
+            tp, sl = (float(item[k]) if item.get(k) else None for k in ('takeprofit', 'stoploss'))
+            note = item.get('note')
+            rows.append((pair, position, lot, openprice, closeprice, tp if tp and tp > 0 else None,
+                         sl if sl and sl > 0 else None, when.strftime("%Y-%m-%d"), when.strftime("%H:%M:%S"),
+                         str(note) if note else None))
+        except (KeyError, TypeError, ValueError) as e:
+            errors.append({'index': i, 'error': f"missing field {e}" if isinstance(e, KeyError) else str(e)})
+    if errors:
+        raise ApiError(400, f"{len(errors)} invalid trades, nothing inserted", errors[:100])
+    return rows
+
+def apiinsertop(conn, params):
+    """tradebulkinsertop that also reports the new ids (AUTOINCREMENT, single writer)"""
+    seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name='ttrading'").fetchone()
+    first = (seq[0] if seq else 0) + 1
+    if len(params) >= APIBULKMIN:
+        app.tradebulkinsertop(conn, params)
+    else:
+        conn.executemany(app.TRADEINSERTSQL, params)
+    return {'inserted': len(params), 'ids': list(range(first, first + len(params)))}
+
+def inserttrades(session, body):
+    if session[2] != 'admin' and (app.getsetting('storestatus') or 'open') == 'close':
+        raise ApiError(403, "store is closed")
+    rows = parsetrades(body.get('trades'))
+    cols = list(zip(*rows))
+    pips, profitusd = app.calculatetradesvec(cols[0], cols[1], cols[2], cols[3], cols[4])
+    rate = app.getfxratecache().ratesfor(cols[7])
+    rate = np.where(np.isnan(rate), app.getusdtoidr() or app.DEFAULTUSDIDR, rate)
+    profitusd = app.roundvec(profitusd, 2)
+    profitidr = app.roundvec(profitusd * rate, 0)
+    pips = app.roundvec(pips, 4)
+    created = datetime.utcnow().isoformat()
+    params = [(session[0], *row, float(usd), float(idr), float(p), created)
+              for row, usd, idr, p in zip(rows, profitusd, profitidr, pips)]
+    # the Future is awaited on the event loop, not on a pool thread, so many
+    # requests can wait on the writer at once and land in the same commit
+    return app.gettradewriter().submit(apiinsertop, params)
+
+# -----------------------
+# queries
+
+def intparam(query, name, default=None, low=None, high=None):
+    value = query.get(name)
+    if value in (None, ""):
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ApiError(400, f"{name} must be an integer")
+    if low is not None:
+        value = max(value, low)
+    if high is not None:
+        value = min(value, high)
+    return value
+
+def tradehistory(session, query):
+    allifadmin = session[2] == 'admin' and query.get('all') in ("1", "true")
+    rows, nextid = app.gettradespage(
+        session[0], afterid=intparam(query, 'afterid'),
+        pagesize=intparam(query, 'pagesize', app.HISTORYPAGESIZE, 1, APIMAXPAGESIZE),
+        pair=query.get('pair') or None, position=query.get('type') or None,
+        datefrom=query.get('datefrom') or None, dateto=query.get('dateto') or None,
+        status=query.get('status') or None, allifadmin=allifadmin)
+    return {'trades': [dict(r) for r in rows], 'nextafterid': nextid}
+
+class ExportStream(io.RawIOBase):
+    """Response body of /api/export: exporttrades() writes into it on a pool thread,
+    the event loop sends each chunk; a full queue blocks the writer (backpressure)"""
+
+    def __init__(self, fmt, kwargs, filename):
+        super().__init__()
+        self.fmt = fmt
+        self.kwargs = kwargs
+        self.filename = filename
+        self.loop = None
+        self.queue = None
+        self.cancelled = False
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        if self.cancelled:
+            raise ConnectionError("client went away")
+        data = bytes(data)
+        if data:
+            asyncio.run_coroutine_threadsafe(self.queue.put(data), self.loop).result()
+            self.position += len(data)
+        return len(data)
+
+    def run(self):
+        try:
+            app.exporttrades(self, self.fmt, **self.kwargs)
+        finally:
+            asyncio.run_coroutine_threadsafe(self.queue.put(None), self.loop).result()
+
+def exporttrades(session, query):
+    fmt = query.get('format') or "csv"
+    if fmt not in app.EXPORTFORMATS:
+        raise ApiError(400, f"format must be one of {', '.join(app.EXPORTFORMATS)}")
+    allifadmin = session[2] == 'admin' and query.get('all') in ("1", "true")
+    kwargs = {'userid': session[0], 'allifadmin': allifadmin,
+              'columns': app.EXPORTCOLUMNS if allifadmin else app.USEREXPORTCOLUMNS,
+              'pair': query.get('pair') or None, 'position': query.get('type') or None,
+              'datefrom': query.get('datefrom') or None, 'dateto': query.get('dateto') or None,
+              'status': query.get('status') or None}
+    return ExportStream(fmt, kwargs, f"trading_{datetime.utcnow().date()}{app.EXPORTFORMATS[fmt]}")
+
+def tradestats(session, query):
+    stats = app.getuserstats(session[0])
+    return {'userid': session[0], 'dataversion': app.getdataversion(session[0]),
+            'total': dict(stats) if stats else None,
+            'bypair': [dict(r) for r in app.getuserpairstats(session[0])]}
+
+def prices(service, query):
+    pairs = [p.strip().upper() for p in query.get('pairs', '').split(',') if p.strip()] or list(service.bypair)
+    values = service.getmany(pairs)
+    out = {}
+    for pair in pairs:
+        cached = service.peek(pair)
+        out[pair] = {'price': values.get(pair), 'fetchedat': cached[1] if cached else None}
+    return {'prices': out}
+
+def health(server, query):
+    return {'status': 'ok', 'writer': app.gettradewriter().stats(), 'uptime': time.time() - server.startedat}
+
+# -----------------------
+# HTTP
+
+STATUSTEXT = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden", 404: "Not Found",
+              405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+class ApiServer:
+    """asyncio HTTP/1.1 server; handlers run on a bounded thread pool"""
+
+    def __init__(self, priceservice=None, workers=APIWORKERS, maxinflight=APIMAXINFLIGHT):
+        self.tokens = TokenStore()
+        self.priceservice = priceservice
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="api")
+        self.maxinflight = maxinflight
+        self.inflight = None
+        self.exports = None
+        self.connections = set()  # serve() tasks of open keep-alive connections
+        self.server = None
+        self.startedat = time.time()
+        # (method, path) -> (handler(session or server, body/query), needs auth)
+        self.routes = {
+            ("POST", "/api/login"): (lambda s, body: login(self.tokens, body), False),
+            ("POST", "/api/trades"): (inserttrades, True),
+            ("GET", "/api/trades"): (tradehistory, True),
+            ("GET", "/api/export"): (exporttrades, True),
+            ("GET", "/api/stats"): (tradestats, True),
+            ("GET", "/api/prices"): (lambda s, query: prices(self.getpriceservice(), query), True),
+            ("GET", "/api/health"): (lambda s, query: health(self, query), False),
+        }
+
+    def getpriceservice(self):
+        if self.priceservice is None:
+            self.priceservice = app.getpriceservice()
+        return self.priceservice
+
+    async def start(self, host=APIHOST, port=APIPORT):
+        self.inflight = asyncio.Semaphore(self.maxinflight)
+        self.exports = asyncio.Semaphore(APIMAXEXPORTS)
+        self.server = await asyncio.start_server(self.serve, host, port)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            for task in list(self.connections):
+                task.cancel()
+            await asyncio.gather(*self.connections, return_exceptions=True)
+            await self.server.wait_closed()
+        self.executor.shutdown(wait=True)
+
+    async def serve(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self.readrequest(reader), APIIDLETIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                if request is None:
+                    break
+                method, target, headers, body = request
+                if isinstance(body, ApiError):
+                    status, payload = body.status, {'error': str(body)}
+                else:
+                    status, payload = await self.dispatch(method, target, headers, body)
+                keepalive = headers.get('connection', '').lower() != 'close'
+                if isinstance(payload, ExportStream):
+                    if not await self.stream(writer, payload, keepalive) or not keepalive:
+                        break
+                    continue
+                data = json.dumps(payload, default=str).encode()
+                writer.write(f"HTTP/1.1 {status} {STATUSTEXT.get(status, '')}\r\n"
+                             f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                             f"Connection: {'keep-alive' if keepalive else 'close'}\r\n\r\n".encode() + data)
+                await writer.drain()
+                if not keepalive:
+                    break
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    async def stream(self, writer, body, keepalive):
+        """Send an ExportStream as a chunked response; False when the connection must be dropped"""
+        async with self.exports:
+            loop = asyncio.get_running_loop()
+            body.loop, body.queue = loop, asyncio.Queue(APIEXPORTQUEUE)
+            writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n"
+                         f"Content-Disposition: attachment; filename=\"{body.filename}\"\r\n"
+                         f"Transfer-Encoding: chunked\r\n"
+                         f"Connection: {'keep-alive' if keepalive else 'close'}\r\n\r\n".encode())
+            done = loop.run_in_executor(self.executor, body.run)
+            try:
+                while (chunk := await body.queue.get()) is not None:
+                    writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    await writer.drain()
+                await done
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+                return True
+            except (Exception, asyncio.CancelledError) as e:
+                # headers are out, so a failure can only cut the response short;
+                # unblock the export thread and let it finish before dropping the connection
+                body.cancelled = True
+                while not done.done() and (await body.queue.get()) is not None:
+                    pass
+                await asyncio.gather(done, return_exceptions=True)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                return False
+
+    async def readrequest(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, _ = line.decode('latin-1').split(" ", 2)
+        except ValueError:
+            return "GET", "/", {'connection': 'close'}, ApiError(400, "malformed request line")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            headers['connection'] = 'close'
+            return method, target, headers, ApiError(400, "invalid Content-Length")
+        if length > APIMAXBODY:
+            headers['connection'] = 'close'
+            return method, target, headers, ApiError(413, "body too large")
+        body = await reader.readexactly(length) if length else b""
+        return method, target, headers, body
+
+    async def dispatch(self, method, target, headers, body):
+        url = urlsplit(target)
+        route = self.routes.get((method, url.path))
+        if route is None:
+            known = any(path == url.path for _, path in self.routes)
+            return (405, {'error': "method not allowed"}) if known else (404, {'error': "not found"})
+        handler, needsauth = route
+        try:
+            context = self
+            auth = headers.get('authorization', '')
+            if needsauth and not auth.startswith("Bearer "):
+                raise ApiError(401, "missing or expired token")
+            async with self.inflight:
+                loop = asyncio.get_running_loop()
+                if needsauth:
+                    context = await loop.run_in_executor(self.executor, self.tokens.authorize, auth[7:])
+                    if context is None:
+                        raise ApiError(401, "missing or expired token")
+                if method == "POST":
+                    try:
+                        arg = json.loads(body or b"{}")
+                    except ValueError:
+                        raise ApiError(400, "body must be JSON")
+                    if not isinstance(arg, dict):
+                        raise ApiError(400, "body must be a JSON object")
+                else:
+                    arg = dict(parse_qsl(url.query))
+                result = await loop.run_in_executor(self.executor, handler, context, arg)
+                if isinstance(result, Future):
+                    result = await asyncio.wrap_future(result)
+            return 200, result
+        except ApiError as e:
+            payload = {'error': str(e)}
+            if e.details:
+                payload['details'] = e.details
+            return e.status, payload
+        except Exception:
+            # details (SQL, paths) go to the server log, not to the client
+            print(f"{method} {url.path} failed:", file=sys.stderr)
+            traceback.print_exc()
+            return 500, {'error': "internal server error"}
+
+# -----------------------
+# client
+
+class ApiClient:
+    """Keep-alive client for the endpoints above; raises ApiError with the server's status and message"""
+
+    def __init__(self, baseurl=f"http://{APIHOST}:{APIPORT}", timeout=30):
+        self.baseurl = baseurl.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.token = None
+
+    def call(self, method, path, params=None, body=None):
+        headers = {'Authorization': f"Bearer {self.token}"} if self.token else {}
+        r = self.session.request(method, self.baseurl + path, params=params, json=body,
+                                 headers=headers, timeout=self.timeout)
+        payload = r.json()
+        if r.status_code != 200:
+            raise ApiError(r.status_code, payload.get('error', r.reason), payload.get('details'))
+        return payload
+
+    def login(self, username, password):
+        result = self.call("POST", "/api/login", body={'username': username, 'password': password})
+        self.token = result['token']
+        return result
+
+    def inserttrades(self, trades):
+        return self.call("POST", "/api/trades", body={'trades': list(trades)})
+
+    def trades(self, **filters):
+        return self.call("GET", "/api/trades", params=filters)
+
+    def stats(self):
+        return self.call("GET", "/api/stats")
+
+    def prices(self, pairs=()):
+        return self.call("GET", "/api/prices", params={'pairs': ",".join(pairs)} if pairs else None)
+
+    def health(self):
+        return self.call("GET", "/api/health")
+
+    def export(self, dest, fmt="csv", **filters):
+        """Stream GET /api/export into dest (binary file object); returns bytes written"""
+        headers = {'Authorization': f"Bearer {self.token}"} if self.token else {}
+        with self.session.get(self.baseurl + "/api/export", params={'format': fmt, **filters},
+                              headers=headers, timeout=self.timeout, stream=True) as r:
+            if r.status_code != 200:
+                raise ApiError(r.status_code, r.json().get('error', r.reason))
+            written = 0
+            for chunk in r.iter_content(64 * 1024):
+                dest.write(chunk)
+                written += len(chunk)
+        return written
+
+    def close(self):
+        self.session.close()
+
+def serve(host=APIHOST, port=APIPORT):
+    app.initdb()
+
+    async def run():
+        server = ApiServer()
+        bound = await server.start(host, port)
+        print(f"listening on http://{bound[0]}:{bound[1]} (db {app.DBPATH})")
+        try:
+            await server.server.serve_forever()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    # guarded: password hashing spawns worker processes that re-import __main__
+    parser = argparse.ArgumentParser(prog="trading_api.py")
+    parser.add_argument("--db", default=None, help="database path (default: %s)" % app.DBPATH)
+    parser.add_argument("--host", default=APIHOST)
+    parser.add_argument("--port", type=int, default=APIPORT)
+    args = parser.parse_args()
+    if args.db:
+        app.DBPATH = args.db
+    serve(args.host, args.port)
+    sys.exit(0)
@@ -1,31 +1,656 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import sqlite3
 import os
+import sys
+import argparse
 import hashlib
+import math
+import re
+import csv
+import gzip
+import tempfile
 import binascii
+import hmac
+import secrets
+import multiprocessing
 import time
-from datetime import datetime
+import queue
+import threading
+import functools
+import inspect
+import atexit
+import json
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait as waitfutures
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 import requests
+import numpy as np
 import pandas as pd
+import io
 from io import StringIO
 
 DBPATH = "tradingapp.db"
-SALT = b"tradingappsaltv1"  # static salt for simplicity, for production, use per-user random salts
+SALT = b"tradingappsaltv1"  # legacy static salt; only used to verify (and then rehash) old hashes
 PAIROPTIONS = ["XAUUSD", "BTCUSD", "ETHUSD", "USTEC", "USOIL", "EURUSD", "USDJPY"]
 CONTRACTSIZE = {
     "XAUUSD": 100, "BTCUSD": 1, "ETHUSD": 1, "USTEC": 20, 
     "USOIL": 1000, "EURUSD": 100000, "USDJPY": 100000
 }
+DEFAULTUSDIDR = 16000  # used when tfxrate has no rate on or before the date
 
-def getdbconnection():
-    conn = sqlite3.connect(DBPATH, check_same_thread=False)
+# SQLite tuning applied to every pooled connection
+DBPOOLSIZE = 8
+DBPOOLTIMEOUT = 30
+DBPRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,       # ~16 MB page cache per connection
+    "mmap_size": 268435456,     # 256 MB
+    "busy_timeout": 5000,       # ms
+    "temp_store": "MEMORY",
+}
+
+# group commit for trade writes: flush after this many ops or this many seconds
+WRITERFLUSHSIZE = 256
+WRITERFLUSHLATENCY = 0.005
+WRITERTIMEOUT = 30  # seconds a single interactive write waits for the writer to pick it up
+# what a UI write can raise: SQL errors, a stopped writer, or not started within WRITERTIMEOUT (see waitwrite)
+WRITEERRORS = (sqlite3.Error, RuntimeError, TimeoutError)
+
+# -----------------------
+# instrumentation: process-wide call timers and cache ratios, cheap enough to leave on
+
+LATENCYBUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)  # ms
+METRICSFILE = os.environ.get("TRADINGAPP_METRICSFILE")  # periodic Prometheus text dump, if set
+METRICSDUMPINTERVAL = 15
+
+class Metrics:
+    """Thread-safe registry of call timers (bucketed latency histogram, rows) plus cache collectors"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timers = {}    # name -> [count, totalms, maxms, rows, errors, bucketcounts]
+        self.collectors = {}  # name -> callable returning a stats dict (caches, writer queue...)
+        self.startedat = time.time()
+
+    def record(self, name, seconds, rows=None, error=False):
+        ms = seconds * 1000.0
+        i = 0
+        while i < len(LATENCYBUCKETS) and ms > LATENCYBUCKETS[i]:
+            i += 1
+        with self.lock:
+            t = self.timers.get(name)
+            if t is None:
+                t = self.timers[name] = [0, 0.0, 0.0, 0, 0, [0] * (len(LATENCYBUCKETS) + 1)]
+            t[0] += 1
+            t[1] += ms
+            if ms > t[2]:
+                t[2] = ms
+            if rows:
+                t[3] += rows
+            if error:
+                t[4] += 1
+            t[5][i] += 1
+
+    def register(self, name, collector):
+        """Pull stats from an object that already counts its own hits/misses"""
+        with self.lock:
+            self.collectors[name] = collector
+
+    def reset(self):
+        with self.lock:
+            self.timers.clear()
+            self.startedat = time.time()
+
+    @staticmethod
+    def percentile(buckets, count, q, maxms):
+        """q-quantile (ms) interpolated inside its histogram bucket, like histogram_quantile()"""
+        target = q * count
+        seen = 0
+        lower = 0.0
+        for bound, n in zip(LATENCYBUCKETS + (maxms,), buckets):
+            if n and seen + n >= target:
+                return min(lower + (min(bound, maxms) - lower) * (target - seen) / n, maxms)
+            seen += n
+            lower = bound
+        return maxms
+
+    def snapshot(self):
+        with self.lock:
+            timers = {k: (v[0], v[1], v[2], v[3], v[4], list(v[5])) for k, v in self.timers.items()}
+            collectors = dict(self.collectors)
+        out = {'since': self.startedat, 'timers': {}, 'caches': {}, 'components': {}}
+        for name, (count, total, mx, rows, errors, buckets) in sorted(timers.items()):
+            out['timers'][name] = {
+                'count': count, 'errors': errors, 'rows': rows, 'avgms': total / count if count else 0.0,
+                'p50ms': self.percentile(buckets, count, 0.50, mx), 'p95ms': self.percentile(buckets, count, 0.95, mx),
+                'p99ms': self.percentile(buckets, count, 0.99, mx), 'maxms': mx, 'buckets': buckets,
+            }
+        for name, collector in sorted(collectors.items()):
+            stats = collector()
+            out['components'][name] = stats
+            if 'hits' in stats and 'misses' in stats:
+                lookups = stats['hits'] + stats['misses']
+                out['caches'][name] = {'hits': stats['hits'], 'misses': stats['misses'],
+                                       'hitratio': stats['hits'] / lookups if lookups else None}
+        return out
+
+    def json(self):
+        return json.dumps(self.snapshot(), indent=2, default=str)
+
+    def prometheus(self):
+        """Prometheus text exposition format"""
+        snap = self.snapshot()
+        lines = ["# TYPE tradingapp_call_duration_ms histogram"]
+        for name, t in snap['timers'].items():
+            cumulative = 0
+            for bound, n in zip(LATENCYBUCKETS + ('+Inf',), t['buckets']):
+                cumulative += n
+                lines.append(f'tradingapp_call_duration_ms_bucket{{fn="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'tradingapp_call_duration_ms_sum{{fn="{name}"}} {t["avgms"] * t["count"]:.3f}')
+            lines.append(f'tradingapp_call_duration_ms_count{{fn="{name}"}} {t["count"]}')
+        lines.append("# TYPE tradingapp_call_rows_total counter")
+        lines += [f'tradingapp_call_rows_total{{fn="{n}"}} {t["rows"]}' for n, t in snap['timers'].items()]
+        lines.append("# TYPE tradingapp_call_errors_total counter")
+        lines += [f'tradingapp_call_errors_total{{fn="{n}"}} {t["errors"]}' for n, t in snap['timers'].items()]
+        lines.append("# TYPE tradingapp_cache_lookups_total counter")
+        for n, c in snap['caches'].items():
+            lines.append(f'tradingapp_cache_lookups_total{{cache="{n}",result="hit"}} {c["hits"]}')
+            lines.append(f'tradingapp_cache_lookups_total{{cache="{n}",result="miss"}} {c["misses"]}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """Write Prometheus text (or JSON for *.json) atomically"""
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.json() if str(path).endswith(".json") else self.prometheus())
+        os.replace(tmp, path)
+
+def metricsdumploop(registry, path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            registry.dump(path)
+        except OSError:
+            pass
+
+@st.cache_resource
+def getmetrics():
+    registry = Metrics()
+    if METRICSFILE:
+        threading.Thread(target=metricsdumploop, args=(registry, METRICSFILE, METRICSDUMPINTERVAL),
+                         name="metricsdump", daemon=True).start()
+    return registry
+
+def countrows(result):
+    if isinstance(result, (list, pd.DataFrame)):
+        return len(result)
+    if isinstance(result, tuple) and result and isinstance(result[0], list):
+        return len(result[0])  # (rows, nextcursor) pages
+    return None
+
+def timed(name, rows=countrows):
+    """Record latency, errors and returned rows of every call under name"""
+    def decorate(fn):
+        registry = getmetrics()  # resolved once per definition, not per call
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                registry.record(name, time.perf_counter() - started, error=True)
+                raise
+            except BaseException:
+                # st.rerun()/st.stop() unwind through renders; that is control flow, not an error
+                registry.record(name, time.perf_counter() - started)
+                raise
+            registry.record(name, time.perf_counter() - started, rows(result) if rows else None)
+            return result
+        return wrapper
+    return decorate
+
+def getdbconnection(path=None):
+    """Open a new tuned connection (autocommit; transactions are explicit via DBPool)"""
+    conn = sqlite3.connect(path or DBPATH, check_same_thread=False, isolation_level=None)
     conn.row_factory = sqlite3.Row
+    for name, value in DBPRAGMAS.items():
+        conn.execute(f"PRAGMA {name}={value}")
     return conn
 
-def initdb():
-    conn = getdbconnection()
-    c = conn.cursor()
-    
+class DBPool:
+    """Process-wide pool of SQLite connections.
+
+    A thread that already holds a connection gets the same one back, so helpers
+    called inside a transaction() join that transaction instead of deadlocking.
+    """
+
+    def __init__(self, path=None, size=DBPOOLSIZE, timeout=DBPOOLTIMEOUT):
+        self.path = path or DBPATH
+        self.size = size
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            cancreate = self.created < self.size
+            if cancreate:
+                self.created += 1
+        if cancreate:
+            try:
+                return getdbconnection(self.path)
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+        try:
+            return self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("database connection pool exhausted")
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self.idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        held = getattr(self.local, 'conn', None)
+        if held is not None:
+            yield held
+            return
+        conn = self.acquire()
+        self.local.conn = conn
+        try:
+            yield conn
+        finally:
+            self.local.conn = None
+            self.release(conn)
+
+    # read-only work just needs a connection; WAL lets readers run next to the writer
+    read = connection
+
+    @contextmanager
+    def transaction(self, mode="IMMEDIATE"):
+        with self.connection() as conn:
+            if conn.in_transaction:
+                # nested call: join the outer transaction
+                yield conn
+                return
+            conn.execute(f"BEGIN {mode}")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    def closeall(self):
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self.lock:
+                self.created -= 1
+
+@st.cache_resource
+def getdbpool(path=None):
+    return DBPool(path)
+
+def getdb():
+    """Shared pool for the current DBPATH (survives Streamlit reruns)"""
+    return getdbpool(DBPATH)
+
+class TradeWriter:
+    """Single background writer that owns the only trade write connection.
+
+    Write ops are queued and committed in batches (one transaction per flush
+    window). If any op in a batch fails, the batch is rolled back and its ops
+    are retried one transaction each, so a bad row does not take the others
+    down; submit() returns a Future with the op result.
+    """
+
+    def __init__(self, path=None, flushsize=WRITERFLUSHSIZE, flushlatency=WRITERFLUSHLATENCY):
+        self.path = path or DBPATH
+        self.flushsize = flushsize
+        self.flushlatency = flushlatency
+        self.queue = queue.Queue()
+        self.statslock = threading.Lock()
+        self.counters = {"submitted": 0, "committed": 0, "failed": 0, "batches": 0,
+                         "lastbatchsize": 0, "maxbatchsize": 0}
+        self.metrics = getmetrics()
+        self.thread = threading.Thread(target=self.run, name="tradewriter", daemon=True)
+        self.thread.start()
+
+    def submit(self, op, *args):
+        if not self.thread.is_alive():
+            raise RuntimeError("trade writer is not running")
+        fut = Future()
+        with self.statslock:
+            self.counters["submitted"] += 1
+        self.queue.put((op, args, fut))
+        return fut
+
+    def stats(self):
+        with self.statslock:
+            stats = dict(self.counters)
+        stats["queuedepth"] = self.queue.qsize()
+        stats["avgbatchsize"] = round(stats["committed"] / stats["batches"], 2) if stats["batches"] else 0.0
+        return stats
+
+    def run(self):
+        conn = getdbconnection(self.path)
+        stop = False
+        while not stop:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flushlatency
+            while len(batch) < self.flushsize:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self.flush(conn, batch)
+        conn.close()
+
+    def flush(self, conn, batch):
+        batch = [(op, args, fut) for op, args, fut in batch if fut.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            self.commitbatch(conn, batch)
+        except Exception as e:
+            # the connection itself failed (e.g. rollback raised): fail what is left, keep the thread alive
+            with self.statslock:
+                self.counters["failed"] += sum(1 for _, _, fut in batch if not fut.done())
+            for _, _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+
+    def commitbatch(self, conn, batch):
+        started = time.perf_counter()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            results = [op(conn, *args) for op, args, _ in batch]
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            if len(batch) > 1:
+                # isolate the failing op: retry each one in its own transaction
+                for item in batch:
+                    self.commitbatch(conn, [item])
+                return
+            with self.statslock:
+                self.counters["failed"] += 1
+            batch[0][2].set_exception(e)
+            return
+        with self.statslock:
+            self.counters["batches"] += 1
+            self.counters["committed"] += len(batch)
+            self.counters["lastbatchsize"] = len(batch)
+            self.counters["maxbatchsize"] = max(self.counters["maxbatchsize"], len(batch))
+        self.metrics.record("writer.commitbatch", time.perf_counter() - started, len(batch))
+        for (_, _, fut), res in zip(batch, results):
+            fut.set_result(res)
+
+    def close(self, timeout=10):
+        """Flush everything already queued and stop the writer thread"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout)
+
+@st.cache_resource
+def gettradewriterfor(path=None):
+    writer = TradeWriter(path)
+    atexit.register(writer.close)
+    getmetrics().register("writer", writer.stats)
+    return writer
+
+def gettradewriter():
+    return gettradewriterfor(DBPATH)
+
+def waitwrite(fut, timeout=WRITERTIMEOUT):
+    """Result of an interactive write, waiting at most timeout for the writer to start it.
+
+    A write still queued after timeout is cancelled, so it never commits
+    behind the caller's back (a retry would otherwise save it twice) and the
+    TimeoutError means nothing was written. One the writer has already
+    started is waited for: its batch is committing.
+    """
+    try:
+        return fut.result(timeout)
+    except TimeoutError:
+        if fut.cancel():
+            raise TimeoutError(f"trade writer busy: not started within {timeout}s, nothing was saved") from None
+        return fut.result()
+
+# -----------------------
+# per-user and per-(user, pair) aggregates, kept current by triggers on ttrading
+# so every write path updates them inside its own transaction
+
+STATSCOLUMNS = ["tradecount", "profitusd", "grossprofitusd", "grosslossusd", "profitidr",
+                "grossprofitidr", "grosslossidr", "pips", "wins", "losses"]
+STATSTABLES = {"tuserstats": ["userid"], "tuserpairstats": ["userid", "pair"]}
+
+def statsexprs(r):
+    """Per-row contribution to each STATSCOLUMNS entry; r is a table alias, NEW or OLD"""
+    return [
+        "1",
+        f"{r}.profitusd", f"MAX({r}.profitusd, 0)", f"MAX(-{r}.profitusd, 0)",
+        f"{r}.profitidr", f"MAX({r}.profitidr, 0)", f"MAX(-{r}.profitidr, 0)",
+        f"{r}.pips", f"({r}.profitusd > 0)", f"({r}.profitusd < 0)",
+    ]
+
+def statsaddsql(table, keys):
+    # open positions (closeprice NULL) have no realized P&L and stay out of the aggregates
+    cols = ", ".join(keys + STATSCOLUMNS + ["lasttradeat"])
+    values = ", ".join([f"NEW.{k}" for k in keys] + statsexprs("NEW") + ["NEW.date || ' ' || NEW.time"])
+    updates = ", ".join([f"{c} = {c} + excluded.{c}" for c in STATSCOLUMNS]
+                        + ["lasttradeat = MAX(COALESCE(lasttradeat, ''), excluded.lasttradeat)"])
+    return (f"INSERT INTO {table}({cols}) SELECT {values} WHERE NEW.closeprice IS NOT NULL "
+            f"ON CONFLICT({', '.join(keys)}) DO UPDATE SET {updates};")
+
+def statssubsql(table, keys):
+    match = " AND ".join(f"{k} = OLD.{k}" for k in keys)
+    updates = ", ".join(f"{c} = {c} - {e}" for c, e in zip(STATSCOLUMNS, statsexprs("OLD")))
+    # only rescan for the newest trade time when the removed row was the newest
+    return (f"UPDATE {table} SET {updates}, lasttradeat = CASE WHEN lasttradeat = OLD.date || ' ' || OLD.time "
+            f"THEN (SELECT MAX(date || ' ' || time) FROM ttrading WHERE {match} AND closeprice IS NOT NULL) "
+            f"ELSE lasttradeat END WHERE {match} AND OLD.closeprice IS NOT NULL;")
+
+def createtradestats(c):
+    for table, keys in STATSTABLES.items():
+        keycols = ", ".join(f"{k} {'INTEGER' if k == 'userid' else 'TEXT'} NOT NULL" for k in keys)
+        statcols = ", ".join(f"{col} {'INTEGER' if col in ('tradecount', 'wins', 'losses') else 'REAL'} NOT NULL DEFAULT 0"
+                             for col in STATSCOLUMNS)
+        c.execute(f"CREATE TABLE IF NOT EXISTS {table} ({keycols}, {statcols}, lasttradeat TEXT, "
+                  f"PRIMARY KEY({', '.join(keys)}))")
+    # per-user data version, bumped by every trade write (cache key for analytics)
+    c.execute("CREATE TABLE IF NOT EXISTS tuserversion (userid INTEGER PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)")
+    # a row in tstatsdefer (only ever present inside a bulk write transaction)
+    # switches the insert/update triggers off; the bulk op fixes the aggregates set-based
+    c.execute("CREATE TABLE IF NOT EXISTS tstatsdefer (flag INTEGER PRIMARY KEY)")
+    adds = " ".join([statsaddsql(t, k) for t, k in STATSTABLES.items()] + [versionbumpsql("NEW")])
+    subs = " ".join([statssubsql(t, k) for t, k in STATSTABLES.items()] + [versionbumpsql("OLD")])
+    triggers = {
+        "trgttradinginsert": f"CREATE TRIGGER trgttradinginsert AFTER INSERT ON ttrading "
+                             f"WHEN NOT EXISTS (SELECT 1 FROM tstatsdefer) BEGIN {adds} END",
+        "trgttradingdelete": f"CREATE TRIGGER trgttradingdelete AFTER DELETE ON ttrading BEGIN {subs} END",
+        "trgttradingupdate": f"CREATE TRIGGER trgttradingupdate AFTER UPDATE ON ttrading "
+                             f"WHEN NOT EXISTS (SELECT 1 FROM tstatsdefer) BEGIN {subs} {adds} END",
+    }
+    # recreate any trigger whose definition changed since it was installed
+    for name, sql in triggers.items():
+        current = c.execute("SELECT sql FROM sqlite_master WHERE type='trigger' AND name=?", (name,)).fetchone()
+        if current and current[0] == sql:
+            continue
+        c.execute(f"DROP TRIGGER IF EXISTS {name}")
+        c.execute(sql)
+
+def versionbumpsql(r):
+    return (f"INSERT INTO tuserversion(userid, version) VALUES ({r}.userid, 1) "
+            f"ON CONFLICT(userid) DO UPDATE SET version = version + 1;")
+
+def statsselectsql(keys, where="1", indexed=True):
+    """indexed=False keeps the planner on the rowid range (a skip-scan of the userid
+    indexes looks cheap after ANALYZE but walks the whole index)"""
+    aggs = ", ".join(f"SUM({e})" for e in statsexprs("t"))
+    return (f"SELECT {', '.join('t.' + k for k in keys)}, {aggs}, MAX(t.date || ' ' || t.time) "
+            f"FROM ttrading t{'' if indexed else ' NOT INDEXED'} WHERE ({where}) AND t.closeprice IS NOT NULL GROUP BY {', '.join('t.' + k for k in keys)}")
+
+def statsmergeop(conn, afterid):
+    """Add every trade with id > afterid to the aggregates in one GROUP BY per table"""
+    for table, keys in STATSTABLES.items():
+        updates = ", ".join([f"{c} = {c} + excluded.{c}" for c in STATSCOLUMNS]
+                            + ["lasttradeat = MAX(COALESCE(lasttradeat, ''), excluded.lasttradeat)"])
+        conn.execute(f"INSERT INTO {table}({', '.join(keys + STATSCOLUMNS)}, lasttradeat) "
+                     f"{statsselectsql(keys, 't.id > ?', indexed=False)} ON CONFLICT({', '.join(keys)}) DO UPDATE SET {updates}",
+                     (afterid,))
+    conn.execute("INSERT INTO tuserversion(userid, version) SELECT DISTINCT userid, 1 FROM ttrading NOT INDEXED WHERE id > ? "
+                 "ON CONFLICT(userid) DO UPDATE SET version = version + 1", (afterid,))
+
+def statsrebuildop(conn):
+    for table, keys in STATSTABLES.items():
+        conn.execute(f"DELETE FROM {table}")
+        conn.execute(f"INSERT INTO {table}({', '.join(keys + STATSCOLUMNS)}, lasttradeat) {statsselectsql(keys)}")
+
+@timed("db.rebuildtradestats")
+def rebuildtradestats():
+    """Recompute both aggregate tables from ttrading (serialized with trade writes)"""
+    gettradewriter().submit(statsrebuildop).result()
+
+@timed("db.checktradestats")
+def checktradestats(tolerance=1e-9):
+    """Compare stored aggregates against a fresh GROUP BY; returns a list of mismatches"""
+    mismatches = []
+    # one read transaction: a write committing between the GROUP BY and the stored read
+    # would otherwise show up as a mismatch (and the admin button then rebuilds everything)
+    with getdb().transaction("DEFERRED") as conn:
+        for table, keys in STATSTABLES.items():
+            expected = {tuple(r[:len(keys)]): tuple(r[len(keys):]) for r in conn.execute(statsselectsql(keys))}
+            stored = {tuple(r[:len(keys)]): tuple(r[len(keys):]) for r in conn.execute(
+                f"SELECT {', '.join(keys + STATSCOLUMNS)}, lasttradeat FROM {table} WHERE tradecount != 0")}
+            for key in expected.keys() | stored.keys():
+                want, got = expected.get(key), stored.get(key)
+                if want is None or got is None:
+                    mismatches.append({'table': table, 'key': key, 'column': None, 'stored': got, 'expected': want})
+                    continue
+                for col, w, g in zip(STATSCOLUMNS + ["lasttradeat"], want, got):
+                    bad = (w != g) if col == "lasttradeat" else not math.isclose(w or 0, g or 0, rel_tol=tolerance, abs_tol=1e-6)
+                    if bad:
+                        mismatches.append({'table': table, 'key': key, 'column': col, 'stored': g, 'expected': w})
+    return mismatches
+
+@timed("db.getuserstats")
+def getuserstats(userid, pair=None):
+    with getdb().read() as conn:
+        if pair is None:
+            return conn.execute("SELECT * FROM tuserstats WHERE userid=?", (userid,)).fetchone()
+        return conn.execute("SELECT * FROM tuserpairstats WHERE userid=? AND pair=?", (userid, pair)).fetchone()
+
+@timed("db.getadmintotals", rows=None)
+def getadmintotals():
+    """(total trades, total users) for the admin dashboard, from the aggregates"""
+    with getdb().read() as conn:
+        totaltrades = conn.execute("SELECT COALESCE(SUM(tradecount), 0) FROM tuserstats").fetchone()[0]
+        totalusers = conn.execute("SELECT COUNT(*) FROM tuser").fetchone()[0]
+    return totaltrades, totalusers
+
+@timed("db.getdataversion")
+def getdataversion(userid):
+    """Counter that changes whenever any of the user's trades is inserted, updated or deleted"""
+    with getdb().read() as conn:
+        r = conn.execute("SELECT version FROM tuserversion WHERE userid=?", (userid,)).fetchone()
+    return r[0] if r else 0
+
+@timed("db.getglobaldataversion")
+def getglobaldataversion():
+    """Sum of all users' data versions: moves on any trade write (key for all-user reads)"""
+    with getdb().read() as conn:
+        return conn.execute("SELECT COALESCE(SUM(version), 0) FROM tuserversion").fetchone()[0]
+
+# -----------------------
+# query cache: trade reads memoized per (query, user, arguments, data version), shared by all sessions
+
+QUERYCACHESIZE = 512
+QUERYCACHEMAXROWS = 50000  # bigger results are not kept (memory is bounded by entries x rows)
+
+@st.cache_resource
+def getquerycachefor(path):
+    cache = LRUCache(QUERYCACHESIZE)
+    getmetrics().register("queries", cache.stats)
+    return cache
+
+def getquerycache():
+    return getquerycachefor(DBPATH)
+
+def querykey(value):
+    """Hashable, order-insensitive stand-in for an argument value (lists, dicts of filters)"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, querykey(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(querykey(v) for v in value)
+    return value
+
+def versioncached(fn):
+    """Memoize fn(userid, ..., allifadmin=False) in the shared query cache.
+
+    The key carries the user's data version (the all-user version when
+    allifadmin), which every write to that user's trades bumps. A write from
+    any session therefore makes every session miss on its next call, and the
+    superseded entries of that user are dropped when the new result is stored.
+    Cached results are shared between sessions: callers must not modify them.
+    """
+    signature = inspect.signature(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        params = bound.arguments
+        scope = None if params.get('allifadmin') or params['userid'] is None else params['userid']
+        version = getglobaldataversion() if scope is None else getdataversion(scope)
+        cache = getquerycache()
+        key = (fn.__name__, scope, version, querykey(params))
+        result = cache.get(key)
+        if result is None:
+            result = fn(*args, **kwargs)
+            cache.discard(lambda k: k[0] == key[0] and k[1] == scope and k[2] != version)
+            if (countrows(result) or 0) <= QUERYCACHEMAXROWS:
+                cache.put(key, result)
+        return result
+    return wrapper
+
+@timed("db.getuserpairstats")
+def getuserpairstats(userid):
+    with getdb().read() as conn:
+        return conn.execute("SELECT * FROM tuserpairstats WHERE userid=? AND tradecount > 0 ORDER BY pair",
+                            (userid,)).fetchall()
+
+# -----------------------
+# schema migrations: MIGRATIONS[i] brings the database to PRAGMA user_version i+1.
+# Append new steps at the end; never edit one that has shipped.
+
+def migrate001basetables(c):
     # users table
     c.execute('''CREATE TABLE IF NOT EXISTS tuser (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -63,197 +688,1288 @@ def initdb():
         key TEXT PRIMARY KEY,
         value TEXT
     )''')
-    conn.commit()
-    
+
+def migrate002historyindexes(c):
+    # history lookups per user (newest first) and date range scans
+    c.execute("CREATE INDEX IF NOT EXISTS idxttradinguserid ON ttrading(userid, id DESC)")
+    c.execute("CREATE INDEX IF NOT EXISTS idxttradingdatetime ON ttrading(date, time)")
+    c.execute("CREATE INDEX IF NOT EXISTS idxttradinguserpair ON ttrading(userid, pair, id DESC)")
+
+def migrate003tradestats(c):
+    # aggregates + data versions; backfill when added to an existing database
+    createtradestats(c)
+    statsrebuildop(c)
+
+def migrate004userdirectory(c):
+    # admin user directory: status/role filters, newest first
+    c.execute("CREATE INDEX IF NOT EXISTS idxtuserstatusrole ON tuser(status, role, id DESC)")
+
+def migrate005fxrates(c):
+    # USD/IDR history (one rate per day) + update trigger that honours tstatsdefer
+    c.execute("""CREATE TABLE IF NOT EXISTS tfxrate (
+        date TEXT PRIMARY KEY,
+        rate REAL NOT NULL,
+        source TEXT,
+        updatedat TEXT NOT NULL
+    ) WITHOUT ROWID""")
+    createtradestats(c)
+
+def migrate006compacttrades(c):
+    # integer pair codes (same numbering as PAIRCODE), BUY flag and epoch seconds next to the text columns
+    c.execute("CREATE TABLE IF NOT EXISTS tpair (code INTEGER PRIMARY KEY, pair TEXT UNIQUE NOT NULL)")
+    c.executemany("INSERT OR IGNORE INTO tpair(code, pair) VALUES (?,?)", [(code, pair) for pair, code in PAIRCODE.items()])
+    c.execute("INSERT OR IGNORE INTO tpair(pair) SELECT DISTINCT pair FROM ttrading")
+    existing = {r[1] for r in c.execute("PRAGMA table_info(ttrading)").fetchall()}
+    for col in ("paircode", "isbuy", "tradeat"):
+        if col not in existing:
+            c.execute(f"ALTER TABLE ttrading ADD COLUMN {col} INTEGER")
+    # values do not change, so keep the stats triggers out of the backfill
+    c.execute("INSERT INTO tstatsdefer(flag) VALUES (1)")
+    c.execute("""UPDATE ttrading SET paircode = (SELECT code FROM tpair WHERE tpair.pair = ttrading.pair),
+                 isbuy = (type = 'BUY'), tradeat = CAST(strftime('%s', date || ' ' || time) AS INTEGER)""")
+    c.execute("DELETE FROM tstatsdefer")
+    createpaircodetriggers(c)
+
+def createpaircodetriggers(c):
+    # a pair outside tpair gets a new code on first use; tstatsdefer flag 2 keeps that
+    # fix-up UPDATE away from the stats triggers without touching a bulk op's flag 1
+    for event in ("INSERT", "UPDATE OF pair"):
+        name = "trgttradingpaircode" + event.split()[0].lower()
+        c.execute(f"DROP TRIGGER IF EXISTS {name}")
+        c.execute(f"""CREATE TRIGGER {name} AFTER {event} ON ttrading WHEN NEW.paircode IS NULL BEGIN
+                      INSERT OR IGNORE INTO tpair(pair) VALUES (NEW.pair);
+                      INSERT OR IGNORE INTO tstatsdefer(flag) VALUES (2);
+                      UPDATE ttrading SET paircode = (SELECT code FROM tpair WHERE pair = NEW.pair) WHERE id = NEW.id;
+                      DELETE FROM tstatsdefer WHERE flag = 2;
+                      END""")
+
+def migrate007openpositions(c):
+    # open positions: closeprice NULL until the position is closed. SQLite cannot drop
+    # NOT NULL in place, so the table is rebuilt (same columns and ids) when needed.
+    columns = c.execute("PRAGMA table_info(ttrading)").fetchall()
+    if any(r[1] == "closeprice" and r[3] for r in columns):
+        names = ", ".join(r[1] for r in columns)
+        sql = c.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='ttrading'").fetchone()[0]
+        sql = re.sub(r"\bcloseprice REAL NOT NULL\b", "closeprice REAL", sql, count=1)
+        sql = re.sub(r"^CREATE TABLE ttrading\b", "CREATE TABLE ttradingnew", sql, count=1)
+        seq = c.execute("SELECT seq FROM sqlite_sequence WHERE name='ttrading'").fetchone()
+        c.execute(sql)
+        c.execute(f"INSERT INTO ttradingnew({names}) SELECT {names} FROM ttrading")
+        c.execute("DROP TABLE ttrading")  # drops its indexes and triggers too
+        c.execute("ALTER TABLE ttradingnew RENAME TO ttrading")
+        if seq:
+            # keep AUTOINCREMENT from reusing ids of rows deleted before the rebuild
+            c.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name='ttrading'", (seq[0],))
+        migrate002historyindexes(c)
+        createpaircodetriggers(c)
+    if not any(r[1] == "status" for r in c.execute("PRAGMA table_xinfo(ttrading)").fetchall()):
+        c.execute("ALTER TABLE ttrading ADD COLUMN status TEXT GENERATED ALWAYS AS "
+                  "(CASE WHEN closeprice IS NULL THEN 'open' ELSE 'closed' END) VIRTUAL")
+    c.execute("CREATE INDEX IF NOT EXISTS idxttradingopen ON ttrading(userid) WHERE closeprice IS NULL")
+    # global version of the open set (cache key for the mark-to-market engine)
+    c.execute("CREATE TABLE IF NOT EXISTS tpositionversion (id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL)")
+    c.execute("INSERT OR IGNORE INTO tpositionversion(id, version) VALUES (0, 0)")
+    for name, event, when in (("trgttradingpositioninsert", "INSERT", "NEW.closeprice IS NULL"),
+                              ("trgttradingpositionupdate", "UPDATE", "OLD.closeprice IS NULL OR NEW.closeprice IS NULL"),
+                              ("trgttradingpositiondelete", "DELETE", "OLD.closeprice IS NULL")):
+        c.execute(f"DROP TRIGGER IF EXISTS {name}")
+        c.execute(f"CREATE TRIGGER {name} AFTER {event} ON ttrading WHEN {when} BEGIN "
+                  f"UPDATE tpositionversion SET version = version + 1; END")
+    createtradestats(c)
+
+def migrate008snapshotwatermark(c):
+    # what the Parquet snapshot needs to catch up incrementally: changed rows by
+    # updatedat, deleted ids from a tombstone table (ids are never reused)
+    c.execute("CREATE INDEX IF NOT EXISTS idxttradingupdatedat ON ttrading(updatedat) WHERE updatedat IS NOT NULL")
+    c.execute("CREATE TABLE IF NOT EXISTS tdeletedtrade (seq INTEGER PRIMARY KEY, id INTEGER NOT NULL)")
+    createtombstonetrigger(c)
+
+def createtombstonetrigger(c):
+    c.execute("DROP TRIGGER IF EXISTS trgttradingtombstone")
+    c.execute("CREATE TRIGGER trgttradingtombstone AFTER DELETE ON ttrading BEGIN "
+              "INSERT INTO tdeletedtrade(id) VALUES (OLD.id); END")
+
+def migrate009snapshotreplicas(c):
+    # pruning emptied tdeletedtrade and plain rowids then restarted at 1, under the
+    # replicas' watermarks: AUTOINCREMENT keeps tombstone seqs rising for good
+    c.execute("DROP TRIGGER IF EXISTS trgttradingtombstone")
+    c.execute("CREATE TABLE tdeletedtradenew (seq INTEGER PRIMARY KEY AUTOINCREMENT, id INTEGER NOT NULL)")
+    c.execute("INSERT INTO tdeletedtradenew(seq, id) SELECT seq, id FROM tdeletedtrade")
+    c.execute("DROP TABLE tdeletedtrade")
+    c.execute("ALTER TABLE tdeletedtradenew RENAME TO tdeletedtrade")
+    createtombstonetrigger(c)
+    # each replica's tombstone watermark: tombstones are pruned only below the lowest one, and
+    # a replica missing here (older ones included) resyncs once, since it may have missed deletes
+    c.execute("CREATE TABLE IF NOT EXISTS tsnapshotreplica (root TEXT PRIMARY KEY, deleteseq INTEGER NOT NULL, at TEXT)")
+
+def migrate010replicatombstones(c):
+    # with no replica registered nothing prunes tombstones: only write them while one is,
+    # and drop the backlog an install without replicas has built up
+    c.execute("DROP TRIGGER IF EXISTS trgttradingtombstone")
+    c.execute("CREATE TRIGGER trgttradingtombstone AFTER DELETE ON ttrading "
+              "WHEN EXISTS (SELECT 1 FROM tsnapshotreplica) BEGIN "
+              "INSERT INTO tdeletedtrade(id) VALUES (OLD.id); END")
+    prunetombstones(c)
+
+def prunetombstones(c):
+    """Drop the tombstones every registered replica has seen (all of them when none is registered)"""
+    return c.execute("DELETE FROM tdeletedtrade WHERE NOT EXISTS (SELECT 1 FROM tsnapshotreplica) "
+                     "OR seq <= (SELECT MIN(deleteseq) FROM tsnapshotreplica)").rowcount
+
+MIGRATIONS = [
+    migrate001basetables,
+    migrate002historyindexes,
+    migrate003tradestats,
+    migrate004userdirectory,
+    migrate005fxrates,
+    migrate006compacttrades,
+    migrate007openpositions,
+    migrate008snapshotwatermark,
+    migrate009snapshotreplicas,
+    migrate010replicatombstones,
+]
+
+def migratedb(conn):
+    """Apply pending MIGRATIONS, one transaction each; returns the resulting schema version"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, migrate in enumerate(MIGRATIONS, start=1):
+        if target <= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # another process may have migrated while we waited for the lock
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if target > version:
+                migrate(conn.cursor())
+                conn.execute(f"PRAGMA user_version={target}")
+                version = target
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return version
+
+def seeddefaults(conn):
     # ensure default settings - PERBAIKAN DI SINI
-    c.execute("SELECT value FROM tsettings WHERE key='storestatus'")
-    r = c.fetchone()
-    if not r:
-        c.execute("INSERT OR REPLACE INTO tsettings(key, value) VALUES (?,?)", ('storestatus', 'open'))
-        conn.commit()
+    conn.execute("INSERT OR IGNORE INTO tsettings(key, value) VALUES (?,?)", ('storestatus', 'open'))
     
     # create default admin if no users exist
-    c.execute("SELECT COUNT(*) as cnt FROM tuser")
-    cnt = c.fetchone()[0]
-    if cnt == 0:
+    if conn.execute("SELECT COUNT(*) as cnt FROM tuser").fetchone()[0] == 0:
         adminpw = hashpassword("admin123")
         created = datetime.utcnow().isoformat()
-        c.execute("INSERT INTO tuser(username,passwordhash,role,status,createdat) VALUES (?,?,?,?,?)",
-                 ("admin", adminpw, "admin", "active", created))
-        conn.commit()
-    
-    conn.close()
+        conn.execute("INSERT INTO tuser(username,passwordhash,role,status,createdat) VALUES (?,?,?,?,?)",
+                     ("admin", adminpw, "admin", "active", created))
+
+def initdb():
+    """Migrate the schema and seed defaults (idempotent)"""
+    with getdb().connection() as conn:
+        version = migratedb(conn)
+    with getdb().transaction() as conn:
+        seeddefaults(conn)
+    getsettingscache().invalidate()
+    return version
+
+@st.cache_resource
+def bootstrapdb(path):
+    return initdb()
+
+def ensuredb():
+    """initdb() once per process and database path, not on every Streamlit rerun"""
+    return bootstrapdb(DBPATH)
+
+
+# -----------------------
+# password hashing: PBKDF2 runs in a process pool, off the Streamlit script thread
+
+PASSWORDITERATIONS = 100000
+HASHWORKERS = os.cpu_count() or 2
+HASHPREFIX = "pbkdf2_sha256"
 
+class HashService:
+    """PBKDF2-HMAC-SHA256 on a process pool (thread pool if processes are unavailable).
 
+    Workers run hashlib.pbkdf2_hmac directly, so nothing from this module has
+    to be pickled or re-imported in the children.
+    """
+
+    def __init__(self, workers=HASHWORKERS, processes=True):
+        self.executor = None
+        if processes:
+            try:
+                self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            except (OSError, ValueError, NotImplementedError):
+                self.executor = None
+        if self.executor is None:
+            # pbkdf2_hmac releases the GIL, so threads still hash in parallel
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hash")
+
+    def derive(self, password, salt, iterations=PASSWORDITERATIONS):
+        return self.executor.submit(hashlib.pbkdf2_hmac, 'sha256', password.encode('utf-8'), salt, iterations)
+
+    def hash(self, password):
+        return self.hashmany([password])[0]
+
+    def hashmany(self, passwords):
+        """Hash many passwords in parallel, each with its own random salt"""
+        salts = [secrets.token_bytes(16) for _ in passwords]
+        futs = [self.derive(pw, salt) for pw, salt in zip(passwords, salts)]
+        return [f"{HASHPREFIX}${PASSWORDITERATIONS}${salt.hex()}${fut.result().hex()}"
+                for salt, fut in zip(salts, futs)]
+
+    def verify(self, password, storedhash):
+        """Blocks the caller until a worker is done; a malformed stored hash never matches"""
+        try:
+            if storedhash.startswith(HASHPREFIX + "$"):
+                _, iterations, salthex, hashhex = storedhash.split("$")
+                dk = self.derive(password, bytes.fromhex(salthex), int(iterations)).result()
+                return hmac.compare_digest(dk.hex(), hashhex)
+            # legacy: hex digest with the static SALT
+            dk = self.derive(password, SALT, 100000).result()
+            return hmac.compare_digest(binascii.hexlify(dk).decode('utf-8'), storedhash)
+        except (ValueError, TypeError):
+            # wrong field count, bad hex, non-numeric or zero iterations, non-ASCII digest
+            return False
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+@st.cache_resource
+def gethashservice():
+    service = HashService()
+    atexit.register(service.close)
+    return service
+
+@timed("auth.hashpassword")
 def hashpassword(password: str) -> str:
-    """Return hex-encoded hash"""
-    pwd = password.encode('utf-8')
-    dk = hashlib.pbkdf2_hmac('sha256', pwd, SALT, 100000)
-    return binascii.hexlify(dk).decode('utf-8')
+    """Return a salted hash string: pbkdf2_sha256$iterations$salt$hash"""
+    return gethashservice().hash(password)
 
+@timed("auth.verifypassword")
 def verifypassword(password: str, storedhash: str) -> bool:
-    return hashpassword(password) == storedhash
+    """Constant-time check against new salted hashes and legacy static-salt hashes"""
+    return gethashservice().verify(password, storedhash)
 
-# Password hashing using PBKDF2-HMAC SHA256
+def needsrehash(storedhash: str) -> bool:
+    return not storedhash.startswith(f"{HASHPREFIX}${PASSWORDITERATIONS}$")
 
+@timed("db.adduser")
 def adduser(username, password, role):  # PERBAIKAN: hapus 'user' dari parameter
-    conn = getdbconnection()
-    c = conn.cursor()
     pwhash = hashpassword(password)
     created = datetime.utcnow().isoformat()
     try:
-        c.execute("INSERT INTO tuser(username,passwordhash,role,status,createdat) VALUES (?,?,?,?,?)",
-                 (username, pwhash, role, "active", created))  # PERBAIKAN: gunakan 'role' bukan 'roleuser'
-        conn.commit()
+        with getdb().transaction() as conn:
+            conn.execute("INSERT INTO tuser(username,passwordhash,role,status,createdat) VALUES (?,?,?,?,?)",
+                         (username, pwhash, role, "active", created))  # PERBAIKAN: gunakan 'role' bukan 'roleuser'
         return True, "User created"
     except sqlite3.IntegrityError:
         return False, "Username already exists"
-    finally:
-        conn.close()
 
+@timed("db.getuserbyusername")
 def getuserbyusername(username):
-    conn = getdbconnection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM tuser WHERE username=?", (username,))
-    row = c.fetchone()
-    conn.close()
-    return row
+    with getdb().read() as conn:
+        return conn.execute("SELECT * FROM tuser WHERE username=?", (username,)).fetchone()
 
+@timed("db.getuserbyid")
+def getuserbyid(userid):
+    with getdb().read() as conn:
+        return conn.execute("SELECT id,username,role,status FROM tuser WHERE id=?", (userid,)).fetchone()
+
+@timed("db.listusers")
 def listusers():
-    conn = getdbconnection()
-    c = conn.cursor()
-    c.execute("SELECT id,username,role,status,createdat FROM tuser ORDER BY id DESC")
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    with getdb().read() as conn:
+        return conn.execute("SELECT id,username,role,status,createdat FROM tuser ORDER BY id DESC").fetchall()
 
+@timed("db.updateuserstatus")
 def updateuserstatus(userid, status):
-    conn = getdbconnection()
-    c = conn.cursor()
-    c.execute("UPDATE tuser SET status=? WHERE id=?", (status, userid))
-    conn.commit()
-    conn.close()
+    with getdb().transaction() as conn:
+        conn.execute("UPDATE tuser SET status=? WHERE id=?", (status, userid))
+
+@timed("db.updateuserpasswordhash")
+def updateuserpasswordhash(userid, pwhash):
+    with getdb().transaction() as conn:
+        conn.execute("UPDATE tuser SET passwordhash=? WHERE id=?", (pwhash, userid))
+
+def generatepassword():
+    return secrets.token_urlsafe(9)
+
+@timed("db.provisionusers")
+def provisionusers(rows, roles=("user", "admin")):
+    """Create many users at once from (username, role[, password]) rows.
 
+    Missing passwords are generated. Hashes are computed in parallel and every
+    user is inserted in one transaction. Returns (created, errors) where
+    created is a list of (username, role, password) and errors (index, message).
+    """
+    def cell(row, i):
+        # blank cells arrive as None, "" or NaN (pandas reads them so even with dtype=str)
+        value = row[i] if len(row) > i else None
+        return "" if value is None or pd.isna(value) else str(value).strip()
+
+    created, errors, seen = [], [], set()
+    candidates = []
+    for i, row in enumerate(rows):
+        username = cell(row, 0)
+        role = cell(row, 1).lower() or "user"
+        password = cell(row, 2) or None
+        if not username:
+            errors.append((i, "username is empty"))
+        elif role not in roles:
+            errors.append((i, f"invalid role: {role}"))
+        elif username in seen:
+            errors.append((i, f"duplicate username in file: {username}"))
+        else:
+            seen.add(username)
+            candidates.append((i, username, role, password or generatepassword()))
+    existing = set()
+    names = [c[1] for c in candidates]
+    with getdb().read() as conn:
+        for start in range(0, len(names), 500):
+            part = names[start:start + 500]
+            existing.update(r[0] for r in conn.execute(
+                f"SELECT username FROM tuser WHERE username IN ({','.join('?' * len(part))})", part))
+    for i, username, _, _ in candidates:
+        if username in existing:
+            errors.append((i, f"username already exists: {username}"))
+    candidates = [c for c in candidates if c[1] not in existing]
+    hashes = gethashservice().hashmany([c[3] for c in candidates])
+    now = datetime.utcnow().isoformat()
+    with getdb().transaction() as conn:
+        conn.executemany("INSERT INTO tuser(username,passwordhash,role,status,createdat) VALUES (?,?,?,?,?)",
+                         [(c[1], h, c[2], "active", now) for c, h in zip(candidates, hashes)])
+    created = [(c[1], c[2], c[3]) for c in candidates]
+    return created, sorted(errors)
+
+@timed("db.updateuserpassword")
 def updateuserpassword(userid, newpassword):
-    conn = getdbconnection()
-    c = conn.cursor()
     pwhash = hashpassword(newpassword)
-    c.execute("UPDATE tuser SET passwordhash=? WHERE id=?", (pwhash, userid))
-    conn.commit()
-    conn.close()
+    with getdb().transaction() as conn:
+        conn.execute("UPDATE tuser SET passwordhash=? WHERE id=?", (pwhash, userid))
+
+USERPAGESIZE = 50
+
+@timed("db.searchusers")
+def searchusers(query=None, status=None, role=None, afterid=None, pagesize=USERPAGESIZE):
+    """Keyset-paginated user directory (newest first); returns (rows, nextafterid).
+
+    query is a username prefix, matched as a range on the unique username
+    index rather than a LIKE scan.
+    """
+    where, params = [], []
+    if query:
+        where.append("username >= ? AND username < ?")
+        params += [query, query + "\U0010ffff"]
+    if status:
+        where.append("status=?")
+        params.append(status)
+    if role:
+        where.append("role=?")
+        params.append(role)
+    if afterid is not None:
+        where.append("id<?")
+        params.append(afterid)
+    sql = "SELECT id,username,role,status,createdat FROM tuser"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id DESC LIMIT ?"
+    params.append(pagesize + 1)
+    with getdb().read() as conn:
+        rows = conn.execute(sql, params).fetchall()
+    if len(rows) > pagesize:
+        rows = rows[:pagesize]
+        return rows, rows[-1]['id']
+    return rows, None
+
+@timed("db.setusersstatus")
+def setusersstatus(userids, status):
+    """Activate/deactivate many users in one statement; returns rows changed"""
+    userids = list(userids)
+    if not userids:
+        return 0
+    with getdb().transaction() as conn:
+        return conn.execute(f"UPDATE tuser SET status=? WHERE id IN ({','.join('?' * len(userids))})",
+                            [status] + userids).rowcount
+
+@timed("db.resetuserspasswords")
+def resetuserspasswords(userids):
+    """Give each user a new random password: hashes computed in parallel, one executemany.
+
+    Returns [(username, password)] for the users that exist, to hand out once.
+    """
+    userids = list(userids)
+    with getdb().read() as conn:
+        users = []
+        for start in range(0, len(userids), 500):
+            part = userids[start:start + 500]
+            users += conn.execute(f"SELECT id, username FROM tuser WHERE id IN ({','.join('?' * len(part))}) ORDER BY id",
+                                  part).fetchall()
+    passwords = [generatepassword() for _ in users]
+    hashes = gethashservice().hashmany(passwords)
+    with getdb().transaction() as conn:
+        conn.executemany("UPDATE tuser SET passwordhash=? WHERE id=?", [(h, u['id']) for h, u in zip(hashes, users)])
+    return [(u['username'], pw) for u, pw in zip(users, passwords)]
 
 # -----------------------
 
-def inserttradedata(data: dict):
-    conn = getdbconnection()
-    c = conn.cursor()
-    c.execute("""INSERT INTO ttrading(userid,pair,type,lot,openprice,closeprice,takeprofit,stoploss,date,time,note,profitusd,profitidr,pips,createdat)
-                 VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+# the compact columns (paircode, isbuy, tradeat) are derived in SQL from the same 15 params
+TRADECOMPACTSQL = "(SELECT code FROM tpair WHERE pair=?2), ?3='BUY', CAST(strftime('%s', ?9 || ' ' || ?10) AS INTEGER)"
+TRADEINSERTSQL = f"""INSERT INTO ttrading(userid,pair,type,lot,openprice,closeprice,takeprofit,stoploss,date,time,note,profitusd,profitidr,pips,createdat,paircode,isbuy,tradeat)
+                 VALUES (?1,?2,?3,?4,?5,?6,?7,?8,?9,?10,?11,?12,?13,?14,?15,{TRADECOMPACTSQL})"""
+
+def tradeinsertop(conn, data):
+    c = conn.execute(TRADEINSERTSQL,
               (data['userid'], data['pair'], data['type'], data['lot'], data['openprice'], data['closeprice'],
                data.get('takeprofit'), data.get('stoploss'), data['date'], data['time'], data.get('note'),
                data['profitusd'], data['profitidr'], data['pips'], datetime.utcnow().isoformat()))
-    conn.commit()
-    conn.close()
+    return c.lastrowid
+
+def tradebulkinsertop(conn, params):
+    """params are TRADEINSERTSQL tuples; one executemany inside the writer's transaction.
+
+    The per-row stats trigger is deferred and the aggregates are merged once for
+    the whole batch (ids are AUTOINCREMENT and the writer is the only writer).
+    """
+    afterid = conn.execute("SELECT COALESCE(MAX(id), 0) FROM ttrading").fetchone()[0]
+    conn.execute("INSERT INTO tstatsdefer(flag) VALUES (1)")
+    conn.executemany(TRADEINSERTSQL, params)
+    statsmergeop(conn, afterid)
+    conn.execute("DELETE FROM tstatsdefer")
+    return len(params)
 
+@timed("db.inserttradedata")
+def inserttradedata(data: dict, wait=True):
+    """Queue an insert on the trade writer; returns the new id (or the Future if wait=False)"""
+    fut = gettradewriter().submit(tradeinsertop, data)
+    return waitwrite(fut) if wait else fut
+
+@timed("db.gettradesforuser")
 def gettradesforuser(userid, allifadmin=False):
-    conn = getdbconnection()
-    c = conn.cursor()
-    if allifadmin:
-        c.execute("SELECT t.*, u.username FROM ttrading t JOIN tuser u ON t.userid=u.id ORDER BY t.id DESC")
+    with getdb().read() as conn:
+        if allifadmin:
+            c = conn.execute("SELECT t.*, u.username FROM ttrading t JOIN tuser u ON t.userid=u.id ORDER BY t.id DESC")
+        else:
+            c = conn.execute("SELECT t.*, u.username FROM ttrading t JOIN tuser u ON t.userid=u.id WHERE userid=? ORDER BY t.id DESC", (userid,))
+        return c.fetchall()
+
+HISTORYPAGESIZE = 50
+
+@timed("db.gettradespage")
+@versioncached
+def gettradespage(userid, afterid=None, pagesize=HISTORYPAGESIZE, pair=None, position=None,
+                  datefrom=None, dateto=None, allifadmin=False, status=None):
+    """Keyset-paginated trade history (newest first).
+
+    Returns (rows, nextafterid); pass nextafterid back as afterid for the next
+    page. nextafterid is None on the last page.
+    """
+    where, params = tradefiltersql(userid, allifadmin, pair, position, datefrom, dateto, status)
+    if afterid is not None:
+        where.append("t.id<?")
+        params.append(afterid)
+    sql = "SELECT t.*, u.username FROM ttrading t JOIN tuser u ON t.userid=u.id"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY t.id DESC LIMIT ?"
+    params.append(pagesize + 1)
+    with getdb().read() as conn:
+        rows = conn.execute(sql, params).fetchall()
+    if len(rows) > pagesize:
+        rows = rows[:pagesize]
+        return rows, rows[-1]['id']
+    return rows, None
+
+def tradefiltersql(userid, allifadmin=False, pair=None, position=None, datefrom=None, dateto=None, status=None):
+    """WHERE terms and params for the history filters (table alias t)"""
+    where, params = [], []
+    if not allifadmin:
+        where.append("t.userid=?")
+        params.append(userid)
+    if pair:
+        where.append("t.pair=?")
+        params.append(pair)
+    if position:
+        where.append("t.type=?")
+        params.append(position)
+    if datefrom:
+        where.append("t.date>=?")
+        params.append(str(datefrom))
+    if dateto:
+        where.append("t.date<=?")
+        params.append(str(dateto))
+    if status:
+        # closeprice rather than the generated status column, so the partial index applies
+        where.append("t.closeprice IS NULL" if status == "open" else "t.closeprice IS NOT NULL")
+    return where, params
+
+# -----------------------
+# typed frames: columns are built from cursor batches, never one dict/Row per trade
+
+FRAMEBATCHSIZE = 50000
+# column -> (select expression, dtype); every real column stays float64: float32 cannot hold
+# IDR sums, 5-digit FX quotes or FX pips (1e-4 steps come back as 0.066666998), and lot feeds
+# P&L arithmetic. The savings come from int32/int8 codes and the pair/type/username categoricals
+TRADEFRAMECOLUMNS = {
+    'id': ("t.id", np.int64),
+    'userid': ("t.userid", np.int32),
+    'username': ("t.userid", np.int32),
+    'pair': ("t.paircode", np.int32),
+    'type': ("t.isbuy", np.int8),
+    'isbuy': ("t.isbuy", np.bool_),
+    'status': ("t.closeprice IS NULL", np.int8),
+    'tradeat': ("COALESCE(t.tradeat, -9223372036854775808)", np.int64),  # NULL -> NaT
+    'lot': ("t.lot", np.float64),
+    'openprice': ("t.openprice", np.float64),
+    'closeprice': ("t.closeprice", np.float64),
+    'takeprofit': ("t.takeprofit", np.float64),
+    'stoploss': ("t.stoploss", np.float64),
+    'profitusd': ("t.profitusd", np.float64),
+    'profitidr': ("t.profitidr", np.float64),
+    'pips': ("t.pips", np.float64),
+    'note': ("t.note", object),
+}
+TRADEFRAMEDEFAULT = ['id', 'username', 'pair', 'type', 'tradeat', 'lot', 'openprice', 'closeprice',
+                     'profitusd', 'profitidr', 'pips']
+
+def codecategorical(codes, table):
+    """Categorical from stored codes and (code, label) rows; unknown codes become NaN"""
+    known = np.array([r[0] for r in table], dtype=np.int64)
+    labels = [r[1] for r in table]
+    remap = np.full(int(max(known.max(initial=0), codes.max(initial=0))) + 1, -1, dtype=np.int32)
+    remap[known] = np.arange(len(known), dtype=np.int32)
+    return pd.Categorical.from_codes(np.where(codes >= 0, remap[np.maximum(codes, 0)], -1), labels)
+
+@timed("db.loadtradesframe")
+def loadtradesframe(userid=None, columns=TRADEFRAMEDEFAULT, allifadmin=False, batchsize=FRAMEBATCHSIZE, **filters):
+    """Trades (id order) as a typed DataFrame: categorical pair/type/username, int32/int8 codes, float64 values.
+
+    Rows are pulled with fetchmany() as plain tuples and each batch is turned
+    into one numpy array per column, so peak memory is the final columns plus
+    one batch. filters are the tradefiltersql() ones.
+    """
+    where, params = tradefiltersql(userid, allifadmin, **filters)
+    sql = f"SELECT {', '.join(TRADEFRAMECOLUMNS[c][0] for c in columns)} FROM ttrading t"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY t.id"
+    parts = {c: [] for c in columns}
+    with getdb().read() as conn:
+        cur = conn.cursor()
+        cur.row_factory = None
+        cur.arraysize = batchsize
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany()
+            if not rows:
+                break
+            for name, values in zip(columns, zip(*rows)):
+                parts[name].append(np.array(values, dtype=TRADEFRAMECOLUMNS[name][1]))
+        pairs = conn.execute("SELECT code, pair FROM tpair ORDER BY code").fetchall() if 'pair' in columns else None
+        users = conn.execute("SELECT id, username FROM tuser ORDER BY id").fetchall() if 'username' in columns else None
+    data = {}
+    for name in columns:
+        dtype = TRADEFRAMECOLUMNS[name][1]
+        values = np.concatenate(parts[name]) if parts[name] else np.array([], dtype=dtype)
+        if name == 'pair':
+            values = codecategorical(values, pairs)
+        elif name == 'username':
+            values = codecategorical(values, users)
+        elif name == 'type':
+            values = pd.Categorical.from_codes(values, ["SELL", "BUY"])
+        elif name == 'status':
+            values = pd.Categorical.from_codes(values, ["closed", "open"])
+        elif name == 'tradeat':
+            values = values.astype('datetime64[s]')
+        data[name] = values
+    return pd.DataFrame(data, copy=False)
+
+# -----------------------
+# streaming export: rows go cursor -> writer chunk by chunk, never all in memory
+
+EXPORTCHUNKSIZE = 20000
+EXPORTCOLUMNS = ['id', 'username', 'pair', 'type', 'status', 'lot', 'openprice', 'closeprice', 'takeprofit', 'stoploss',
+                 'date', 'time', 'note', 'profitusd', 'profitidr', 'pips', 'createdat', 'updatedat']
+USEREXPORTCOLUMNS = ['id', 'pair', 'type', 'status', 'lot', 'openprice', 'closeprice',
+                     'profitusd', 'profitidr', 'pips', 'date', 'time']
+EXPORTFORMATS = {"csv": ".csv", "csv.gz": ".csv.gz", "parquet": ".parquet"}
+
+def itertradechunks(userid=None, allifadmin=False, columns=EXPORTCOLUMNS, chunksize=EXPORTCHUNKSIZE, **filters):
+    """Yield lists of row tuples (newest first) from a single cursor via fetchmany"""
+    where, params = tradefiltersql(userid, allifadmin, **filters)
+    cols = ", ".join("u.username" if c == 'username' else f"t.{c}" for c in columns)
+    sql = f"SELECT {cols} FROM ttrading t JOIN tuser u ON t.userid=u.id"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY t.id DESC"
+    with getdb().read() as conn:
+        cur = conn.cursor()
+        cur.arraysize = chunksize
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany()
+            if not rows:
+                break
+            yield [tuple(r) for r in rows]
+
+@timed("db.exporttrades")
+def exporttrades(dest, fmt="csv", userid=None, allifadmin=False, columns=EXPORTCOLUMNS,
+                 chunksize=EXPORTCHUNKSIZE, progress=None, **filters):
+    """Write filtered trades to dest (path or binary file object) as csv, csv.gz or parquet.
+
+    Memory stays at roughly one chunk regardless of history size. Returns the
+    number of rows written.
+    """
+    chunks = itertradechunks(userid, allifadmin, columns=columns, chunksize=chunksize, **filters)
+    written = 0
+    if fmt == "parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+        types = {'id': pa.int64(), 'userid': pa.int64(), 'lot': pa.float64(), 'openprice': pa.float64(),
+                 'closeprice': pa.float64(), 'takeprofit': pa.float64(), 'stoploss': pa.float64(),
+                 'profitusd': pa.float64(), 'profitidr': pa.float64(), 'pips': pa.float64()}
+        schema = pa.schema([(c, types.get(c, pa.string())) for c in columns])
+        with pq.ParquetWriter(dest, schema, compression="zstd") as writer:
+            for rows in chunks:
+                writer.write_table(pa.table([list(v) for v in zip(*rows)], schema=schema))
+                written += len(rows)
+                if progress:
+                    progress(written)
+        return written
+    if fmt not in ("csv", "csv.gz"):
+        raise ValueError(f"unknown export format: {fmt}")
+    if isinstance(dest, (str, os.PathLike)):
+        raw = open(dest, "wb")
+        closeraw = True
     else:
-        c.execute("SELECT t.*, u.username FROM ttrading t JOIN tuser u ON t.userid=u.id WHERE userid=? ORDER BY t.id DESC", (userid,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+        raw, closeraw = dest, False
+    binary = gzip.GzipFile(fileobj=raw, mode="wb") if fmt == "csv.gz" else raw
+    text = io.TextIOWrapper(binary, encoding="utf-8", newline="")
+    try:
+        out = csv.writer(text, lineterminator="\n")
+        out.writerow(columns)
+        for rows in chunks:
+            out.writerows(rows)
+            written += len(rows)
+            if progress:
+                progress(written)
+        text.flush()
+    finally:
+        text.detach()
+        if binary is not raw:
+            binary.close()
+        if closeraw:
+            raw.close()
+    return written
+
+def exportfile(fmt="csv", **kwargs):
+    """Export into an anonymous temp file and return its raw handle, rewound (the file goes away when closed).
+
+    Only the open file is handed over, never its bytes. st.download_button still
+    reads it into Streamlit's in-memory media store, so exports too big for that
+    go through the CLI or the API's streamed /api/export.
+    """
+    tmp = tempfile.TemporaryFile()
+    try:
+        exporttrades(tmp, fmt, **kwargs)
+        tmp.flush()
+    except BaseException:
+        tmp.close()
+        raise
+    raw = tmp.detach()  # FileIO: a RawIOBase, which download_button accepts
+    raw.seek(0)
+    return raw
+
+def tradedeleteop(conn, tradeid):
+    return conn.execute("DELETE FROM ttrading WHERE id=?", (tradeid,)).rowcount
 
-def deletetrade(tradeid):
-    conn = getdbconnection()
-    c = conn.cursor()
-    c.execute("DELETE FROM ttrading WHERE id=?", (tradeid,))
-    conn.commit()
-    conn.close()
+@timed("db.deletetrade")
+def deletetrade(tradeid, wait=True):
+    fut = gettradewriter().submit(tradedeleteop, tradeid)
+    return waitwrite(fut) if wait else fut
 
 # -----------------------
 
-def updatetrade(tradeid, data: dict):
-    conn = getdbconnection()
-    c = conn.cursor()
-    c.execute("""UPDATE ttrading SET pair=?, type=?, lot=?, openprice=?, closeprice=?, takeprofit=?, stoploss=?, date=?, time=?, note=?, profitusd=?, profitidr=?, pips=?, updatedat=?
-                 WHERE id=?""",
+def tradeupdateop(conn, tradeid, data):
+    return conn.execute("""UPDATE ttrading SET pair=?1, type=?2, lot=?3, openprice=?4, closeprice=?5, takeprofit=?6, stoploss=?7, date=?8, time=?9, note=?10, profitusd=?11, profitidr=?12, pips=?13, updatedat=?14,
+                 paircode=(SELECT code FROM tpair WHERE pair=?1), isbuy=?2='BUY', tradeat=CAST(strftime('%s', ?8 || ' ' || ?9) AS INTEGER)
+                 WHERE id=?15""",
               (data['pair'], data['type'], data['lot'], data['openprice'], data['closeprice'],
                data.get('takeprofit'), data.get('stoploss'), data['date'], data['time'], data.get('note'),
-               data['profitusd'], data['profitidr'], data['pips'], datetime.utcnow().isoformat(), tradeid))
-    conn.commit()
-    conn.close()
+               data['profitusd'], data['profitidr'], data['pips'], datetime.utcnow().isoformat(), tradeid)).rowcount
+
+@timed("db.updatetrade")
+def updatetrade(tradeid, data: dict, wait=True):
+    fut = gettradewriter().submit(tradeupdateop, tradeid, data)
+    return waitwrite(fut) if wait else fut
 
 # -----------------------
 
+SETTINGSTTL = 60  # seconds; picks up changes made by other processes
+
+class SettingsCache:
+    """All of tsettings held in memory; setsetting() writes through and invalidates"""
+
+    def __init__(self, ttl=SETTINGSTTL):
+        self.ttl = ttl
+        self.values = None
+        self.loadedat = 0.0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if self.values is None or time.monotonic() - self.loadedat > self.ttl:
+                self.misses += 1
+                with getdb().read() as conn:
+                    self.values = dict(conn.execute("SELECT key, value FROM tsettings").fetchall())
+                self.loadedat = time.monotonic()
+            else:
+                self.hits += 1
+            return self.values.get(key)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'loaded': self.values is not None}
+
+    def invalidate(self):
+        with self.lock:
+            self.values = None
+
+@st.cache_resource
+def getsettingscachefor(path):
+    cache = SettingsCache()
+    getmetrics().register("settings", cache.stats)
+    return cache
+
+def getsettingscache():
+    return getsettingscachefor(DBPATH)
+
+@timed("db.getsetting", rows=None)
 def getsetting(key):
-    conn = getdbconnection()
-    c = conn.cursor()
-    c.execute("SELECT value FROM tsettings WHERE key=?", (key,))
-    r = c.fetchone()
-    conn.close()
-    return r[0] if r else None
+    return getsettingscache().get(key)
 
+@timed("db.setsetting")
 def setsetting(key, value):
-    conn = getdbconnection()
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO tsettings(key,value) VALUES (?,?)", (key, value))
-    conn.commit()
-    conn.close()
+    with getdb().transaction() as conn:
+        conn.execute("INSERT OR REPLACE INTO tsettings(key,value) VALUES (?,?)", (key, value))
+    getsettingscache().invalidate()
+
+# -----------------------
+# market prices: one provider per upstream, every pair of a provider fetched in one request
+
+PRICETTL = 5        # seconds a cached price counts as fresh
+PRICETIMEOUT = 5
+
+class PriceProvider:
+    """Fetches quotes for all of its pairs from one upstream in a single request"""
+    name = "base"
+    defaulturl = ""
+    symbols = {}  # pair -> upstream symbol
+
+    def __init__(self, baseurl=None, apikey="demo"):
+        self.baseurl = (baseurl or self.defaulturl).rstrip('/')
+        self.apikey = apikey
+
+    def fetch(self, session, pairs, timeout=PRICETIMEOUT):
+        """Return {pair: price} for whatever pairs the upstream answered"""
+        raise NotImplementedError
+
+class BinanceProvider(PriceProvider):
+    # Crypto via Binance using USDT pair
+    name = "binance"
+    defaulturl = "https://api.binance.com"
+    symbols = {"BTCUSD": "BTCUSDT", "ETHUSD": "ETHUSDT"}
+
+    def fetch(self, session, pairs, timeout=PRICETIMEOUT):
+        syms = [self.symbols[p] for p in pairs]
+        r = session.get(f"{self.baseurl}/api/v3/ticker/price",
+                        params={"symbols": json.dumps(syms, separators=(',', ':'))}, timeout=timeout)
+        if r.status_code != 200:
+            return {}
+        bysym = {d['symbol']: float(d['price']) for d in r.json()}
+        return {p: bysym[self.symbols[p]] for p in pairs if self.symbols[p] in bysym}
+
+class FMPProvider(PriceProvider):
+    # Commodities/index via FMP demo key
+    name = "fmp"
+    defaulturl = "https://financialmodelingprep.com"
+    symbols = {"XAUUSD": "XAUUSD", "USOIL": "WTIUSD", "USTEC": "NDX"}
+
+    def fetch(self, session, pairs, timeout=PRICETIMEOUT):
+        syms = ",".join(self.symbols[p] for p in pairs)
+        r = session.get(f"{self.baseurl}/api/v3/quote/{syms}", params={"apikey": self.apikey}, timeout=timeout)
+        data = r.json()
+        if not isinstance(data, list):
+            return {}
+        bysym = {d['symbol']: float(d['price']) for d in data if d.get('price') is not None}
+        return {p: bysym[self.symbols[p]] for p in pairs if self.symbols[p] in bysym}
+
+class TwelveDataProvider(PriceProvider):
+    # Forex via TwelveData demo
+    name = "twelvedata"
+    defaulturl = "https://api.twelvedata.com"
+    symbols = {"EURUSD": "EURUSD", "USDJPY": "USDJPY"}
+
+    def fetch(self, session, pairs, timeout=PRICETIMEOUT):
+        syms = [self.symbols[p] for p in pairs]
+        r = session.get(f"{self.baseurl}/price", params={"symbol": ",".join(syms), "apikey": self.apikey},
+                        timeout=timeout)
+        data = r.json()
+        # a single symbol comes back flat, several come back keyed by symbol
+        if len(syms) == 1:
+            data = {syms[0]: data}
+        out = {}
+        for p in pairs:
+            entry = data.get(self.symbols[p])
+            if isinstance(entry, dict) and entry.get('price'):
+                out[p] = float(entry['price'])
+        return out
+
+def defaultpriceproviders():
+    return [BinanceProvider(), FMPProvider(), TwelveDataProvider()]
+
+class PriceService:
+    """Stale-while-revalidate price cache over pluggable providers.
+
+    A fresh or stale cached price is returned immediately; stale entries kick
+    off one background refresh per provider. Only a cold pair blocks, and then
+    every provider is fetched concurrently over one pooled HTTP session.
+    """
+
+    def __init__(self, providers=None, ttl=PRICETTL, timeout=PRICETIMEOUT, session=None, store=None):
+        self.providers = defaultpriceproviders() if providers is None else providers
+        self.store = store  # optional TickStore that receives every fetched price
+        self.bypair = {pair: prov for prov in self.providers for pair in prov.symbols}
+        self.ttl = ttl
+        self.timeout = timeout
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=max(len(self.providers), 1), pool_maxsize=4)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        self.session = session
+        self.executor = ThreadPoolExecutor(max_workers=max(len(self.providers), 1), thread_name_prefix="pricefetch")
+        self.lock = threading.Lock()
+        self.cache = {}     # pair -> (price, fetchedat)
+        self.inflight = {}  # provider name -> Future
+        self.counters = {"hits": 0, "stale": 0, "misses": 0, "fetches": 0, "errors": 0}
+
+    def fetchprovider(self, provider):
+        try:
+            prices = provider.fetch(self.session, list(provider.symbols), self.timeout)
+        except Exception:
+            prices = {}
+        now = time.time()
+        with self.lock:
+            self.counters["fetches"] += 1
+            if not prices:
+                self.counters["errors"] += 1
+            for pair, price in prices.items():
+                self.cache[pair] = (price, now)
+        if self.store is not None:
+            for pair, price in prices.items():
+                self.store.append(pair, now, price)
+        return prices
+
+    def refresh(self, pairs=None):
+        """Start (or join an in-flight) refresh for the providers of pairs; returns their futures"""
+        pairs = list(self.bypair) if pairs is None else pairs
+        providers = {self.bypair[p].name: self.bypair[p] for p in pairs if p in self.bypair}
+        futs = {}
+        with self.lock:
+            for name, prov in providers.items():
+                fut = self.inflight.get(name)
+                if fut is None or fut.done():
+                    fut = self.executor.submit(self.fetchprovider, prov)
+                    self.inflight[name] = fut
+                futs[name] = fut
+        return futs
+
+    def peek(self, pair):
+        """(price, fetchedat) from cache without touching the network"""
+        with self.lock:
+            return self.cache.get(pair.upper())
+
+    def getmany(self, pairs):
+        pairs = [p.upper() for p in pairs]
+        now = time.time()
+        out, stale, cold = {}, [], []
+        with self.lock:
+            for pair in pairs:
+                entry = self.cache.get(pair)
+                if entry is None:
+                    cold.append(pair)
+                    self.counters["misses"] += 1
+                    continue
+                out[pair] = entry[0]
+                if now - entry[1] > self.ttl:
+                    stale.append(pair)
+                    self.counters["stale"] += 1
+                else:
+                    self.counters["hits"] += 1
+        if stale:
+            self.refresh(stale)
+        if cold:
+            # warm everything at once so the next cold pair does not block again
+            futs = self.refresh()
+            waitfutures(futs.values(), timeout=self.timeout + 1)
+            with self.lock:
+                for pair in cold:
+                    entry = self.cache.get(pair)
+                    out[pair] = entry[0] if entry else None
+        return {pair: out.get(pair) for pair in pairs}
+
+    def get(self, pair):
+        return self.getmany([pair])[pair.upper()]
+
+    def getall(self):
+        return self.getmany(list(self.bypair))
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, cached=len(self.cache))
+
+class ReplayProvider(PriceProvider):
+    """Offline provider that replays recorded prices, one step per fetch.
+
+    ticks is {pair: [price, ...]} or a CSV path with pair,price rows. When a
+    pair runs out of prices the last one is repeated (or it wraps if loop=True).
+    """
+    name = "replay"
+
+    def __init__(self, ticks, loop=False):
+        super().__init__(baseurl="replay://")
+        if isinstance(ticks, (str, os.PathLike)):
+            df = pd.read_csv(ticks)
+            ticks = {pair: grp['price'].astype(float).tolist() for pair, grp in df.groupby('pair', sort=False)}
+        self.ticks = {pair.upper(): list(prices) for pair, prices in ticks.items() if len(prices)}
+        self.symbols = {pair: pair for pair in self.ticks}
+        self.loop = loop
+        self.step = 0
+
+    def fetch(self, session, pairs, timeout=PRICETIMEOUT):
+        out = {}
+        for pair in pairs:
+            prices = self.ticks.get(pair)
+            if prices:
+                i = self.step % len(prices) if self.loop else min(self.step, len(prices) - 1)
+                out[pair] = prices[i]
+        self.step += 1
+        return out
 
 # -----------------------
-# st.cache_data(ttl=5)  # cache 5 seconds for market price
-@st.cache_data(ttl=5)
+# shared tick history, filled by one background feed for all sessions
+
+TICKBUFFERSIZE = 4096
+PRICEFEEDINTERVAL = 2.0  # seconds between polls of every provider
+
+class TickRing:
+    """Fixed-size ring buffer of (timestamp, price) ticks backed by NumPy arrays"""
+
+    def __init__(self, size=TICKBUFFERSIZE):
+        self.size = size
+        self.ts = np.zeros(size, dtype=np.float64)
+        self.px = np.zeros(size, dtype=np.float64)
+        self.count = 0  # total ticks ever appended
+        self.lock = threading.Lock()
+
+    def append(self, ts, price):
+        with self.lock:
+            i = self.count % self.size
+            self.ts[i] = ts
+            self.px[i] = price
+            self.count += 1
+
+    def latest(self):
+        with self.lock:
+            if not self.count:
+                return None
+            i = (self.count - 1) % self.size
+            return float(self.px[i]), float(self.ts[i])
+
+    def last(self, n):
+        """(timestamps, prices) of the last n ticks, oldest first (copies)"""
+        with self.lock:
+            n = min(n, self.count, self.size)
+            idx = (np.arange(self.count - n, self.count)) % self.size
+            return self.ts[idx], self.px[idx]
+
+class TickStore:
+    """Per-pair TickRing registry shared by every session in the process"""
+
+    def __init__(self, pairs=PAIROPTIONS, size=TICKBUFFERSIZE):
+        self.size = size
+        self.rings = {pair: TickRing(size) for pair in pairs}
+        self.lock = threading.Lock()
+
+    def ring(self, pair):
+        pair = pair.upper()
+        ring = self.rings.get(pair)
+        if ring is None:
+            with self.lock:
+                ring = self.rings.setdefault(pair, TickRing(self.size))
+        return ring
+
+    def append(self, pair, ts, price):
+        self.ring(pair).append(ts, price)
+
+    def latest(self, pair):
+        """(price, timestamp) of the newest tick, or None"""
+        ring = self.rings.get(pair.upper())
+        return ring.latest() if ring else None
+
+    def last(self, pair, n):
+        ring = self.rings.get(pair.upper())
+        if ring is None:
+            return np.zeros(0), np.zeros(0)
+        return ring.last(n)
+
+    def lastframe(self, pair, n):
+        ts, px = self.last(pair, n)
+        return pd.DataFrame({'time': pd.to_datetime(ts, unit='s'), 'price': px})
+
+    def snapshot(self):
+        return {pair: ring.latest() for pair, ring in self.rings.items()}
+
+class PriceFeed:
+    """Daemon thread that refreshes every provider of a PriceService on a fixed schedule"""
+
+    def __init__(self, service, interval=PRICEFEEDINTERVAL):
+        self.service = service
+        self.store = service.store
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.polls = 0
+        self.thread = threading.Thread(target=self.run, name="pricefeed", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def pollonce(self):
+        futs = self.service.refresh()
+        waitfutures(futs.values(), timeout=self.service.timeout + 1)
+        self.polls += 1
+
+    def run(self):
+        while not self.stopped.is_set():
+            started = time.monotonic()
+            try:
+                self.pollonce()
+            except Exception:
+                pass
+            self.stopped.wait(max(self.interval - (time.monotonic() - started), 0))
+
+    def stop(self, timeout=5):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+
+@st.cache_resource
+def getpriceservice():
+    service = PriceService(store=TickStore())
+    getmetrics().register("prices", service.stats)
+    return service
+
+@st.cache_resource
+def getpricefeed():
+    feed = PriceFeed(getpriceservice()).start()
+    atexit.register(feed.stop)
+    return feed
+
+def gettickstore():
+    return getpricefeed().store
+
+@timed("price.getmarketpriceapi")
 def getmarketpriceapi(pair):
-    pair = pair.upper()
+    """Latest price from the shared tick store; only blocks before the first tick"""
     try:
-        # -----------------------
-        if pair == "BTCUSD":
-            r = requests.get("https://api.binance.com/api/v3/ticker/price?symbol=BTCUSDT", timeout=5)
-            return float(r.json()['price']) if r.status_code == 200 else None
-        if pair == "ETHUSD":
-            r = requests.get("https://api.binance.com/api/v3/ticker/price?symbol=ETHUSDT", timeout=5)
-            return float(r.json()['price']) if r.status_code == 200 else None
-        # Crypto via Binance using USDT pair
-        
-        if pair == "XAUUSD":
-            r = requests.get("https://financialmodelingprep.com/api/v3/quote/XAUUSD?apikey=demo", timeout=5)
-            data = r.json()
-            return float(data[0]['price']) if isinstance(data, list) and len(data) > 0 else None
-        if pair == "USOIL":
-            r = requests.get("https://financialmodelingprep.com/api/v3/quote/WTIUSD?apikey=demo", timeout=5)
-            data = r.json()
-            return float(data[0]['price']) if isinstance(data, list) and len(data) > 0 else None
-        if pair == "USTEC":
-            r = requests.get("https://financialmodelingprep.com/api/v3/quote/NDX?apikey=demo", timeout=5)
-            data = r.json()
-            return float(data[0]['price']) if isinstance(data, list) and len(data) > 0 else None
-        # Commodities/index via FMP demo key
-        
-        if pair == "EURUSD":
-            r = requests.get("https://api.twelvedata.com/price?symbol=EURUSD&apikey=demo", timeout=5)
-            data = r.json()
-            return float(data.get('price')) if data.get('price') else None
-        if pair == "USDJPY":
-            r = requests.get("https://api.twelvedata.com/price?symbol=USDJPY&apikey=demo", timeout=5)
-            data = r.json()
-            return float(data.get('price')) if data.get('price') else None
+        tick = gettickstore().latest(pair)
+        if tick is not None:
+            return tick[0]
+        return getpriceservice().get(pair)
     except Exception:
         return None
-    return None
 
-# st.cache_data(ttl=3600)  # cache 1 hour for exchange rate
-@st.cache_data(ttl=3600)
-def getusdtoidr():
-    try:
-        r = requests.get("https://api.exchangerate.host/latest?base=USD&symbols=IDR", timeout=5)
-        data = r.json()
+# -----------------------
+# USD/IDR history: tfxrate keyed by date, served from memory; HTTP only refreshes the table
+
+FXRATETTL = 300              # seconds before the in-memory copy re-reads tfxrate
+FXREFRESHINTERVAL = 3600     # at most one background API refresh per hour
+FXTIMEOUT = 10
+FXLATESTURL = "https://api.exchangerate.host/latest?base=USD&symbols=IDR"
+FXSERIESURL = "https://api.exchangerate.host/timeseries?base=USD&symbols=IDR&start_date={start}&end_date={end}"
+FXSERIESDAYS = 365           # longest range the timeseries endpoint serves per request
+FXRATECOLUMNS = ["rate", "idr", "usdidr", "close"]
+
+class FxRateCache:
+    """All of tfxrate as sorted arrays; as-of lookups (latest rate on or before a date).
+
+    When the newest stored rate is older than today a background thread asks
+    the API for the missing days, so callers never wait on HTTP.
+    """
+
+    def __init__(self, ttl=FXRATETTL, autorefresh=True):
+        self.ttl = ttl
+        self.autorefresh = autorefresh
+        self.dates = None
+        self.rates = None
+        self.loadedat = 0.0
+        self.refreshedat = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        with self.lock:
+            if self.dates is None or time.monotonic() - self.loadedat > self.ttl:
+                self.misses += 1
+                with getdb().read() as conn:
+                    rows = conn.execute("SELECT date, rate FROM tfxrate ORDER BY date").fetchall()
+                self.dates = np.array([r[0] for r in rows], dtype='U10')
+                self.rates = np.array([r[1] for r in rows], dtype=float)
+                self.loadedat = time.monotonic()
+            else:
+                self.hits += 1
+            return self.dates, self.rates
+
+    def ratesfor(self, dates):
+        """As-of rate per 'YYYY-MM-DD' date; NaN where no rate precedes the date"""
+        known, rates = self.load()
+        dates = np.asarray(dates, dtype='U10')
+        idx = np.searchsorted(known, dates, side='right') - 1
+        out = np.full(len(dates), np.nan)
+        found = idx >= 0
+        out[found] = rates[idx[found]]
+        return out
+
+    def rate(self, date=None):
+        today = datetime.now().date().isoformat()
+        known, _ = self.load()
+        if self.autorefresh and (not len(known) or known[-1] < today):
+            self.refreshsoon(str(known[-1]) if len(known) else None)
+        value = self.ratesfor([str(date or today)[:10]])[0]
+        return None if np.isnan(value) else float(value)
+
+    def refreshsoon(self, newest):
+        with self.lock:
+            if self.refreshedat is not None and time.monotonic() - self.refreshedat < FXREFRESHINTERVAL:
+                return
+            self.refreshedat = time.monotonic()
+        threading.Thread(target=self.refresh, args=(newest,), name="fxrefresh", daemon=True).start()
+
+    def refresh(self, newest=None):
+        try:
+            rows = fetchfxrates(datefrom=newest)
+            if rows:
+                upsertfxrates(rows, "api")
+        except (requests.RequestException, ValueError, KeyError, sqlite3.Error):
+            pass  # keep serving what is stored; next attempt after FXREFRESHINTERVAL
+
+    def invalidate(self):
+        with self.lock:
+            self.dates = None
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'rates': 0 if self.dates is None else len(self.dates),
+                    'newest': None if self.dates is None or not len(self.dates) else str(self.dates[-1])}
+
+@st.cache_resource
+def getfxratecachefor(path):
+    cache = FxRateCache()
+    getmetrics().register("fxrates", cache.stats)
+    return cache
+
+def getfxratecache():
+    return getfxratecachefor(DBPATH)
+
+@timed("price.getusdtoidr")
+def getusdtoidr(date=None):
+    """USD/IDR as of date (default today) from the in-memory rate table; None if unknown"""
+    return getfxratecache().rate(date)
+
+def fetchfxrates(datefrom=None, dateto=None):
+    """[(date, rate)] from the exchange rate API: latest only, or a daily series for a range"""
+    if not datefrom:
+        data = requests.get(FXLATESTURL, timeout=FXTIMEOUT).json()
         rate = data.get('rates', {}).get('IDR')
-        return float(rate) if rate else None
-    except Exception:
-        return None
+        return [(data.get('date') or datetime.now().date().isoformat(), float(rate))] if rate else []
+    start = pd.Timestamp(datefrom).date()
+    end = pd.Timestamp(dateto).date() if dateto else datetime.now().date()
+    rows = []
+    while start <= end:
+        stop = min(start + pd.Timedelta(days=FXSERIESDAYS - 1), end)
+        data = requests.get(FXSERIESURL.format(start=start, end=stop), timeout=FXTIMEOUT).json()
+        rows += [(day, float(r['IDR'])) for day, r in sorted((data.get('rates') or {}).items()) if r.get('IDR')]
+        start = stop + pd.Timedelta(days=1)
+    return rows
+
+def loadfxrates(source, sep=None):
+    """[(date, rate)] from a CSV with a date column and a rate/idr/usdidr/close column"""
+    df = pd.read_csv(source, sep=sep or sniffdelimiter(source), dtype=str, skipinitialspace=True, encoding='utf-8-sig')
+    cols = {c.strip().lower(): c for c in df.columns}
+    if 'date' not in cols:
+        raise ValueError("rate file needs a 'date' column")
+    ratecol = next((cols[c] for c in FXRATECOLUMNS if c in cols), None)
+    if ratecol is None:
+        raise ValueError(f"rate file needs one of the columns: {', '.join(FXRATECOLUMNS)}")
+    dates = pd.to_datetime(df[cols['date']], errors='coerce')
+    rates = pd.to_numeric(df[ratecol].str.replace(',', '', regex=False), errors='coerce')
+    ok = dates.notna() & (rates > 0)
+    return list(zip(dates[ok].dt.strftime('%Y-%m-%d'), rates[ok].astype(float)))
+
+@timed("db.upsertfxrates", rows=lambda n: n)
+def upsertfxrates(rows, source="file"):
+    """Insert or replace (date, rate) rows; returns how many were written"""
+    now = datetime.utcnow().isoformat()
+    with getdb().transaction() as conn:
+        conn.executemany("INSERT INTO tfxrate(date, rate, source, updatedat) VALUES (?,?,?,?) "
+                         "ON CONFLICT(date) DO UPDATE SET rate=excluded.rate, source=excluded.source, "
+                         "updatedat=excluded.updatedat", [(str(d)[:10], float(r), source, now) for d, r in rows])
+    getfxratecache().invalidate()
+    return len(rows)
+
+def fxrevalueop(conn, datefrom=None, dateto=None):
+    """profitidr = profitusd * as-of rate of the trade date, in one UPDATE ... FROM.
+
+    Rows without a rate on or before their date, or already at the right value,
+    are left alone. Per-row triggers are deferred; the aggregates are rebuilt
+    once and every user's data version is bumped.
+    """
+    where, params = ["1"], []
+    if datefrom:
+        where.append("date >= ?")
+        params.append(str(datefrom))
+    if dateto:
+        where.append("date <= ?")
+        params.append(str(dateto))
+    conn.execute("INSERT INTO tstatsdefer(flag) VALUES (1)")
+    conn.execute(f"""
+        WITH daterate AS (
+            SELECT d.date, (SELECT f.rate FROM tfxrate f WHERE f.date <= d.date ORDER BY f.date DESC LIMIT 1) AS rate
+            FROM (SELECT DISTINCT date FROM ttrading WHERE {' AND '.join(where)}) d
+        )
+        UPDATE ttrading SET profitidr = ROUND(ttrading.profitusd * daterate.rate, 0), updatedat = ?
+        FROM daterate
+        WHERE ttrading.date = daterate.date AND daterate.rate IS NOT NULL AND ttrading.closeprice IS NOT NULL
+          AND ttrading.profitidr <> ROUND(ttrading.profitusd * daterate.rate, 0)""",
+        params + [datetime.utcnow().isoformat()])
+    updated = conn.execute("SELECT changes()").fetchone()[0]  # rowcount is -1 for WITH ... UPDATE
+    conn.execute("DELETE FROM tstatsdefer")
+    if updated:
+        statsrebuildop(conn)
+        conn.execute("UPDATE tuserversion SET version = version + 1")
+    return updated
+
+@timed("db.revaluetrades", rows=lambda n: n)
+def revaluetrades(datefrom=None, dateto=None):
+    """Re-price profitidr of stored trades from tfxrate (serialized with trade writes); returns rows changed"""
+    return gettradewriter().submit(fxrevalueop, datefrom, dateto).result()
+
 # Forex via TwelveData demo
 
 def calculatepips(pair, openprice, closeprice):
@@ -278,6 +1994,1245 @@ def calculateprofitusd(pair, openprice, closeprice, lot, position):
     return profit
 # fallback
 
+# -----------------------
+# vectorized P&L: same rules as calculatepips/calculateprofitusd, over whole columns
+
+PIPFACTOR = {"XAUUSD": 0.01, "USOIL": 0.01, "EURUSD": 0.0001, "USDJPY": 0.01,
+             "BTCUSD": 1.0, "ETHUSD": 1.0, "USTEC": 1.0}
+PAIRCODE = {pair: i for i, pair in enumerate(PAIROPTIONS)}
+# indexed by pair code; the extra last slot (code -1) is the fallback for unknown pairs
+PIPFACTORARRAY = np.array([PIPFACTOR.get(p, 1.0) for p in PAIROPTIONS] + [1.0])
+CONTRACTARRAY = np.array([float(CONTRACTSIZE.get(p, 1)) for p in PAIROPTIONS] + [1.0])
+RECALCCHUNKSIZE = 20000
+
+def paircodes(pairs):
+    """Map pair strings to int codes (-1 for pairs outside PAIROPTIONS)"""
+    return np.fromiter((PAIRCODE.get(str(p).upper(), -1) for p in pairs), dtype=np.int64, count=len(pairs))
+
+def calculatepipsvec(codes, openprice, closeprice):
+    return np.abs(np.asarray(closeprice, dtype=float) - np.asarray(openprice, dtype=float)) * PIPFACTORARRAY[codes]
+
+def calculateprofitusdvec(codes, openprice, closeprice, lot, isbuy):
+    openprice = np.asarray(openprice, dtype=float)
+    closeprice = np.asarray(closeprice, dtype=float)
+    diff = np.where(isbuy, closeprice - openprice, openprice - closeprice)
+    return diff * np.asarray(lot, dtype=float) * CONTRACTARRAY[codes]
+
+def roundvec(values, ndigits=0):
+    """np.round with the results of Python's round(), which the scalar path stores.
+
+    np.round scales, rounds half to even and scales back, so a value whose
+    scaled form is exactly .5 can round the other way (round(5.525, 2) is
+    5.53, np.round gives 5.52). Those exact ties are rare, and only they go
+    through round(); every other element rounds the same either way.
+    """
+    values = np.asarray(values, dtype=float)
+    scale = 10.0 ** ndigits
+    scaled = values * scale
+    out = np.rint(scaled) / scale
+    ties = np.flatnonzero(np.abs(scaled - np.trunc(scaled)) == 0.5)
+    if len(ties):
+        out = out.copy() if out.ndim else out
+        out.flat[ties] = [round(float(v), ndigits) for v in values.flat[ties]]
+    return out
+
+def calculatetradesvec(pairs, positions, lot, openprice, closeprice):
+    """(pips, profitusd) arrays for column inputs; positions are 'BUY'/'SELL' strings"""
+    codes = paircodes(pairs)
+    isbuy = np.asarray(positions) == "BUY"
+    return calculatepipsvec(codes, openprice, closeprice), calculateprofitusdvec(codes, openprice, closeprice, lot, isbuy)
+
+def traderecalcop(conn, params):
+    conn.executemany("UPDATE ttrading SET profitusd=?, profitidr=?, pips=?, updatedat=? WHERE id=?", params)
+    return len(params)
+
+@timed("db.recalculatetrades")
+def recalculatetrades(chunksize=RECALCCHUNKSIZE, rate=None, progress=None):
+    """Recompute pips/profitusd/profitidr for every stored trade, chunk by chunk.
+
+    profitidr keeps each row's original USD/IDR rate unless rate is given; rows
+    where that rate cannot be recovered (zero profit) use the current rate.
+    Only rows whose values change are written. Returns (scanned, updated).
+    """
+    fallbackrate = rate or getusdtoidr() or DEFAULTUSDIDR
+    scanned = updated = 0
+    lastid = 0
+    while True:
+        with getdb().read() as conn:
+            rows = conn.execute("""SELECT id, pair, type, lot, openprice, closeprice, profitusd, profitidr, pips
+                                   FROM ttrading WHERE id>? AND closeprice IS NOT NULL ORDER BY id LIMIT ?""",
+                                (lastid, chunksize)).fetchall()
+        if not rows:
+            break
+        cols = list(zip(*rows))
+        ids = np.array(cols[0], dtype=np.int64)
+        oldusd, oldidr, oldpips = (np.array(c, dtype=float) for c in cols[6:9])
+        pips, profitusd = calculatetradesvec(cols[1], cols[2], cols[3], cols[4], cols[5])
+        pips = roundvec(pips, 4)
+        profitusd = roundvec(profitusd, 2)
+        if rate:
+            rowrate = np.full(len(rows), float(rate))
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rowrate = np.where(oldusd != 0, oldidr / oldusd, fallbackrate)
+        profitidr = roundvec(profitusd * rowrate, 0)
+        changed = (pips != oldpips) | (profitusd != oldusd) | (profitidr != oldidr)
+        if changed.any():
+            now = datetime.utcnow().isoformat()
+            params = [(float(u), float(r), float(p), now, int(i)) for u, r, p, i in
+                      zip(profitusd[changed], profitidr[changed], pips[changed], ids[changed])]
+            updated += gettradewriter().submit(traderecalcop, params).result()
+        scanned += len(rows)
+        lastid = int(ids[-1])
+        if progress:
+            progress(scanned, updated)
+    return scanned, updated
+
+# -----------------------
+# open positions: closeprice is NULL until closed; unrealized P&L is marked to the latest tick
+
+MTMCOLUMNS = ['id', 'userid', 'pair', 'type', 'lot', 'openprice', 'price', 'pips', 'profitusd', 'profitidr',
+              'date', 'time']
+
+def openposition(data: dict, wait=True):
+    """Insert a trade without close price; profit stays 0 until closeposition()"""
+    data = dict(data, closeprice=None, profitusd=0.0, profitidr=0.0, pips=0.0)
+    return inserttradedata(data, wait=wait)
+
+def positioncloseop(conn, tradeid, closeprice, pips, profitusd, profitidr):
+    # the closeprice IS NULL guard makes a second close (other tab, other session) a no-op
+    return conn.execute("""UPDATE ttrading SET closeprice=?, pips=?, profitusd=?, profitidr=?, updatedat=?
+                           WHERE id=? AND closeprice IS NULL""",
+                        (closeprice, pips, profitusd, profitidr, datetime.utcnow().isoformat(), tradeid)).rowcount
+
+@timed("db.closeposition", rows=None)
+def closeposition(tradeid, closeprice, userid=None):
+    """Realize an open position at closeprice; returns False if it is not open (or not the user's)"""
+    with getdb().read() as conn:
+        row = conn.execute("SELECT userid, pair, type, lot, openprice, date FROM ttrading WHERE id=? AND closeprice IS NULL",
+                           (tradeid,)).fetchone()
+    if row is None or (userid is not None and row['userid'] != userid):
+        return False
+    pips = calculatepips(row['pair'], row['openprice'], closeprice)
+    profitusd = calculateprofitusd(row['pair'], row['openprice'], closeprice, row['lot'], row['type'])
+    rate = getusdtoidr(row['date']) or DEFAULTUSDIDR
+    return bool(waitwrite(gettradewriter().submit(positioncloseop, tradeid, closeprice, round(pips, 4),
+                                                  round(profitusd, 2), round(profitusd * rate, 0))))
+
+class MarkToMarket:
+    """Unrealized pips/profit of every open position, computed in one vectorized pass.
+
+    The open set is held as arrays and only re-read when tpositionversion moves;
+    the last result is reused until either that version or one of the latest
+    prices changes, so idle reruns cost one primary-key read.
+    """
+
+    def __init__(self, pricefn=None):
+        self.pricefn = pricefn or getmarketpriceapi
+        self.version = None
+        self.positions = None  # dict of column arrays, id order
+        self.pairs = []        # distinct pairs of the open set; positions['pairindex'] points here
+        self.key = None
+        self.frame = pd.DataFrame(columns=MTMCOLUMNS)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.recomputes = 0
+        self.reloads = 0
+
+    def positionversion(self):
+        with getdb().read() as conn:
+            r = conn.execute("SELECT version FROM tpositionversion WHERE id = 0").fetchone()
+        return r[0] if r else 0
+
+    def reload(self, version):
+        with getdb().read() as conn:
+            rows = conn.execute("""SELECT id, userid, pair, type, lot, openprice, date, time FROM ttrading
+                                   WHERE closeprice IS NULL ORDER BY id""").fetchall()
+        cols = list(zip(*rows)) or [()] * 8
+        pairs = np.array(cols[2], dtype=object)
+        self.pairs, pairindex = np.unique(pairs, return_inverse=True)
+        self.positions = {
+            'id': np.array(cols[0], dtype=np.int64), 'userid': np.array(cols[1], dtype=np.int64),
+            'pair': pairs, 'type': np.array(cols[3], dtype=object),
+            'code': paircodes(pairs), 'isbuy': np.array(cols[3], dtype=object) == "BUY",
+            'lot': np.array(cols[4], dtype=float), 'openprice': np.array(cols[5], dtype=float),
+            'date': np.array(cols[6], dtype=object), 'time': np.array(cols[7], dtype=object),
+            'pairindex': np.asarray(pairindex, dtype=np.int64),
+        }
+        self.version = version
+        self.reloads += 1
+
+    def mark(self):
+        """DataFrame (MTMCOLUMNS) of all open positions at the latest price; price NaN when unknown"""
+        version = self.positionversion()
+        with self.lock:
+            if version != self.version:
+                self.reload(version)
+            prices = np.array([self.pricefn(p) or np.nan for p in self.pairs], dtype=float)
+            key = (version, prices.tobytes())
+            if key == self.key:
+                self.hits += 1
+                return self.frame
+            pos = self.positions
+            price = prices[pos['pairindex']] if len(prices) else np.zeros(0)
+            pips = calculatepipsvec(pos['code'], pos['openprice'], price)
+            profitusd = calculateprofitusdvec(pos['code'], pos['openprice'], price, pos['lot'], pos['isbuy'])
+            rate = getusdtoidr() or DEFAULTUSDIDR
+            self.frame = pd.DataFrame({
+                'id': pos['id'], 'userid': pos['userid'], 'pair': pos['pair'], 'type': pos['type'],
+                'lot': pos['lot'], 'openprice': pos['openprice'], 'price': price,
+                'pips': roundvec(pips, 4), 'profitusd': roundvec(profitusd, 2),
+                'profitidr': roundvec(profitusd * rate, 0), 'date': pos['date'], 'time': pos['time'],
+            }, columns=MTMCOLUMNS)
+            self.key = key
+            self.recomputes += 1
+            return self.frame
+
+    def foruser(self, userid=None):
+        """mark() restricted to one user (None: everyone)"""
+        frame = self.mark()
+        if userid is None:
+            return frame
+        return frame[frame['userid'].to_numpy() == userid].reset_index(drop=True)
+
+    def invalidate(self):
+        with self.lock:
+            self.version = self.key = None
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.recomputes, 'reloads': self.reloads,
+                    'positions': 0 if self.positions is None else len(self.positions['id'])}
+
+@st.cache_resource
+def getmarktomarketfor(path):
+    engine = MarkToMarket()
+    getmetrics().register("marktomarket", engine.stats)
+    return engine
+
+def getmarktomarket():
+    return getmarktomarketfor(DBPATH)
+
+@timed("price.openpositions")
+def openpositions(userid=None):
+    """Open positions with live unrealized pips/profit (shared engine, see MarkToMarket)"""
+    return getmarktomarket().foruser(userid)
+
+# -----------------------
+# TP/SL replay: OHLC candles per pair as memory-mapped .npy columns, trades replayed in vectorized batches
+
+CANDLEDIR = os.environ.get("TRADINGAPP_CANDLEDIR", "candles")
+CANDLEFIELDS = ("ts", "open", "high", "low", "close")  # ts: candle open time, epoch seconds
+CANDLEBLOCK = 256            # candles per block of the max-high / min-low summaries
+REPLAYBATCHSIZE = 50000      # trades per fetchmany batch
+REPLAYCHUNK = 4096           # trades per gather matrix (REPLAYCHUNK x CANDLEBLOCK values)
+REPLAYBLOCKSCAN = 64         # summary blocks examined per step when looking for the hit block
+REPLAYHORIZON = 30 * 86400   # seconds after the open searched for a TP/SL hit
+REPLAYOUTCOMES = ["nodata", "none", "tp", "sl"]
+REPLAYCOLUMNS = ['id', 'userid', 'pair', 'type', 'lot', 'openprice', 'closeprice', 'takeprofit', 'stoploss',
+                 'outcome', 'ambiguous', 'hitat', 'exitprice', 'profitusd', 'replayusd', 'diffusd']
+
+class CandleStore:
+    """OHLC candles per pair under root/<PAIR>/<field>.npy, opened with mmap_mode='r'.
+
+    Block summaries (max high / min low per CANDLEBLOCK candles) are built on
+    first use and kept with the maps until the ts file changes on disk.
+    """
+
+    def __init__(self, root=CANDLEDIR, block=CANDLEBLOCK):
+        self.root = root
+        self.block = block
+        self.loaded = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, pair, field):
+        return os.path.join(self.root, pair.upper(), f"{field}.npy")
+
+    def pairs(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(d for d in os.listdir(self.root) if os.path.exists(self.path(d, "ts")))
+
+    def load(self, pair):
+        """dict of field arrays plus blockhigh/blocklow, or None when the pair has no candles"""
+        pair = pair.upper()
+        try:
+            stamp = os.stat(self.path(pair, "ts")).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            cached = self.loaded.get(pair)
+            if cached is not None and cached['stamp'] == stamp:
+                self.hits += 1
+                return cached
+            self.misses += 1
+            data = {f: np.load(self.path(pair, f), mmap_mode='r') for f in CANDLEFIELDS}
+            starts = np.arange(0, len(data['ts']), self.block)
+            data['blockhigh'] = np.maximum.reduceat(data['high'], starts) if len(starts) else np.zeros(0)
+            data['blocklow'] = np.minimum.reduceat(data['low'], starts) if len(starts) else np.zeros(0)
+            data['stamp'] = stamp
+            self.loaded[pair] = data
+            return data
+
+    def write(self, pair, ts, open_, high, low, close):
+        """Merge candles into the pair's files (a repeated ts replaces the stored candle); returns the total"""
+        pair = pair.upper()
+        old = self.load(pair)
+        cols = [np.asarray(v, dtype=np.int64 if f == "ts" else np.float64)
+                for f, v in zip(CANDLEFIELDS, (ts, open_, high, low, close))]
+        if old is not None:
+            cols = [np.concatenate([np.asarray(old[f]), c]) for f, c in zip(CANDLEFIELDS, cols)]
+        order = np.argsort(cols[0], kind='stable')
+        cols = [c[order] for c in cols]
+        keep = np.append(cols[0][1:] != cols[0][:-1], True)  # last of equal ts = the newer file
+        os.makedirs(os.path.join(self.root, pair), exist_ok=True)
+        with self.lock:
+            self.loaded.pop(pair, None)
+            # ts goes last: its mtime is what readers compare
+            for f, c in sorted(zip(CANDLEFIELDS, cols), key=lambda fc: fc[0] == "ts"):
+                tmp = self.path(pair, f) + ".tmp"
+                with open(tmp, "wb") as fh:
+                    np.save(fh, c[keep])
+                os.replace(tmp, self.path(pair, f))
+        return int(keep.sum())
+
+    def describe(self):
+        """[{pair, candles, first, last}] of what is stored"""
+        out = []
+        for pair in self.pairs():
+            data = self.load(pair)
+            ts = data['ts']
+            out.append({'pair': pair, 'candles': len(ts),
+                        'first': datetime.utcfromtimestamp(int(ts[0])).isoformat(' ') if len(ts) else None,
+                        'last': datetime.utcfromtimestamp(int(ts[-1])).isoformat(' ') if len(ts) else None})
+        return out
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'pairs': len(self.loaded)}
+
+@st.cache_resource
+def getcandlestorefor(root):
+    store = CandleStore(root)
+    getmetrics().register("candles", store.stats)
+    return store
+
+def getcandlestore():
+    return getcandlestorefor(CANDLEDIR)
+
+def loadcandlefile(source, sep=None):
+    """(ts, open, high, low, close) arrays from a candle CSV.
+
+    Accepts a header with time/datetime/timestamp (or date + time) and
+    open/high/low/close columns, or header-less MT4/MT5 history exports
+    (date,time,o,h,l,c[,volume] or datetime,o,h,l,c[,volume]). Times are
+    taken as UTC, like tradeat.
+    """
+    df = pd.read_csv(source, sep=sep or sniffdelimiter(source), dtype=str, header=None,
+                     skipinitialspace=True, encoding='utf-8-sig')
+    header = [re.sub(r'[^a-z]', '', str(v).lower()) for v in df.iloc[0]] if len(df) else []
+    if "open" in header:
+        df = df.iloc[1:]
+        df.columns = header
+    else:
+        splittime = df.shape[1] > 1 and df[1].astype(str).str.match(r'^\d{1,2}:\d{2}').all()
+        names = (["date", "time"] if splittime else ["time"]) + ["open", "high", "low", "close"]
+        df.columns = (names + [f"extra{i}" for i in range(df.shape[1])])[:df.shape[1]]
+    missing = [c for c in ("open", "high", "low", "close") if c not in df.columns]
+    if missing:
+        raise ValueError(f"candle file needs the columns: {', '.join(missing)}")
+    if "date" in df.columns and "time" in df.columns:
+        when = df["date"].astype(str) + " " + df["time"].astype(str)
+    else:
+        col = next((c for c in ("time", "datetime", "timestamp", "date") if c in df.columns), None)
+        if col is None:
+            raise ValueError("candle file needs a time, datetime, timestamp or date column")
+        when = df[col].astype(str)
+    epoch = pd.to_numeric(when, errors='coerce')
+    if epoch.notna().all():
+        ts = np.where(epoch > 1e11, epoch // 1000, epoch).astype(np.int64)  # milliseconds -> seconds
+    else:
+        parsed = pd.to_datetime(when.str.replace(r'^(\d{4})\.(\d{2})\.(\d{2})', r'\1-\2-\3', regex=True),
+                                errors='coerce', format='mixed')
+        ok = parsed.notna().to_numpy()
+        ts = np.full(len(df), np.iinfo(np.int64).min)
+        ts[ok] = parsed[ok].to_numpy().astype('datetime64[s]').astype(np.int64)
+    o, h, l, c = (pd.to_numeric(df[f], errors='coerce').to_numpy(dtype=float) for f in ("open", "high", "low", "close"))
+    ok = (ts != np.iinfo(np.int64).min) & np.isfinite(o) & np.isfinite(c) & (h >= l)
+    return ts[ok], o[ok], h[ok], l[ok], c[ok]
+
+@timed("price.importcandles", rows=lambda n: n)
+def importcandles(source, pair, sep=None, store=None):
+    """Load a candle CSV into the store for pair; returns the number of candles read"""
+    pair = normalizepair(pair) or str(pair).upper()
+    ts, o, h, l, c = loadcandlefile(source, sep)
+    (store or getcandlestore()).write(pair, ts, o, h, l, c)
+    return len(ts)
+
+def scancandles(values, start, stop, barrier, cross, out, rows):
+    """Check candles [start, stop) (at most one block each); sets out[rows] at the first crossing"""
+    idx = start[:, None] + np.arange(CANDLEBLOCK)
+    hit = cross(values[np.minimum(idx, len(values) - 1)], barrier[:, None]) & (idx < stop[:, None])
+    found = hit.any(axis=1)
+    out[rows[found]] = start[found] + hit[found].argmax(axis=1)
+    return found
+
+def firstcross(candles, field, start, end, barrier, above):
+    """Index of the first candle in [start, end) whose high (above) / low (below) crosses barrier; end if none.
+
+    Vectorized over trades: the rest of each start block is checked candle by
+    candle, then the block summaries find the first block that crosses and
+    only that block is scanned again.
+    """
+    values = candles[field]
+    blocks = candles['blockhigh' if above else 'blocklow']
+    cross = np.greater_equal if above else np.less_equal
+    out = end.copy()
+    if not len(values):
+        return out
+    rows = np.arange(len(start))
+    stop = np.minimum(end, (start // CANDLEBLOCK + 1) * CANDLEBLOCK)
+    found = scancandles(values, start, stop, barrier, cross, out, rows)
+    pending = rows[~found & (stop < end)]
+    nextblock = stop[pending] // CANDLEBLOCK
+    step = np.arange(REPLAYBLOCKSCAN)
+    while len(pending):
+        bidx = nextblock[:, None] + step
+        valid = bidx * CANDLEBLOCK < end[pending, None]
+        hit = cross(blocks[np.minimum(bidx, len(blocks) - 1)], barrier[pending, None]) & valid
+        inblock = hit.any(axis=1)
+        if inblock.any():
+            first = bidx[inblock, hit[inblock].argmax(axis=1)]
+            rowsin = pending[inblock]
+            # a crossing past end inside the last (partial) block leaves out at end
+            scancandles(values, first * CANDLEBLOCK, np.minimum(end[rowsin], (first + 1) * CANDLEBLOCK),
+                        barrier[rowsin], cross, out, rowsin)
+        more = ~inblock & valid[:, -1]
+        pending, nextblock = pending[more], nextblock[more] + REPLAYBLOCKSCAN
+    return out
+
+def replaycandles(candles, tradeat, isbuy, takeprofit, stoploss, horizon=REPLAYHORIZON):
+    """(outcome codes, hit time, exit price, ambiguous) for trades of one pair; exit is NaN unless TP/SL hit.
+
+    A candle that crosses both levels counts as SL (the conservative reading of
+    OHLC data) and is flagged ambiguous; a gap through a level fills at the
+    candle open.
+    """
+    ts = candles['ts']
+    n = len(ts)
+    start = np.searchsorted(ts, tradeat, side='left')
+    end = np.searchsorted(ts, tradeat + horizon, side='right')
+    # BUY: TP above / SL below the entry; SELL the other way round
+    up = np.where(isbuy, takeprofit, stoploss)
+    down = np.where(isbuy, stoploss, takeprofit)
+    iup, idown = end.copy(), end.copy()
+    for lo in range(0, len(start), REPLAYCHUNK):
+        for barrier, out, field, above in ((up, iup, 'high', True), (down, idown, 'low', False)):
+            rows = lo + np.flatnonzero(np.isfinite(barrier[lo:lo + REPLAYCHUNK]))
+            if len(rows):
+                out[rows] = firstcross(candles, field, start[rows], end[rows], barrier[rows], above)
+    tpidx = np.where(isbuy, iup, idown)
+    slidx = np.where(isbuy, idown, iup)
+    hit = np.minimum(tpidx, slidx)
+    nodata = (start >= n) | (tradeat < ts[0]) if n else np.ones(len(start), dtype=bool)
+    hashit = (hit < end) & ~nodata
+    outcome = np.where(nodata, 0, np.where(hashit, np.where(slidx <= tpidx, 3, 2), 1))
+    at = np.minimum(hit, max(n - 1, 0))
+    candleopen = np.asarray(candles['open'])[at] if n else np.full(len(hit), np.nan)
+    uphit = (outcome == 2) == isbuy
+    exitprice = np.where(hashit, np.where(uphit, np.fmax(up, candleopen), np.fmin(down, candleopen)), np.nan)
+    hitat = np.where(hashit, ts[at] if n else 0, np.iinfo(np.int64).min)
+    return outcome, hitat, exitprice, hashit & (tpidx == slidx)
+
+def replaybatch(store, pairs, ids, userids, codes, isbuy, tradeat, lot, openprice, closeprice, takeprofit,
+                stoploss, profitusd, horizon=REPLAYHORIZON):
+    """Replay one batch of trades (column arrays), pair by pair; returns a dict of REPLAYCOLUMNS arrays"""
+    labels = dict(pairs)
+    outcome = np.zeros(len(ids), dtype=np.int8)
+    hitat = np.full(len(ids), np.iinfo(np.int64).min)
+    exitprice = np.full(len(ids), np.nan)
+    ambiguous = np.zeros(len(ids), dtype=bool)
+    for code in np.unique(codes):
+        candles = store.load(labels.get(int(code), ""))
+        if candles is None:
+            continue
+        rows = np.flatnonzero(codes == code)
+        outcome[rows], hitat[rows], exitprice[rows], ambiguous[rows] = replaycandles(
+            candles, tradeat[rows], isbuy[rows], takeprofit[rows], stoploss[rows], horizon)
+    # neither level hit: the trade closed where it actually did
+    exitprice = np.where(outcome == 1, closeprice, exitprice)
+    contract = np.where(codes < len(PAIROPTIONS), codes, -1)
+    replayusd = roundvec(calculateprofitusdvec(contract, openprice, exitprice, lot, isbuy), 2)
+    return {'id': ids, 'userid': userids, 'paircode': codes, 'isbuy': isbuy, 'lot': lot, 'openprice': openprice,
+            'closeprice': closeprice, 'takeprofit': takeprofit, 'stoploss': stoploss, 'outcome': outcome,
+            'ambiguous': ambiguous, 'hitat': hitat, 'exitprice': exitprice, 'profitusd': profitusd,
+            'replayusd': replayusd}
+
+@timed("analytics.replaytrades")
+def replaytrades(userid=None, allifadmin=False, store=None, horizon=REPLAYHORIZON, batchsize=REPLAYBATCHSIZE,
+                 progress=None, **filters):
+    """Replay every closed trade with a TP and/or SL against the candle store.
+
+    Returns a REPLAYCOLUMNS frame: outcome is tp / sl (hit first within
+    horizon seconds of the open), none (neither hit, so the actual close
+    stands) or nodata (no candles cover the open). replayusd is the P&L had
+    the order run to its TP/SL, with the CONTRACTSIZE rules of the form.
+    Trades are read in id order with fetchmany and replayed per pair, one
+    batch at a time.
+    """
+    store = store or getcandlestore()
+    where, params = tradefiltersql(userid, allifadmin, **filters)
+    where += ["t.closeprice IS NOT NULL", "(t.takeprofit IS NOT NULL OR t.stoploss IS NOT NULL)"]
+    sql = (f"SELECT t.id, t.userid, t.paircode, t.isbuy, {TRADEFRAMECOLUMNS['tradeat'][0]}, t.lot, t.openprice, "
+           f"t.closeprice, t.takeprofit, t.stoploss, t.profitusd FROM ttrading t WHERE {' AND '.join(where)} ORDER BY t.id")
+    dtypes = (np.int64, np.int64, np.int64, np.bool_, np.int64) + (np.float64,) * 6
+    parts = []
+    done = 0
+    with getdb().read() as conn:
+        pairs = conn.execute("SELECT code, pair FROM tpair ORDER BY code").fetchall()
+        cur = conn.cursor()
+        cur.row_factory = None
+        cur.arraysize = batchsize
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany()
+            if not rows:
+                break
+            cols = [np.array(v, dtype=d) for v, d in zip(zip(*rows), dtypes)]
+            parts.append(replaybatch(store, pairs, *cols, horizon=horizon))
+            done += len(rows)
+            if progress:
+                progress(done)
+    if not parts:
+        parts.append(replaybatch(store, pairs, *(np.zeros(0, dtype=d) for d in dtypes), horizon=horizon))
+    data = {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+    return pd.DataFrame({
+        'id': data['id'], 'userid': data['userid'],
+        'pair': codecategorical(data['paircode'], pairs),
+        'type': pd.Categorical.from_codes(data['isbuy'].astype(np.int8), ["SELL", "BUY"]),
+        'lot': data['lot'], 'openprice': data['openprice'], 'closeprice': data['closeprice'],
+        'takeprofit': data['takeprofit'], 'stoploss': data['stoploss'],
+        'outcome': pd.Categorical.from_codes(data['outcome'].astype(np.int8), REPLAYOUTCOMES),
+        'ambiguous': data['ambiguous'].astype(bool),
+        'hitat': data['hitat'].astype('datetime64[s]'),
+        'exitprice': data['exitprice'], 'profitusd': data['profitusd'], 'replayusd': data['replayusd'],
+        'diffusd': np.round(data['replayusd'] - data['profitusd'], 2),
+    }, columns=REPLAYCOLUMNS)
+
+def replaysummary(df):
+    """Per outcome: trades, actual and replayed profit (nodata rows carry no replayed profit)"""
+    return (df.groupby('outcome', observed=False)
+              .agg(trades=('id', 'size'), ambiguous=('ambiguous', 'sum'),
+                   profitusd=('profitusd', 'sum'), replayusd=('replayusd', 'sum'))
+              .reset_index())
+
+# -----------------------
+# bulk import from CSV / MT4-MT5 statement exports
+
+IMPORTCHUNKSIZE = 50000
+IMPORTMAXERRORS = 1000
+IMPORTNAVALUES = {"", "NA", "N/A", "NaN", "nan", "NULL", "null"}  # read as missing, like pandas
+# normalized header (lowercase, alphanumerics only) -> field; pandas renames
+# duplicate MT headers to "Price.1"/"Time.1", i.e. the close columns
+IMPORTCOLUMNS = {
+    "pair": "pair", "symbol": "pair", "item": "pair", "instrument": "pair",
+    "type": "type", "side": "type", "direction": "type",
+    "lot": "lot", "lots": "lot", "size": "lot", "volume": "lot",
+    "openprice": "openprice", "priceopen": "openprice", "price": "openprice", "entryprice": "openprice",
+    "closeprice": "closeprice", "priceclose": "closeprice", "price1": "closeprice", "exitprice": "closeprice",
+    "takeprofit": "takeprofit", "tp": "takeprofit",
+    "stoploss": "stoploss", "sl": "stoploss",
+    "date": "date", "opendate": "date",
+    "time": "time", "opentime": "opentime", "timeopen": "opentime", "datetime": "opentime",
+    "note": "note", "notes": "note", "comment": "note",
+}
+PAIRALIASES = {
+    "GOLD": "XAUUSD", "BTCUSDT": "BTCUSD", "ETHUSDT": "ETHUSD", "NAS100": "USTEC", "US100": "USTEC",
+    "NDX": "USTEC", "WTI": "USOIL", "WTIUSD": "USOIL", "XTIUSD": "USOIL", "USOUSD": "USOIL",
+}
+
+def normalizepair(value):
+    """Map broker symbols (suffixes, aliases) onto PAIROPTIONS; None when unknown"""
+    sym = re.sub(r'[^A-Z0-9]', '', str(value).upper())
+    if sym in PAIRCODE:
+        return sym
+    if sym in PAIRALIASES:
+        return PAIRALIASES[sym]
+    # broker suffixes such as XAUUSDm / EURUSD.a / BTCUSDT.pro
+    for known in list(PAIROPTIONS) + list(PAIRALIASES):
+        if sym.startswith(known):
+            return PAIRALIASES.get(known, known)
+    return None
+
+def normalizetype(value):
+    t = str(value).strip().upper()
+    if t in ("BUY", "LONG", "B", "0"):
+        return "BUY"
+    if t in ("SELL", "SHORT", "S", "1"):
+        return "SELL"
+    return None
+
+def sniffdelimiter(source):
+    """Guess , ; or tab from the first line of a path or seekable file object"""
+    try:
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, newline='', encoding='utf-8-sig', errors='replace') as f:
+                head = f.readline()
+        else:
+            pos = source.tell()
+            head = source.readline()
+            source.seek(pos)
+            if isinstance(head, bytes):
+                head = head.decode('utf-8-sig', errors='replace')
+        return csv.Sniffer().sniff(head, delimiters=",;\t").delimiter
+    except (csv.Error, OSError, AttributeError):
+        return ","
+
+def importcolumnmap(columns):
+    mapping = {}
+    for col in columns:
+        field = IMPORTCOLUMNS.get(re.sub(r'[^a-z0-9]', '', str(col).lower()))
+        if field and field not in mapping.values():
+            mapping[col] = field
+    return mapping
+
+def mangleheader(header):
+    """Suffix repeated header names .1, .2 ... the way pandas does (MT statements repeat Price/Time)"""
+    seen = {}
+    columns = []
+    for col in header:
+        n = seen.get(col, 0)
+        seen[col] = n + 1
+        columns.append(col if n == 0 else f"{col}.{n}")
+    return columns
+
+def readimportchunks(source, sep, chunksize=IMPORTCHUNKSIZE):
+    """Yield (raw chunk, line numbers, malformed [(line, message)]) from a path or file object.
+
+    csv.reader knows the physical line each record starts on (quoted fields
+    may span lines), so every error names its real line; records with more
+    fields than the header are reported instead of being dropped.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        f = open(source, newline='', encoding='utf-8-sig', errors='replace')
+        release = f.close
+    elif isinstance(source.read(0), bytes):
+        f = io.TextIOWrapper(source, encoding='utf-8-sig', errors='replace', newline='')
+        release = f.detach  # leave the caller's file open
+    else:
+        f, release = source, None
+    try:
+        reader = csv.reader(f, delimiter=sep, skipinitialspace=True)
+        header = next((r for r in reader if r), None)
+        if header is None:
+            return
+        columns = mangleheader(header)
+        rows, lines, malformed = [], [], []
+        start = reader.line_num + 1
+        for record in reader:
+            if record:
+                if len(record) > len(columns):
+                    malformed.append((start, f"expected {len(columns)} fields, got {len(record)}"))
+                else:
+                    rows.append(record)
+                    lines.append(start)
+            start = reader.line_num + 1
+            if len(rows) + len(malformed) >= chunksize:
+                yield importframe(rows, columns), np.array(lines, dtype=np.int64), malformed
+                rows, lines, malformed = [], [], []
+        if rows or malformed:
+            yield importframe(rows, columns), np.array(lines, dtype=np.int64), malformed
+    finally:
+        if release:
+            release()
+
+def importframe(rows, columns):
+    chunk = pd.DataFrame(rows, columns=columns, dtype=object)
+    return chunk.mask(chunk.isin(IMPORTNAVALUES))
+
+def prepareimportchunk(chunk, lines, maxerrors=IMPORTMAXERRORS):
+    """Normalize one raw chunk (lines: file line of each row); returns (valid DataFrame, bad row count, [(line, message), ...])"""
+    chunk = chunk.rename(columns=importcolumnmap(chunk.columns))
+    n = len(chunk)
+    empty = pd.Series([None] * n, index=chunk.index, dtype=object)
+    
+    def numeric(col):
+        if col not in chunk:
+            return pd.Series(np.nan, index=chunk.index)
+        return pd.to_numeric(chunk[col].astype(str).str.replace(r'\s', '', regex=True), errors='coerce')
+    
+    # map the few distinct symbol/type spellings once instead of per row
+    rawpair = chunk.get('pair', empty)
+    pair = rawpair.map({v: normalizepair(v) for v in rawpair.dropna().unique()})
+    rawtype = chunk.get('type', empty)
+    position = rawtype.map({v: normalizetype(v) for v in rawtype.dropna().unique()})
+    lot, openprice, closeprice = numeric('lot'), numeric('openprice'), numeric('closeprice')
+    takeprofit, stoploss = numeric('takeprofit'), numeric('stoploss')
+    if 'date' in chunk:
+        when = chunk['date'].astype(str) + ' ' + chunk.get('time', pd.Series('00:00:00', index=chunk.index)).astype(str)
+    else:
+        when = chunk.get('opentime', chunk.get('time', empty)).astype(str)
+    when = pd.to_datetime(when.str.replace('.', '-', regex=False), errors='coerce')
+    
+    checks = [
+        (pair.isna(), "unknown pair", rawpair),
+        (position.isna(), "type must be BUY or SELL", rawtype),
+        (~(lot > 0), "lot must be > 0", chunk.get('lot', empty)),
+        (~(openprice > 0), "open price must be > 0", chunk.get('openprice', empty)),
+        (~(closeprice > 0), "close price must be > 0", chunk.get('closeprice', empty)),
+        (when.isna(), "invalid date/time", when),
+    ]
+    bad = np.zeros(n, dtype=bool)
+    errors = []
+    for mask, message, raw in checks:
+        mask = mask.to_numpy()
+        for i in np.flatnonzero(mask & ~bad)[:max(maxerrors - len(errors), 0)]:
+            errors.append((int(lines[i]), f"{message} ({raw.iloc[i]!r})"))
+        bad |= mask
+    ok = ~bad
+    valid = pd.DataFrame({
+        'pair': pair[ok].to_numpy(), 'type': position[ok].to_numpy(), 'lot': lot[ok].to_numpy(),
+        'openprice': openprice[ok].to_numpy(), 'closeprice': closeprice[ok].to_numpy(),
+        'takeprofit': takeprofit[ok].where(takeprofit[ok] > 0).to_numpy(),
+        'stoploss': stoploss[ok].where(stoploss[ok] > 0).to_numpy(),
+        'date': when[ok].dt.strftime('%Y-%m-%d').to_numpy(), 'time': when[ok].dt.strftime('%H:%M:%S').to_numpy(),
+        'note': chunk['note'][ok].where(chunk['note'][ok].notna(), None).to_numpy() if 'note' in chunk else None,
+    })
+    return valid, int(bad.sum()), errors
+
+@timed("db.importtrades")
+def importtrades(source, userid, chunksize=IMPORTCHUNKSIZE, sep=None, progress=None, dryrun=False):
+    """Stream a CSV / broker statement into ttrading for one user.
+
+    Pips and profit come from the vectorized engine (same rules as the form),
+    the USD/IDR rate is the as-of rate of each trade date and each chunk is one
+    executemany in a single writer transaction. Returns a summary dict with
+    per-row errors (capped at IMPORTMAXERRORS); malformed lines and chunks the
+    writer rejected are counted as failed there, so the summary is always
+    returned and says which lines did not make it in.
+    """
+    result = {'rows': 0, 'imported': 0, 'failed': 0, 'errors': []}
+    pending = None
+
+    def adderrors(errors):
+        result['errors'].extend(errors[:max(IMPORTMAXERRORS - len(result['errors']), 0)])
+
+    def settle(pending):
+        fut, count, first, last = pending
+        try:
+            result['imported'] += fut.result()
+        except Exception as e:
+            result['failed'] += count
+            adderrors([(first, f"lines {first}-{last} not imported: {e}")])
+
+    for chunk, lines, malformed in readimportchunks(source, sep or sniffdelimiter(source), chunksize):
+        valid, failed, errors = prepareimportchunk(chunk, lines, IMPORTMAXERRORS - len(result['errors']))
+        result['rows'] += len(chunk) + len(malformed)
+        result['failed'] += failed + len(malformed)
+        adderrors(sorted(malformed + errors))
+        if len(valid):
+            pips, profitusd = calculatetradesvec(valid['pair'].to_numpy(), valid['type'].to_numpy(), valid['lot'].to_numpy(),
+                                                 valid['openprice'].to_numpy(), valid['closeprice'].to_numpy())
+            # as-of rate of each trade date; today's (or the default) where the history has none
+            rate = getfxratecache().ratesfor(valid['date'].to_numpy())
+            rate = np.where(np.isnan(rate), getusdtoidr() or DEFAULTUSDIDR, rate)
+            profitusd = roundvec(profitusd, 2)
+            valid['profitusd'] = profitusd
+            valid['profitidr'] = roundvec(profitusd * rate, 0)
+            valid['pips'] = roundvec(pips, 4)
+            created = datetime.utcnow().isoformat()
+            valid = valid.astype(object).where(valid.notna(), None)
+            params = [(userid, *row, created) for row in valid[[
+                'pair', 'type', 'lot', 'openprice', 'closeprice', 'takeprofit', 'stoploss', 'date', 'time',
+                'note', 'profitusd', 'profitidr', 'pips']].itertuples(index=False, name=None)]
+            if not dryrun:
+                # keep one chunk in flight so parsing overlaps with the write
+                if pending is not None:
+                    settle(pending)
+                    pending = None
+                try:
+                    pending = (gettradewriter().submit(tradebulkinsertop, params), len(params), int(lines[0]), int(lines[-1]))
+                except RuntimeError as e:
+                    result['failed'] += len(params)
+                    adderrors([(int(lines[0]), f"lines {lines[0]}-{lines[-1]} not imported: {e}")])
+            else:
+                result['imported'] += len(params)
+        if progress:
+            progress(result['rows'], result['imported'], result['failed'])
+    if pending is not None:
+        settle(pending)
+    if progress:
+        progress(result['rows'], result['imported'], result['failed'])
+    return result
+
+# -----------------------
+# analytics: equity curve, drawdown and breakdowns, cached per (user, data version)
+
+ANALYTICSCACHESIZE = 256
+EQUITYPOINTS = 2000  # equity curve is downsampled to this many points for charts
+WEEKDAYS = ["Senin", "Selasa", "Rabu", "Kamis", "Jumat", "Sabtu", "Minggu"]
+
+class LRUCache:
+    """Small thread-safe LRU map shared by every session in the process"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.data), 'maxsize': self.maxsize}
+
+    def discard(self, predicate):
+        """Drop every entry whose key matches predicate"""
+        with self.lock:
+            for key in [k for k in self.data if predicate(k)]:
+                del self.data[key]
+
+    def __len__(self):
+        return len(self.data)
+
+@st.cache_resource
+def getanalyticscachefor(path):
+    cache = LRUCache(ANALYTICSCACHESIZE)
+    getmetrics().register("analytics", cache.stats)
+    return cache
+
+def getanalyticscache():
+    # per database, like the query cache: data versions of two databases can coincide
+    return getanalyticscachefor(DBPATH)
+
+@timed("db.loadanalyticsframe")
+def loadanalyticsframe(userid):
+    """Only the columns analytics needs, in trade-time order"""
+    # read in id order (sequential on the (userid, id) index) and sort by time in pandas;
+    # ORDER BY tradeat in SQL means a random row lookup per trade
+    df = loadtradesframe(userid, columns=['tradeat', 'pair', 'profitusd', 'pips'], status='closed')
+    return df.rename(columns={'tradeat': 'when'}).sort_values('when', kind='stable', ignore_index=True)
+
+def computeanalytics(df):
+    """Summary metrics, equity curve and breakdowns from a loadanalyticsframe() frame"""
+    n = len(df)
+    profit = df['profitusd'].to_numpy()
+    wins, losses = profit > 0, profit < 0
+    grossprofit = float(profit[wins].sum())
+    grossloss = float(-profit[losses].sum())
+    equity = np.cumsum(profit)
+    peak = np.maximum.accumulate(np.concatenate(([0.0], equity)))[1:] if n else equity
+    drawdown = equity - peak
+    trough = int(np.argmin(drawdown)) if n else 0
+    peakat = int(np.argmax(equity[:trough + 1])) if n and equity[:trough + 1].max() > 0 else None
+    summary = {
+        'trades': n,
+        'wins': int(wins.sum()),
+        'losses': int(losses.sum()),
+        'winrate': float(wins.mean()) if n else 0.0,
+        'netprofit': float(profit.sum()),
+        'grossprofit': grossprofit,
+        'grossloss': abs(grossloss),
+        'profitfactor': grossprofit / grossloss if grossloss else None,
+        'expectancy': float(profit.mean()) if n else 0.0,
+        'avgwin': float(profit[wins].mean()) if wins.any() else 0.0,
+        'avgloss': float(profit[losses].mean()) if losses.any() else 0.0,
+        'avgpips': float(df['pips'].mean()) if n else 0.0,
+        'maxdrawdown': float(-drawdown.min()) if n else 0.0,
+        'maxdrawdownfrom': df['when'].iloc[peakat] if peakat is not None else None,
+        'maxdrawdownto': df['when'].iloc[trough] if n and drawdown.min() < 0 else None,
+    }
+    step = max(n // EQUITYPOINTS, 1)
+    keep = np.unique(np.append(np.arange(0, n, step), n - 1)) if n else np.arange(0)
+    curve = pd.DataFrame({'when': df['when'].to_numpy()[keep], 'equity': equity[keep], 'drawdown': drawdown[keep]})
+    
+    def breakdown(key):
+        g = df.assign(win=wins, loss=losses).groupby(key, observed=True)
+        out = g.agg(trades=('profitusd', 'size'), netprofit=('profitusd', 'sum'), wins=('win', 'sum'),
+                    losses=('loss', 'sum'), avgpips=('pips', 'mean'))
+        out['winrate'] = out['wins'] / out['trades']
+        return out.reset_index()
+    
+    bypair = breakdown('pair')
+    weekday = df['when'].dt.dayofweek
+    byweekday = breakdown(weekday.rename('weekday'))
+    byweekday['weekday'] = byweekday['weekday'].map(lambda d: WEEKDAYS[int(d)])
+    return {'summary': summary, 'equity': curve, 'bypair': bypair, 'byweekday': byweekday}
+
+@timed("analytics.getanalytics")
+def getanalytics(userid):
+    """Analytics for a user; recomputed only when the user's data version moved"""
+    cache = getanalyticscache()
+    key = (userid, getdataversion(userid))
+    result = cache.get(key)
+    if result is None:
+        result = computeanalytics(loadanalyticsframe(userid))
+        cache.discard(lambda k: k[0] == userid)
+        cache.put(key, result)
+    return result
+
+@timed("render.analyticspanel")
+def analyticspanel(userid):
+    a = getanalytics(userid)
+    sm = a['summary']
+    if not sm['trades']:
+        st.info("ℹ️ Belum ada data untuk dianalisis")
+        return
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("Win Rate", f"{sm['winrate'] * 100:.1f}%")
+    c2.metric("Profit Factor", f"{sm['profitfactor']:.2f}" if sm['profitfactor'] is not None else "∞")
+    c3.metric("Expectancy / Trade", f"{sm['expectancy']:.2f}")
+    c4.metric("Max Drawdown", f"{sm['maxdrawdown']:.2f}")
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("Rata-rata Win", f"{sm['avgwin']:.2f}")
+    c2.metric("Rata-rata Loss", f"{sm['avgloss']:.2f}")
+    c3.metric("Rata-rata Pips", f"{sm['avgpips']:.2f}")
+    c4.metric("Menang / Kalah", f"{sm['wins']} / {sm['losses']}")
+    st.line_chart(a['equity'], x='when', y=['equity', 'drawdown'])
+    c1, c2 = st.columns(2)
+    c1.dataframe(a['bypair'], hide_index=True, use_container_width=True)
+    c2.dataframe(a['byweekday'], hide_index=True, use_container_width=True)
+
+# -----------------------
+# columnar replica: ttrading mirrored into month-partitioned Parquet for admin-wide reports,
+# so cross-user scans run on Arrow instead of the SQLite file users write to
+
+SNAPSHOTDIR = os.environ.get("TRADINGAPP_SNAPSHOTDIR", "snapshot")
+SNAPSHOTINTERVAL = int(os.environ.get("TRADINGAPP_SNAPSHOTINTERVAL", 300))  # seconds; 0 disables the background job
+SNAPSHOTBATCHSIZE = 100000
+SNAPSHOTOVERLAP = 60          # seconds of updatedat re-read each run (writer clock vs commit order)
+SNAPSHOTMAXFILES = 200        # data files before a run compacts the whole replica
+SNAPSHOTCACHESIZE = 4
+SNAPSHOTCOLUMNS = ['id', 'userid', 'pair', 'type', 'status', 'lot', 'openprice', 'closeprice', 'takeprofit',
+                   'stoploss', 'date', 'time', 'tradeat', 'profitusd', 'profitidr', 'pips', 'note',
+                   'createdat', 'updatedat']
+
+def snapshotschema(pa):
+    types = {'id': pa.int64(), 'userid': pa.int64(), 'tradeat': pa.int64(), 'lot': pa.float64(),
+             'openprice': pa.float64(), 'closeprice': pa.float64(), 'takeprofit': pa.float64(),
+             'stoploss': pa.float64(), 'profitusd': pa.float64(), 'profitidr': pa.float64(), 'pips': pa.float64()}
+    return pa.schema([(c, types.get(c, pa.string())) for c in SNAPSHOTCOLUMNS] + [('seq', pa.int64())])
+
+def snapshotregisterop(conn, root, deleteseq, at):
+    """Record a replica's tombstone watermark and prune what every registered replica has seen"""
+    conn.execute("INSERT INTO tsnapshotreplica(root, deleteseq, at) VALUES (?,?,?) "
+                 "ON CONFLICT(root) DO UPDATE SET deleteseq=excluded.deleteseq, at=excluded.at", (root, deleteseq, at))
+    return prunetombstones(conn)
+
+def snapshotjoinop(conn, root, at):
+    """Register a replica at the newest tombstone; deletes from here on are kept for it.
+
+    Tombstones are only written while some replica is registered, so a replica
+    has to join before the read its full export starts from.
+    """
+    deleteseq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM tdeletedtrade").fetchone()[0]
+    snapshotregisterop(conn, root, deleteseq, at)
+    return deleteseq
+
+def snapshotforgetop(conn, root):
+    forgotten = conn.execute("DELETE FROM tsnapshotreplica WHERE root=?", (root,)).rowcount
+    prunetombstones(conn)
+    return forgotten
+
+class TradeSnapshot:
+    """Incremental Parquet replica of ttrading plus the query side used by admin reports.
+
+    Layout under root: trades/month=YYYY-MM/part-<seq>-<n>.parquet holds rows
+    that were new or changed in run <seq>; deletes/part-<seq>.parquet holds ids
+    deleted since the previous run; state.json holds the watermarks (last id,
+    last updatedat, last tombstone). A reader keeps the newest seq per id and
+    drops deleted ids. Compaction writes the merged data before removing the
+    files it replaces, so a concurrent reader never misses a row.
+
+    Every replica registers its tombstone watermark in tsnapshotreplica, and
+    tombstones are pruned only once all of them have it, so several replicas
+    (snapshot --dir) can share one database; with none registered, deletes
+    leave no tombstones at all. A replica whose state.json does not match its
+    registration (a new one included) joins first and exports from scratch;
+    forget() unregisters a replica that is no longer refreshed, so it stops
+    holding tombstones back.
+    """
+
+    def __init__(self, root=SNAPSHOTDIR, batchsize=SNAPSHOTBATCHSIZE):
+        self.root = root
+        self.key = os.path.abspath(root)
+        self.batchsize = batchsize
+        self.lock = threading.Lock()
+        self.cache = LRUCache(SNAPSHOTCACHESIZE)
+        self.runs = 0
+
+    def statepath(self):
+        return os.path.join(self.root, "state.json")
+
+    def state(self):
+        try:
+            with open(self.statepath()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'seq': 0, 'lastid': 0, 'lastupdatedat': "", 'lastdeleteseq': 0, 'at': None}
+
+    def savestate(self, state):
+        tmp = self.statepath() + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.statepath())
+
+    def files(self, kind="trades"):
+        out = []
+        for dirpath, _, names in os.walk(os.path.join(self.root, kind)):
+            out.extend(os.path.join(dirpath, n) for n in names if n.endswith(".parquet"))
+        return sorted(out)
+
+    def writemonths(self, pq, table, name):
+        """One file per month partition of table (by its date column); returns files written"""
+        months = np.array([d[:7] for d in table['date'].to_pylist()], dtype='U7')
+        for month in np.unique(months):
+            part = os.path.join(self.root, "trades", f"month={month}")
+            os.makedirs(part, exist_ok=True)
+            pq.write_table(table.filter(months == month), os.path.join(part, f"{name}.parquet"), compression="zstd")
+        return len(np.unique(months))
+
+    @timed("snapshot.refresh", rows=lambda r: r['rows'])
+    def refresh(self, compact=None):
+        """Export rows added/changed/deleted since the last run; returns a summary dict"""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = snapshotschema(pa)
+        updatedcol = SNAPSHOTCOLUMNS.index('updatedat')
+        with self.lock, snapshotfilelock(self.root):
+            state = self.state()
+            seq = state['seq'] + 1
+            cols = ", ".join(f"t.{c}" for c in SNAPSHOTCOLUMNS)
+            lastid, lastupdatedat, lastdeleteseq = state['lastid'], state['lastupdatedat'], state['lastdeleteseq']
+            exported = files = 0
+            stale = []
+            with getdb().read() as conn:
+                registered = conn.execute("SELECT deleteseq FROM tsnapshotreplica WHERE root=?", (self.key,)).fetchone()
+            if registered is None or registered[0] != lastdeleteseq:
+                # new replica, or the tombstones this one relies on may be gone: join first so
+                # deletes from here on are kept, then export everything again and drop the
+                # old files once the new ones are written
+                lastdeleteseq = gettradewriter().submit(snapshotjoinop, self.key, datetime.utcnow().isoformat()).result()
+                if state['seq']:
+                    stale = self.files() + self.files("deletes")
+                    lastid, lastupdatedat = 0, ""
+            with getdb().transaction("DEFERRED") as conn:
+                # one read transaction (WAL: the snapshot is taken at the first SELECT and held to
+                # COMMIT): new ids, changed rows and tombstones are one consistent cut
+                since = (datetime.fromisoformat(lastupdatedat) - timedelta(seconds=SNAPSHOTOVERLAP)).isoformat() \
+                    if lastupdatedat else ""
+                maxid = conn.execute("SELECT COALESCE(MAX(id), 0) FROM ttrading").fetchone()[0]
+                queries = [(f"SELECT {cols} FROM ttrading t WHERE t.id > ? AND t.id <= ? ORDER BY t.id",
+                            (lastid, maxid))]
+                if lastid:
+                    queries.append((f"SELECT {cols} FROM ttrading t WHERE t.updatedat > ? AND t.id <= ?",
+                                    (since, lastid)))
+                for sql, params in queries:
+                    cur = conn.cursor()
+                    cur.row_factory = None
+                    cur.arraysize = self.batchsize
+                    cur.execute(sql, params)
+                    while True:
+                        rows = cur.fetchmany()
+                        if not rows:
+                            break
+                        columns = list(zip(*rows)) + [[seq] * len(rows)]
+                        table = pa.table([pa.array(v, type=f.type) for v, f in zip(columns, schema)], schema=schema)
+                        files += self.writemonths(pq, table, f"part-{seq:08d}-{exported:010d}")
+                        exported += len(rows)
+                        lastupdatedat = max([lastupdatedat] + [r[updatedcol] for r in rows if r[updatedcol]])
+                deletes = conn.execute("SELECT seq, id FROM tdeletedtrade WHERE seq > ? ORDER BY seq",
+                                       (lastdeleteseq,)).fetchall()
+            if deletes:
+                os.makedirs(os.path.join(self.root, "deletes"), exist_ok=True)
+                pq.write_table(pa.table({'id': pa.array([r[1] for r in deletes], pa.int64())}),
+                               os.path.join(self.root, "deletes", f"part-{seq:08d}.parquet"))
+            state.update(seq=seq, lastid=maxid, lastupdatedat=lastupdatedat,
+                         lastdeleteseq=deletes[-1][0] if deletes else lastdeleteseq,
+                         at=datetime.utcnow().isoformat())
+            self.savestate(state)
+            for path in stale:
+                os.remove(path)
+            # state.json first: a crash in between leaves a mismatch, i.e. a resync, never a lost delete
+            gettradewriter().submit(snapshotregisterop, self.key, state['lastdeleteseq'], state['at']).result()
+            compacted = bool(compact or (compact is None and len(self.files()) > SNAPSHOTMAXFILES))
+            if compacted:
+                self.compact(pq, state)
+            self.runs += 1
+            return {'seq': state['seq'], 'rows': exported, 'files': files, 'deleted': len(deletes),
+                    'compacted': compacted, 'resynced': bool(state['seq'] and stale)}
+
+    def forget(self):
+        """Unregister this replica; returns whether it was registered"""
+        return bool(gettradewriter().submit(snapshotforgetop, self.key).result())
+
+    def compact(self, pq, state):
+        """Rewrite the live rows as one file per month, then drop the files they replace"""
+        old, olddeletes = self.files(), self.files("deletes")
+        table = self.load(None, old, olddeletes)
+        state['seq'] += 1
+        self.writemonths(pq, table, f"part-{state['seq']:08d}-compact")
+        for path in old + olddeletes:
+            os.remove(path)
+        self.savestate(state)
+
+    def load(self, columns, files, deletefiles):
+        """Live rows of the given files: newest seq per id, deleted ids removed"""
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        schema = snapshotschema(pa)
+        wanted = None if columns is None else list(dict.fromkeys(['id', 'seq'] + list(columns)))
+        table = ds.dataset(files, schema=schema, format="parquet").to_table(columns=wanted)
+        ids = table['id'].to_numpy()
+        seqs = table['seq'].to_numpy()
+        order = np.lexsort((seqs, ids))
+        sortedids = ids[order]
+        newest = order[np.append(sortedids[1:] != sortedids[:-1], True)] if len(ids) else order
+        if deletefiles:
+            deleted = ds.dataset(deletefiles, format="parquet").to_table(columns=['id'])['id'].to_numpy()
+            newest = newest[~np.isin(ids[newest], deleted)]
+        return table.take(newest)  # newest is in id order
+
+    @timed("snapshot.table", rows=lambda t: t.num_rows)
+    def table(self, columns=None):
+        """Live replica as a pyarrow Table in id order; cached until the next run"""
+        key = (self.state()['seq'], None if columns is None else tuple(columns))
+        table = self.cache.get(key)
+        if table is None:
+            try:
+                table = self.load(columns, self.files(), self.files("deletes"))
+            except FileNotFoundError:
+                # a compaction removed files after they were listed; its output is complete by now
+                table = self.load(columns, self.files(), self.files("deletes"))
+            self.cache.discard(lambda k: k[0] != key[0])
+            self.cache.put(key, table)
+        return table
+
+    def stats(self):
+        state = self.state()
+        cache = self.cache.stats()
+        return {'hits': cache['hits'], 'misses': cache['misses'], 'runs': self.runs, 'seq': state['seq'],
+                'lastid': state['lastid'], 'at': state['at']}
+
+@contextmanager
+def snapshotfilelock(root):
+    """Cross-process exclusive lock on root/.lock (POSIX); other platforms rely on the in-process lock"""
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, ".lock"), "w") as f:
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def snapshotloop(snapshot, interval):
+    while True:
+        try:
+            snapshot.refresh()
+        except (OSError, sqlite3.Error):
+            pass  # next run picks up from the same watermark
+        time.sleep(interval)
+
+def snapshotavailable():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+@st.cache_resource
+def getsnapshotfor(path, root):
+    snapshot = TradeSnapshot(root)
+    getmetrics().register("snapshot", snapshot.stats)
+    if SNAPSHOTINTERVAL and snapshotavailable():
+        threading.Thread(target=snapshotloop, args=(snapshot, SNAPSHOTINTERVAL), name="snapshot", daemon=True).start()
+    return snapshot
+
+def getsnapshot():
+    return getsnapshotfor(DBPATH, SNAPSHOTDIR)
+
+@timed("analytics.snapshotreport")
+def snapshotreport(by):
+    """Cross-user aggregates of closed trades from the replica; by is 'pair', 'userid' or 'month'"""
+    import pyarrow.compute as pc
+    table = getsnapshot().table(['date', 'userid', 'pair', 'status', 'profitusd', 'profitidr', 'pips'])
+    table = table.filter(pc.equal(table['status'], "closed"))
+    if by == 'month':
+        table = table.append_column('month', pc.utf8_slice_codeunits(table['date'], 0, 7))
+    out = table.group_by(by).aggregate([
+        ('id', 'count'), ('userid', 'count_distinct'), ('profitusd', 'sum'), ('profitidr', 'sum'),
+        ('pips', 'sum'), ('profitusd', 'mean'),
+    ]).to_pandas()
+    out = out.rename(columns={'id_count': 'trades', 'userid_count_distinct': 'users', 'profitusd_sum': 'profitusd',
+                              'profitidr_sum': 'profitidr', 'pips_sum': 'pips', 'profitusd_mean': 'avgprofitusd'})
+    out = out[[by, 'trades', 'users', 'profitusd', 'profitidr', 'pips', 'avgprofitusd']]
+    if by == 'userid':
+        with getdb().read() as conn:
+            names = dict(conn.execute("SELECT id, username FROM tuser").fetchall())
+        out.insert(1, 'username', out['userid'].map(names))
+        return out.drop(columns=['users']).sort_values('profitusd', ascending=False, ignore_index=True)
+    return out.sort_values(by, ignore_index=True)
+
+@timed("render.alltradespanel")
+def alltradespanel():
+    """Cross-user reports from the Parquet replica (when pyarrow is there) and the paged trade table"""
+    if not snapshotavailable():
+        st.caption("pyarrow tidak terpasang; laporan lintas user tidak tersedia, tabel dibaca per halaman dari database")
+        alltradestable()
+        return
+    snapshot = getsnapshot()
+    state = snapshot.state()
+    c1, c2 = st.columns([3, 1])
+    c1.caption(f"Snapshot #{state['seq']} ({state['at'] + ' UTC' if state['at'] else 'belum pernah'}), "
+               f"sampai id {state['lastid']}")
+    if c2.button("Perbarui Snapshot", use_container_width=True) or not state['seq']:
+        with st.spinner("Menyalin transaksi baru..."):
+            result = snapshot.refresh()
+        st.success(f"{result['rows']} baris disalin, {result['deleted']} dihapus")
+    tab1, tab2, tab3, tab4 = st.tabs(["Per Pair", "Per User", "Per Bulan", "Semua Transaksi"])
+    with tab1:
+        st.dataframe(snapshotreport('pair'), hide_index=True, use_container_width=True)
+    with tab2:
+        st.dataframe(snapshotreport('userid'), hide_index=True, use_container_width=True)
+    with tab3:
+        bymonth = snapshotreport('month')
+        st.bar_chart(bymonth, x='month', y='profitusd')
+        st.dataframe(bymonth, hide_index=True, use_container_width=True)
+    with tab4:
+        alltradestable()
+
+def alltradestable():
+    """Every user's trades one keyset page at a time; exports stream the whole filtered set"""
+    rows, filters = tradehistorypager("alltrades", None, allifadmin=True)
+    if rows:
+        st.dataframe(pd.DataFrame([dict(row) for row in rows]), use_container_width=True, hide_index=True)
+        exportcontrols("alltradesexport", None, filters, allifadmin=True,
+                       filename=f"trading_all_{datetime.now().date()}")
+
+@timed("render.loginpage")
 def loginpage():
     st.header("Masuk ke Catatan Trading")
     username = st.text_input("Username")
@@ -295,6 +3250,9 @@ def loginpage():
                 st.error("Akun dinonaktifkan. Hubungi admin.")
                 return
             if verifypassword(password, user['passwordhash']):
+                # transparently move old static-salt hashes to a per-user salt
+                if needsrehash(user['passwordhash']):
+                    updateuserpasswordhash(user['id'], hashpassword(password))
                 st.session_state['loggedin'] = True
                 st.session_state['userid'] = user['id']
                 st.session_state['username'] = user['username']
@@ -318,6 +3276,7 @@ def logout():
         del st.session_state[k]
     st.rerun()
 
+@timed("render.admindashboard")
 def admindashboard():
     st.title("Dashboard Admin")
     st.markdown("---")
@@ -335,17 +3294,73 @@ def admindashboard():
     
     with col2:
         st.subheader("Statistik Singkat")
-        conn = getdbconnection()
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM ttrading")
-        totaltrades = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM tuser")
-        totalusers = c.fetchone()[0]
-        conn.close()
+        totaltrades, totalusers = getadmintotals()
         
         st.metric("Total Transaksi", totaltrades)
         st.metric("Total Users", totalusers)
     
+        if st.button("Cek Konsistensi Statistik"):
+            mismatches = checktradestats()
+            if mismatches:
+                st.warning(f"{len(mismatches)} selisih ditemukan, statistik dibangun ulang")
+                rebuildtradestats()
+            else:
+                st.success("Statistik konsisten")
+        
+        if st.button("Hitung Ulang P&L Semua Transaksi"):
+            bar = st.progress(0.0, text="Menghitung ulang...")
+            with getdb().read() as conn:
+                total = conn.execute("SELECT COUNT(*) FROM ttrading").fetchone()[0] or 1
+            scanned, updated = recalculatetrades(
+                progress=lambda done, changed: bar.progress(min(done / total, 1.0), text=f"{done}/{total} transaksi"))
+            st.success(f"{scanned} transaksi dihitung ulang, {updated} diperbarui")
+    
+    st.markdown("---")
+    st.subheader("Harga Pasar")
+    snap = gettickstore().snapshot()
+    st.dataframe(pd.DataFrame([{
+        'pair': pair,
+        'price': tick[0] if tick else None,
+        'update': datetime.fromtimestamp(tick[1]).strftime('%H:%M:%S') if tick else None,
+    } for pair, tick in snap.items()]), hide_index=True)
+    
+    with st.expander("💱 Kurs USD/IDR"):
+        fxstats = getfxratecache().stats()
+        st.caption(f"{fxstats['rates']} kurs tersimpan, terbaru {fxstats['newest'] or '-'}; "
+                   f"kurs hari ini: {getusdtoidr() or DEFAULTUSDIDR:,.0f}")
+        ratefile = st.file_uploader("Upload CSV kurs (date, rate)", type=["csv", "txt"], key="fxfile")
+        if ratefile is not None and st.button("Simpan Kurs dari File"):
+            try:
+                st.success(f"{upsertfxrates(loadfxrates(ratefile), 'file')} kurs disimpan")
+            except ValueError as e:
+                st.error(f"❌ {e}")
+        r1, r2 = st.columns(2)
+        fxfrom = r1.date_input("Ambil dari API mulai", value=None, key="fxfrom")
+        if r2.button("Ambil Kurs dari API"):
+            try:
+                st.success(f"{upsertfxrates(fetchfxrates(fxfrom), 'api')} kurs disimpan")
+            except (requests.RequestException, ValueError, KeyError) as e:
+                st.error(f"❌ Gagal mengambil kurs: {e}")
+        if st.button("Revaluasi Profit IDR Semua Transaksi"):
+            st.success(f"{revaluetrades()} transaksi direvaluasi")
+    
+    with st.expander("🕯️ Candle OHLC & Replay TP/SL"):
+        stored = getcandlestore().describe()
+        if stored:
+            st.dataframe(pd.DataFrame(stored), hide_index=True)
+        else:
+            st.caption(f"Belum ada candle di {CANDLEDIR}")
+        c1, c2 = st.columns([1, 3])
+        candlepair = c1.selectbox("Pair", PAIROPTIONS, key="candlepair")
+        candlefile = c2.file_uploader("Upload CSV candle (time, open, high, low, close / export MT4-MT5)",
+                                      type=["csv", "txt"], key="candlefile")
+        if candlefile is not None and st.button("Simpan Candle"):
+            try:
+                st.success(f"{importcandles(candlefile, candlepair)} candle {candlepair} disimpan")
+            except ValueError as e:
+                st.error(f"❌ {e}")
+        replaypanel("replayadmin", None, allifadmin=True, label="Replay TP/SL Semua Transaksi")
+    
     st.markdown("---")
     st.subheader("Manajemen User")
     
@@ -371,56 +3386,214 @@ def admindashboard():
                     else:
                         st.error(msg)
     
-    users = listusers()
-    if users:
-        dfusers = pd.DataFrame([dict(u) for u in users])  # PERBAIKAN: konversi Row ke dict
-        st.dataframe(dfusers)
+    with st.expander("📤 Upload User Massal (CSV: username, role, password opsional)"):
+        upload = st.file_uploader("File CSV", type=["csv"], key="provisionfile")
+        if upload is not None and st.button("Buat Semua User"):
+            rows = pd.read_csv(upload, dtype=str).reindex(columns=["username", "role", "password"]).itertuples(index=False, name=None)
+            created, errors = provisionusers(list(rows))
+            st.success(f"{len(created)} user dibuat")
+            if created:
+                dfcreated = pd.DataFrame(created, columns=["username", "role", "password"])
+                st.dataframe(dfcreated, hide_index=True)
+                st.download_button("⬇️ Download Password", data=dfcreated.to_csv(index=False),
+                                   file_name="users_provisioned.csv", mime="text/csv")
+            if errors:
+                st.warning(f"{len(errors)} baris gagal")
+                st.dataframe(pd.DataFrame(errors, columns=["baris", "error"]), hide_index=True)
     
-    st.markdown("---")
-    st.subheader("Action Per User")
-    for u in users:
-        cols = st.columns([3,1,1,1])
-        cols[0].write(f"**{u['username']}** - {u['role']} ({u['status']})")
-        if cols[1].button("✅ Aktifkan", key=f"act{u['id']}"):
-            updateuserstatus(u['id'], "active")
-            st.success(f"User {u['username']} diaktifkan")
-            st.rerun()
-        if cols[2].button("❌ Nonaktifkan", key=f"deact{u['id']}"):
-            updateuserstatus(u['id'], "inactive")
-            st.success(f"User {u['username']} dinonaktifkan")
-            st.rerun()
-        if cols[3].button("🔑 Reset PW", key=f"reset{u['id']}"):
-            updateuserpassword(u['id'], "password123")
-            st.info(f"Password {u['username']} direset ke: **password123**")
+    userdirectory("users")
     
     st.markdown("---")
     st.subheader("Semua Transaksi")
-    rows = gettradesforuser(None, allifadmin=True)
+    rows, filters = tradehistorypager("admintrades", None, allifadmin=True)
     if rows:
         df = pd.DataFrame([dict(row) for row in rows])  # PERBAIKAN: konversi Row ke dict
         st.dataframe(df, use_container_width=True)
+        exportcontrols("adminexport", None, filters, allifadmin=True,
+                       filename=f"trading_all_{datetime.now().date()}")
+
+@timed("render.exportcontrols")
+def exportcontrols(key, userid, filters, allifadmin=False, columns=EXPORTCOLUMNS, filename="trading"):
+    """Format picker + download button; the file is generated only when clicked"""
+    col1, col2 = st.columns([1, 2])
+    fmt = col1.selectbox("Format", list(EXPORTFORMATS), key=f"{key}fmt", label_visibility="collapsed")
+    mime = "application/octet-stream" if fmt == "parquet" else ("application/gzip" if fmt == "csv.gz" else "text/csv")
+    col2.download_button(
+        f"📥 Export {fmt.upper()}",
+        data=lambda: exportfile(fmt, userid=userid, allifadmin=allifadmin, columns=columns, **filters),
+        file_name=filename + EXPORTFORMATS[fmt],
+        mime=mime,
+        key=f"{key}download",
+        use_container_width=True,
+    )
+    st.caption("Export jutaan baris: `python trading_app_full.py export` atau `GET /api/export` "
+               "(trading_api.py) mengalirkan file tanpa menampungnya di memori.")
+
+@timed("render.tradehistorypager")
+def tradehistorypager(key, userid, allifadmin=False, pagesize=HISTORYPAGESIZE):
+    """Filter bar + prev/next keyset paging; returns (rows of the current page, filters)"""
+    f1, f2, f3, f4, f5 = st.columns(5)
+    pair = f1.selectbox("Pair", ["Semua"] + PAIROPTIONS, key=f"{key}pair")
+    position = f2.selectbox("Posisi", ["Semua", "BUY", "SELL"], key=f"{key}position")
+    status = f3.selectbox("Status", ["Semua", "Terbuka", "Tertutup"], key=f"{key}status")
+    datefrom = f4.date_input("Dari Tanggal", value=None, key=f"{key}datefrom")
+    dateto = f5.date_input("Sampai Tanggal", value=None, key=f"{key}dateto")
+    filters = {
+        'pair': None if pair == "Semua" else pair,
+        'position': None if position == "Semua" else position,
+        'datefrom': datefrom.isoformat() if datefrom else None,
+        'dateto': dateto.isoformat() if dateto else None,
+        'status': {"Terbuka": "open", "Tertutup": "closed"}.get(status),
+    }
+    cursors = keysetcursors(key, filters)
+    rows, nextid = gettradespage(userid, afterid=cursors[-1], pagesize=pagesize,
+                                 allifadmin=allifadmin, **filters)
+    keysetnav(key, cursors, nextid)
+    return rows, filters
+
+def keysetcursors(key, filters):
+    """Cursor stack in session state; cursors[-1] is the afterid of the page being shown"""
+    if st.session_state.get(f"{key}filters") != filters:
+        st.session_state[f"{key}filters"] = filters
+        st.session_state[f"{key}cursors"] = [None]
+    return st.session_state[f"{key}cursors"]
+
+def keysetnav(key, cursors, nextid):
+    nav1, nav2, nav3 = st.columns([1, 2, 1])
+    nav1.button("⬅️ Sebelumnya", key=f"{key}prev", disabled=len(cursors) == 1,
+                on_click=lambda: cursors.pop())
+    nav2.caption(f"Halaman {len(cursors)}")
+    nav3.button("Berikutnya ➡️", key=f"{key}next", disabled=nextid is None,
+                on_click=lambda: cursors.append(nextid))
 
+@timed("render.replaypanel")
+def replaypanel(key, userid, allifadmin=False, label="Jalankan Replay"):
+    """Replay button plus its last result, kept in session_state so it survives reruns (e.g. the download)"""
+    if st.button(label, key=key):
+        with st.spinner("Replay..."):
+            st.session_state[f"{key}result"] = (replaytrades(userid, allifadmin=allifadmin), datetime.now())
+    if f"{key}result" not in st.session_state:
+        return
+    df, ranat = st.session_state[f"{key}result"]
+    st.caption(f"Hasil replay {ranat:%d-%m-%Y %H:%M:%S}; klik tombol lagi untuk menghitung ulang")
+    if df.empty:
+        st.info("ℹ️ Tidak ada transaksi tertutup dengan TP/SL")
+        return
+    summary = replaysummary(df)
+    replayed = df['outcome'].isin(['tp', 'sl', 'none'])
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Transaksi di-replay", f"{int(replayed.sum())} / {len(df)}")
+    col2.metric("Profit Aktual USD", f"{df.loc[replayed, 'profitusd'].sum():.2f}")
+    col3.metric("Profit Replay USD", f"{df.loc[replayed, 'replayusd'].sum():.2f}",
+                delta=f"{df.loc[replayed, 'diffusd'].sum():.2f}")
+    st.dataframe(summary, hide_index=True)
+    st.dataframe(df[replayed].groupby('pair', observed=True)[['profitusd', 'replayusd', 'diffusd']].sum().reset_index(),
+                 hide_index=True)
+    st.download_button("📥 Hasil Replay (CSV)", data=lambda: df.to_csv(index=False).encode(), file_name="replay_tpsl.csv",
+                       mime="text/csv", key=f"{key}download")
+
+@st.fragment(run_every=PRICEFEEDINTERVAL)
+@timed("render.openpositionspanel")
+def openpositionspanel(userid):
+    """Open positions marked to the live price; reruns on its own with the price feed"""
+    df = openpositions(userid)
+    if df.empty:
+        return
+    st.markdown("---")
+    st.subheader("📂 Posisi Terbuka")
+    col1, col2 = st.columns(2)
+    col1.metric("💹 Floating Profit USD", f"{df['profitusd'].sum():.2f}")
+    col2.metric("💹 Floating Profit IDR", f"{df['profitidr'].sum():,.0f}")
+    st.dataframe(df.drop(columns=['userid']), use_container_width=True, hide_index=True)
+    c1, c2, c3 = st.columns([2, 2, 1])
+    tradeid = c1.selectbox("Posisi", df['id'].tolist(), key="closepositionid",
+                           format_func=lambda i: f"#{i} {df.loc[df['id'] == i, 'pair'].iloc[0]}")
+    live = df.loc[df['id'] == tradeid, 'price'].iloc[0]
+    # no live default: the fragment reruns every tick and must not overwrite what was typed
+    closeprice = c2.number_input("Close Price (kosong = harga live)", min_value=0.0, value=None,
+                                 format="%.2f", key="closepositionprice")
+    if c3.button("Tutup Posisi", use_container_width=True):
+        closeprice = closeprice or (float(live) if live == live else 0.0)
+        if closeprice <= 0:
+            st.error("❌ Close Price harus > 0")
+            return
+        try:
+            closed = closeposition(tradeid, closeprice, userid=userid)
+        except WRITEERRORS as e:
+            st.error(f"❌ Gagal menutup posisi: {e}")
+            return
+        if closed:
+            st.success("✅ Posisi ditutup")
+        else:
+            st.warning("⚠️ Posisi sudah ditutup")
+        st.rerun(scope="app")
+
+@timed("render.userdirectory")
+def userdirectory(key, pagesize=USERPAGESIZE):
+    """Searchable, paged user table with bulk actions; cost depends on page size only"""
+    f1, f2, f3 = st.columns([2, 1, 1])
+    query = f1.text_input("Cari username (awalan)", key=f"{key}query").strip()
+    status = f2.selectbox("Status", ["Semua", "active", "inactive"], key=f"{key}status")
+    role = f3.selectbox("Role", ["Semua", "user", "admin"], key=f"{key}role")
+    filters = {
+        'query': query or None,
+        'status': None if status == "Semua" else status,
+        'role': None if role == "Semua" else role,
+    }
+    cursors = keysetcursors(key, filters)
+    users, nextid = searchusers(afterid=cursors[-1], pagesize=pagesize, **filters)
+    if not users:
+        st.info("Tidak ada user yang cocok")
+    else:
+        dfusers = pd.DataFrame([dict(u) for u in users])  # PERBAIKAN: konversi Row ke dict
+        dfusers.insert(0, "pilih", False)
+        edited = st.data_editor(dfusers, hide_index=True, use_container_width=True, key=f"{key}editor",
+                                disabled=[c for c in dfusers.columns if c != "pilih"])
+        selected = [int(i) for i in edited.loc[edited["pilih"], "id"]]
+        b1, b2, b3, b4 = st.columns([1, 1, 1, 2])
+        b4.caption(f"{len(selected)} user dipilih")
+        if b1.button("✅ Aktifkan", key=f"{key}act", disabled=not selected):
+            n = setusersstatus(selected, "active")
+            st.success(f"{n} user diaktifkan")
+            st.rerun()
+        if b2.button("❌ Nonaktifkan", key=f"{key}deact", disabled=not selected):
+            # jangan kunci akun admin yang sedang login
+            n = setusersstatus([i for i in selected if i != st.session_state.get('userid')], "inactive")
+            st.success(f"{n} user dinonaktifkan")
+            st.rerun()
+        if b3.button("🔑 Reset PW", key=f"{key}reset", disabled=not selected):
+            reset = pd.DataFrame(resetuserspasswords(selected), columns=["username", "password"])
+            st.info(f"Password {len(reset)} user direset; bagikan password baru ini sekali saja")
+            st.dataframe(reset, hide_index=True)
+            st.download_button("⬇️ Download Password", data=reset.to_csv(index=False),
+                               file_name="users_reset.csv", mime="text/csv", key=f"{key}resetdownload")
+    keysetnav(key, cursors, nextid)
+
+@timed("render.userdashboard")
 def userdashboard():
     st.title("📊 Dashboard User")
     st.markdown("---")
     
     uid = st.session_state['userid']
-    rows = gettradesforuser(uid, allifadmin=False)
-    
-    # PERBAIKAN: Cek kolom ada sebelum akses
-    df = pd.DataFrame([dict(row) for row in rows]) if rows else pd.DataFrame()
-    
-    totaltrades = len(df)
-    totalprofit = 0.0
+    stats = getuserstats(uid)
     
-    # Aman: cek kolom ada dan df tidak kosong
-    if not df.empty and 'profitusd' in df.columns:
-        totalprofit = df['profitusd'].sum()
+    # satu baris agregat, bukan seluruh riwayat
+    totaltrades = stats['tradecount'] if stats else 0
+    totalprofit = stats['profitusd'] if stats else 0.0
     
     col1, col2 = st.columns(2)
     col1.metric("📈 Total Transaksi", totaltrades)
     col2.metric("💰 Total Profit USD", f"{totalprofit:.2f}")
     
+    with st.expander("📈 Analitik Trading"):
+        analyticspanel(uid)
+    
+    with st.expander("🎯 Replay TP/SL"):
+        st.caption("Apa jadinya jika TP/SL dibiarkan berjalan, dihitung dari data candle OHLC")
+        replaypanel("replayuser", uid)
+    
+    openpositionspanel(uid)
+    
     st.markdown("---")
     st.subheader("➕ Tambah Catatan Trading")
     
@@ -432,11 +3605,15 @@ def userdashboard():
             position = st.radio("Posisi", ["BUY", "SELL"], horizontal=True)
             lot = st.number_input("Lot", min_value=0.01, value=0.01, step=0.01, format="%.2f")
             openprice = st.number_input("Open Price", min_value=0.0, format="%.2f")
+            isopen = st.checkbox("📂 Posisi masih terbuka (Close Price diisi saat ditutup)")
         
         with col2:
             marketprice_live = getmarketpriceapi(pair)
             if marketprice_live:
                 st.metric("🟢 LIVE PRICE", f"${marketprice_live:.2f}")
+                tick = gettickstore().latest(pair)
+                if tick:
+                    st.caption(f"Update: {datetime.fromtimestamp(tick[1]).strftime('%H:%M:%S')}")
     
             marketprice = st.number_input(
                 "💹 Market Price",value=float(marketprice_live)
@@ -459,12 +3636,34 @@ def userdashboard():
         submitted = st.form_submit_button("💾 Simpan Transaksi", use_container_width=True)
         
         if submitted:
-            if openprice <= 0 or closeprice <= 0 or lot <= 0:
+            if isopen and (openprice <= 0 or lot <= 0):
+                st.error("❌ Open Price dan Lot harus > 0")
+            elif isopen:
+                data = {
+                    'userid': uid,
+                    'pair': pair,
+                    'type': position,
+                    'lot': lot,
+                    'openprice': openprice,
+                    'takeprofit': tp if tp > 0 else None,
+                    'stoploss': sl if sl > 0 else None,
+                    'date': datein.isoformat(),
+                    'time': timein.strftime("%H:%M:%S"),
+                    'note': note or None,
+                }
+                try:
+                    openposition(data)
+                except WRITEERRORS as e:
+                    st.error(f"❌ Gagal menyimpan posisi: {e}")
+                else:
+                    st.success("✅ Posisi terbuka tersimpan!")
+                    st.rerun()
+            elif openprice <= 0 or closeprice <= 0 or lot <= 0:
                 st.error("❌ Open Price, Close Price, dan Lot harus > 0")
             else:
                 pips = calculatepips(pair, openprice, closeprice)
                 profitusd = calculateprofitusd(pair, openprice, closeprice, lot, position)
-                rate = getusdtoidr() or 16000  # fallback rate
+                rate = getusdtoidr(datein.isoformat()) or DEFAULTUSDIDR  # fallback rate
                 profitidr = profitusd * rate
                 
                 data = {
@@ -483,33 +3682,42 @@ def userdashboard():
                     'profitidr': round(profitidr, 0),
                     'pips': round(pips, 4)
                 }
-                inserttradedata(data)
-                st.success("✅ Transaksi tersimpan!")
-                st.balloons()
-                st.rerun()
+                try:
+                    inserttradedata(data)
+                except WRITEERRORS as e:
+                    st.error(f"❌ Gagal menyimpan transaksi: {e}")
+                else:
+                    st.success("✅ Transaksi tersimpan!")
+                    st.balloons()
+                    st.rerun()
+    
+    with st.expander("📤 Import CSV / Statement MT4-MT5"):
+        upload = st.file_uploader("File CSV", type=["csv", "txt"], key="importfile")
+        if upload is not None and st.button("Import Transaksi", use_container_width=True):
+            bar = st.progress(0.0, text="Mengimpor...")
+            result = importtrades(upload, uid, progress=lambda rows, imported, failed: bar.progress(
+                min(upload.tell() / max(upload.size, 1), 1.0), text=f"{imported} diimpor, {failed} gagal"))
+            st.success(f"✅ {result['imported']} dari {result['rows']} baris diimpor")
+            if result['errors']:
+                st.warning(f"⚠️ {result['failed']} baris gagal")
+                st.dataframe(pd.DataFrame(result['errors'], columns=['baris', 'error']), hide_index=True)
     
     st.markdown("---")
     st.subheader("📋 Riwayat Trading")
     
-    rows = gettradesforuser(uid, allifadmin=False)
+    rows, filters = tradehistorypager("history", uid)
     if rows:
         df = pd.DataFrame([dict(row) for row in rows])
         # Pilih kolom penting saja
-        display_cols = ['id', 'pair', 'type', 'lot', 'openprice', 'closeprice', 
+        display_cols = ['id', 'pair', 'type', 'status', 'lot', 'openprice', 'closeprice', 
                        'profitusd', 'profitidr', 'pips', 'date', 'time']
         available_cols = [col for col in display_cols if col in df.columns]
         if available_cols:
             st.dataframe(df[available_cols], use_container_width=True, hide_index=True)
             
-            # Export CSV
-            if st.button("📥 Export CSV", use_container_width=True):
-                csv = df[available_cols].to_csv(index=False)
-                st.download_button(
-                    "⬇️ Download CSV", 
-                    data=csv, 
-                    file_name=f"trading_{st.session_state['username']}_{datein}.csv",
-                    mime="text/csv"
-                )
+            # Export (semua halaman, filter yang sama)
+            exportcontrols("historyexport", uid, filters, columns=USEREXPORTCOLUMNS,
+                           filename=f"trading_{st.session_state['username']}_{datein}")
         else:
             st.info("ℹ️ Data transaksi kosong")
     else:
@@ -517,9 +3725,41 @@ def userdashboard():
 
     # ----------------------- validate
 
+def performancepanel():
+    """Admin-only view of the in-process metrics registry"""
+    metrics = getmetrics()
+    snap = metrics.snapshot()
+    st.header("Performa")
+    st.caption(f"Sejak {datetime.fromtimestamp(snap['since']).strftime('%Y-%m-%d %H:%M:%S')} (per proses)"
+               + (f" - dump ke {METRICSFILE} tiap {METRICSDUMPINTERVAL} detik" if METRICSFILE else ""))
+    if snap['timers']:
+        df = pd.DataFrame([
+            {'fungsi': name, 'panggilan': t['count'], 'error': t['errors'], 'baris': t['rows'],
+             'avg ms': round(t['avgms'], 3), 'p50 ms': round(t['p50ms'], 3), 'p95 ms': round(t['p95ms'], 3),
+             'p99 ms': round(t['p99ms'], 3), 'max ms': round(t['maxms'], 3)}
+            for name, t in snap['timers'].items()])
+        st.dataframe(df.sort_values('panggilan', ascending=False), use_container_width=True, hide_index=True)
+        st.caption("p50/p95/p99 diinterpolasi dari bucket histogram.")
+    else:
+        st.info("Belum ada data.")
+    if snap['caches']:
+        st.subheader("Cache")
+        st.dataframe(pd.DataFrame([
+            {'cache': name, 'hit': c['hits'], 'miss': c['misses'],
+             'hit ratio': None if c['hitratio'] is None else round(c['hitratio'], 3)}
+            for name, c in snap['caches'].items()]), use_container_width=True, hide_index=True)
+    with st.expander("Komponen"):
+        st.json(snap['components'])
+    col1, col2, col3 = st.columns(3)
+    col1.download_button("Unduh JSON", metrics.json, file_name="metrics.json", mime="application/json")
+    col2.download_button("Unduh Prometheus", metrics.prometheus, file_name="metrics.prom", mime="text/plain")
+    if col3.button("Reset Metrik"):
+        metrics.reset()
+        st.rerun()
+
 def main():
     st.set_page_config(page_title="Catatan Trading", layout="wide")
-    initdb()
+    ensuredb()
     
     if 'loggedin' not in st.session_state:
         st.session_state['loggedin'] = False
@@ -539,7 +3779,7 @@ def main():
             logout()
         
         if role == 'admin':
-            menu = st.selectbox("Menu", ["Admin Dashboard", "All Trades"])
+            menu = st.selectbox("Menu", ["Admin Dashboard", "All Trades", "Performance"])
         else:
             menu = st.selectbox("Menu", ["User Dashboard"])
     
@@ -547,10 +3787,9 @@ def main():
         if menu == "Admin Dashboard":
             admindashboard()
         elif menu == "All Trades":
-            rows = gettradesforuser(None, allifadmin=True)
-            if rows:
-                df = pd.DataFrame(rows)
-                st.dataframe(df, use_container_width=True)
+            alltradespanel()
+        elif menu == "Performance":
+            performancepanel()
     else:
         if menu == "User Dashboard":
             # ----------------------- if logged in
@@ -560,6 +3799,170 @@ def main():
             else:
                 userdashboard()
 
+# -----------------------
+# maintenance commands: python trading_app_full.py <command> (outside Streamlit)
+
+def cmdcheckstats(args):
+    initdb()
+    mismatches = checktradestats()
+    for m in mismatches:
+        print(m)
+    print(f"{len(mismatches)} mismatches")
+    if mismatches and args.rebuild:
+        rebuildtradestats()
+        print("aggregates rebuilt")
+    return 1 if mismatches and not args.rebuild else 0
+
+def cmdrecalc(args):
+    initdb()
+    scanned, updated = recalculatetrades(chunksize=args.chunksize, rate=args.rate,
+                                         progress=lambda done, changed: print(f"{done} scanned, {changed} updated"))
+    print(f"done: {scanned} scanned, {updated} updated")
+    return 0
+
+def cmdimport(args):
+    initdb()
+    user = getuserbyusername(args.user)
+    if not user:
+        print(f"unknown user: {args.user}")
+        return 1
+    result = importtrades(args.file, user['id'], chunksize=args.chunksize, dryrun=args.dryrun,
+                          progress=lambda rows, imported, failed: print(f"{rows} read, {imported} imported, {failed} failed"))
+    for lineno, message in result['errors']:
+        print(f"line {lineno}: {message}")
+    print(f"done: {result['imported']} of {result['rows']} rows imported, {result['failed']} failed")
+    return 0
+
+def cmdexport(args):
+    initdb()
+    userid = None
+    if args.user:
+        user = getuserbyusername(args.user)
+        if not user:
+            print(f"unknown user: {args.user}")
+            return 1
+        userid = user['id']
+    written = exporttrades(args.file, args.format, userid=userid, allifadmin=userid is None,
+                           pair=args.pair, position=args.type, datefrom=args.datefrom, dateto=args.dateto)
+    print(f"{written} rows written to {args.file}")
+    return 0
+
+def cmdfxrates(args):
+    initdb()
+    if args.file:
+        rows = loadfxrates(args.file)
+        source = "file"
+    else:
+        rows = fetchfxrates(args.datefrom, args.dateto)
+        source = "api"
+    print(f"{upsertfxrates(rows, source)} rates stored")
+    if args.revalue:
+        print(f"{revaluetrades()} trades revalued")
+    return 0
+
+def cmdrevalue(args):
+    initdb()
+    print(f"{revaluetrades(args.datefrom, args.dateto)} trades revalued")
+    return 0
+
+def cmdcandles(args):
+    print(f"{importcandles(args.file, args.pair)} candles read into {os.path.join(CANDLEDIR, args.pair.upper())}")
+    return 0
+
+def cmdreplay(args):
+    initdb()
+    userid = None
+    if args.user:
+        user = getuserbyusername(args.user)
+        if not user:
+            print(f"unknown user: {args.user}")
+            return 1
+        userid = user['id']
+    df = replaytrades(userid, allifadmin=userid is None, horizon=int(args.horizon * 86400),
+                      progress=lambda done: print(f"{done} trades replayed"))
+    print(replaysummary(df).to_string(index=False))
+    if args.out:
+        df.to_csv(args.out, index=False)
+        print(f"{len(df)} rows written to {args.out}")
+    return 0
+
+def cmdsnapshot(args):
+    initdb()
+    if not snapshotavailable():
+        print("the snapshot needs pyarrow (pip install pyarrow)")
+        return 1
+    snapshot = TradeSnapshot(args.dir or SNAPSHOTDIR)
+    if args.forget:
+        print(f"{snapshot.key} {'unregistered' if snapshot.forget() else 'was not registered'}")
+        return 0
+    result = snapshot.refresh(compact=True if args.compact else None)
+    print(f"snapshot {result['seq']}: {result['rows']} rows in {result['files']} files, {result['deleted']} deletes"
+          + (", resynced" if result['resynced'] else "") + (", compacted" if result['compacted'] else ""))
+    return 0
+
+def buildcli():
+    parser = argparse.ArgumentParser(prog="trading_app_full.py")
+    parser.add_argument("--db", default=None, help="database path (default: %s)" % DBPATH)
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("checkstats", help="verify tuserstats/tuserpairstats against ttrading")
+    p.add_argument("--rebuild", action="store_true", help="rebuild aggregates when they drifted")
+    p.set_defaults(func=cmdcheckstats)
+    p = sub.add_parser("recalc", help="recompute pips/profit for every trade")
+    p.add_argument("--chunksize", type=int, default=RECALCCHUNKSIZE)
+    p.add_argument("--rate", type=float, default=None, help="USD/IDR rate (default: keep each row's rate)")
+    p.set_defaults(func=cmdrecalc)
+    p = sub.add_parser("import", help="import trades from a CSV or MT4/MT5 statement export")
+    p.add_argument("file")
+    p.add_argument("--user", required=True, help="username that owns the imported trades")
+    p.add_argument("--chunksize", type=int, default=IMPORTCHUNKSIZE)
+    p.add_argument("--dryrun", action="store_true", help="validate only, do not insert")
+    p.set_defaults(func=cmdimport)
+    p = sub.add_parser("export", help="stream trades to CSV, gzip CSV or Parquet")
+    p.add_argument("file")
+    p.add_argument("--format", choices=list(EXPORTFORMATS), default="csv")
+    p.add_argument("--user", help="only this username (default: all users)")
+    p.add_argument("--pair")
+    p.add_argument("--type", choices=["BUY", "SELL"])
+    p.add_argument("--datefrom")
+    p.add_argument("--dateto")
+    p.set_defaults(func=cmdexport)
+    p = sub.add_parser("fxrates", help="load USD/IDR history from a CSV (date,rate) or the API")
+    p.add_argument("file", nargs="?", help="CSV file (default: fetch from the API)")
+    p.add_argument("--datefrom", help="API range start (default: latest rate only)")
+    p.add_argument("--dateto")
+    p.add_argument("--revalue", action="store_true", help="revalue profitidr afterwards")
+    p.set_defaults(func=cmdfxrates)
+    p = sub.add_parser("revalue", help="recompute profitidr from the rate history")
+    p.add_argument("--datefrom")
+    p.add_argument("--dateto")
+    p.set_defaults(func=cmdrevalue)
+    p = sub.add_parser("candles", help="load an OHLC candle CSV into the candle store")
+    p.add_argument("pair")
+    p.add_argument("file")
+    p.set_defaults(func=cmdcandles)
+    p = sub.add_parser("replay", help="replay TP/SL of closed trades against the stored candles")
+    p.add_argument("--user", help="only this username (default: all users)")
+    p.add_argument("--horizon", type=float, default=REPLAYHORIZON / 86400, help="days after the open to search")
+    p.add_argument("--out", help="write the per-trade result to this CSV")
+    p.set_defaults(func=cmdreplay)
+    p = sub.add_parser("snapshot", help="bring the Parquet replica used by admin reports up to date")
+    p.add_argument("--dir", help="replica directory (default: %s)" % SNAPSHOTDIR)
+    p.add_argument("--compact", action="store_true", help="rewrite the replica as one file per month")
+    p.add_argument("--forget", action="store_true",
+                   help="unregister a replica that is no longer refreshed, so its watermark stops holding back tombstone pruning")
+    p.set_defaults(func=cmdsnapshot)
+    return parser
+
+def cli(argv):
+    global DBPATH
+    args = buildcli().parse_args(argv)
+    if args.db:
+        DBPATH = args.db
+    return args.func(args)
+
 if __name__ == "__main__":
+    # under Streamlit the script runs inside a script-run context; plain `python` gets the CLI
+    if len(sys.argv) > 1 and get_script_run_ctx() is None:
+        sys.exit(cli(sys.argv[1:]))
     main()
 # ----------------------- check store status